@@ -1,70 +1,112 @@
-import mne, re
+import mne, re, sys, multiprocessing
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils import buildcache
+
 
 def extract_run_numbers(filename):
     """Extract run numbers from a given filename."""
     numbers = re.findall(r'\d+', filename)
     return list(map(int, numbers))
 
-def detect_and_save_runs(participant_dir, output_dir):
-    """Detect and save runs from MEG data for all files in participant's directory."""
+def find_run_bounds(misc005, sfreq):
+    """Alternating start and end sample indices of the runs, from the breaks in MISC005."""
+    # Parameters for detecting the runs
+    eps = 1e-3
+    time_tresh = 5 * sfreq
+    gap_left = 10 * sfreq
+    gap_right = 3 * sfreq
+
+    # Find indices where MISC005 is below a specific threshold
+    indices = np.flatnonzero(misc005 < eps)
+    if len(indices) < 2:  # np.gradient needs 2 points, and there is no break anyway
+        return np.array([0, len(misc005) - 1])
+    grad = np.gradient(indices)
+    ind = np.flatnonzero(grad > time_tresh)
+
+    # MISC005 is low during the runs: each break ends a run gap_right after its last low sample
+    # and starts the next one gap_left before its first low sample
+    offsets = np.where(np.arange(len(ind)) % 2, -gap_left, gap_right)
+    indices_runs = np.concatenate([[0], indices[ind] + offsets, [len(misc005) - 1]])
+    return indices_runs.astype(int)
+
+def get_runs_list_fname(fif_file, output_dir):
+    """List of the runs saved from an acquisition file, with the fingerprint of the file"""
+    return Path(output_dir) / f'{Path(fif_file).stem}_runs.txt'
+
+def split_up_to_date(fif_file, output_dir):
+    """Whether the runs of the acquisition file were saved from its current version"""
+    runs_list = get_runs_list_fname(fif_file, output_dir)
+    if not buildcache.up_to_date(runs_list, buildcache.fingerprint([fif_file])):
+        return False
+    return all(Path(output_file).exists() for output_file in runs_list.read_text().splitlines())
+
+def split_runs(fif_file, output_dir):
+    """Detect the runs of a multi-run acquisition file and save each of them, without loading the recording."""
+    fif_file = Path(fif_file)
+    output_dir = Path(output_dir)
+    if split_up_to_date(fif_file, output_dir):
+        print(f'Runs of {fif_file.name} already saved')
+        return [Path(output_file) for output_file in get_runs_list_fname(fif_file, output_dir).read_text().splitlines()]
+    fingerprint = buildcache.fingerprint([fif_file])
+    output_dir.mkdir(parents=True, exist_ok=True)
+    raw = mne.io.read_raw_fif(fif_file, preload=False, allow_maxshield=True)
+
+    # Use the MISC channel to detect breaks: only this channel is kept in memory
+    misc005_data = raw.get_data(picks=['MISC005'])[0]
+    indices_runs = find_run_bounds(misc005_data, raw.info['sfreq'])
+    del misc005_data
+
+    # Extract run numbers from the file name
+    run_numbers = extract_run_numbers(fif_file.stem)
+
+    # Save each run, its samples being streamed from the acquisition file
+    saved = []
+    for i in range(0, len(indices_runs) - 1, 2):
+        start_idx = indices_runs[i]
+        end_idx = indices_runs[i+1]
+        tmin = start_idx / raw.info['sfreq']
+        tmax = end_idx / raw.info['sfreq']
+
+        run_number = run_numbers[i//2]
+        output_file = output_dir / f'run_{run_number}.fif'
+
+        # Cropping the (not preloaded) copy only changes the sample range to read
+        raw.copy().crop(tmin=tmin, tmax=tmax).save(output_file, overwrite=True)
+        print(f'Saved: {output_file}')
+        saved.append(output_file)
+
+    runs_list = get_runs_list_fname(fif_file, output_dir)
+    runs_list.write_text(''.join(f'{output_file}\n' for output_file in saved))
+    buildcache.record(runs_list, fingerprint)
+    return saved
+
+def detect_and_save_runs(participant_dir, output_dir, n_jobs=1):
+    """Detect and save runs from MEG data for all files in participant's directory.
+
+    The .fif files are processed by n_jobs worker processes (-1 for one per CPU).
+    """
     participant_dir = Path(participant_dir)
     output_dir = Path(output_dir)
     output_dir.mkdir(exist_ok=True)
 
-    # Iterate over all .fif files in the participant's directory
-    for fif_file in participant_dir.glob('*.fif'):
-        raw = mne.io.read_raw_fif(fif_file, preload=True, allow_maxshield=True)
-
-        # Use the MISC channel to detect breaks
-        raw_misc005 = raw.copy().pick_channels(['MISC005'])
-        misc005_data = raw_misc005.get_data()
-
-        # Parameters for detecting the runs
-        eps = 1e-3
-        time_tresh = 5 * raw.info['sfreq']
-        gap_left = 10 * raw.info['sfreq']
-        gap_right = 3 * raw.info['sfreq']
-
-        # Find indices where MISC005 is below a specific threshold
-        indices = np.where(misc005_data[0] < eps)[0]
-        grad = np.gradient(indices)
-        ind = np.where(grad > time_tresh)[0]
-
-        # Calculate the start and end indices for each run
-        indices_runs = [0]
-        for i, index in enumerate(ind):
-            if i % 2 != 0 and i > 0:
-                j = indices[index] - gap_left
-            else:
-                j = indices[index] + gap_right
-            indices_runs.append(j)
-        indices_runs.append(len(misc005_data[0])-1)
-        indices_runs = np.array(indices_runs).astype(int)
-
-
-        # Extract run numbers from the file name
-        run_numbers = extract_run_numbers(fif_file.stem)
-
-        # Save each run
-        for i in range(0, len(indices_runs) - 1, 2):
-            start_idx = indices_runs[i]
-            end_idx = indices_runs[i+1]
-            tmin = start_idx / raw.info['sfreq']
-            tmax = end_idx / raw.info['sfreq']
-
-            run_number = run_numbers[i//2]
-            output_file = output_dir / f'run_{run_number}.fif'
-
-            # Crop and save the data for the current run
-            raw_crop = raw.copy().crop(tmin=tmin, tmax=tmax)
-            raw_crop.save(output_file, overwrite=True)
-            print(f'Saved: {output_file}')
-
-## Example usage
-PARTICIPANT_DIR = '/home/jb278714/Bureau/LPP_project/data/MEG/meg_distraction/raw/ng_240362/241022'
-OUTPUT_DIR = '/home/jb278714/Bureau/LPP_project/data/MEG/meg_distraction/raw/ng_240362/cropped_runs'
-
-detect_and_save_runs(PARTICIPANT_DIR, OUTPUT_DIR)
+    fif_files = sorted(participant_dir.glob('*.fif'))
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+    n_jobs = max(1, min(n_jobs, len(fif_files)))
+    if n_jobs == 1:
+        return [output_file for fif_file in fif_files for output_file in split_runs(fif_file, output_dir)]
+
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [executor.submit(split_runs, fif_file, output_dir) for fif_file in fif_files]
+        return [output_file for future in futures for output_file in future.result()]
+
+if __name__ == "__main__":
+    ## Example usage
+    PARTICIPANT_DIR = '/home/jb278714/Bureau/LPP_project/data/MEG/meg_distraction/raw/ng_240362/241022'
+    OUTPUT_DIR = '/home/jb278714/Bureau/LPP_project/data/MEG/meg_distraction/raw/ng_240362/cropped_runs'
+
+    detect_and_save_runs(PARTICIPANT_DIR, OUTPUT_DIR, n_jobs=-1)
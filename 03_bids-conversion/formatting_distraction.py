@@ -1,16 +1,28 @@
 #!/usr/bin/env python
 
 import pandas as pd
-import os, re, mne
+import os, re, sys, mne, errno, fcntl, shutil, warnings, subprocess, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from mne_bids import BIDSPath, write_raw_bids
 
+# The subjects are converted in parallel (here and by pipeline.py): mne-bids only locks the
+# files they share (participants.tsv, dataset_description.json...) when filelock is installed
+try:
+    import filelock  # noqa: F401
+except ImportError as e:
+    raise ImportError("The BIDS conversion needs filelock, for mne-bids to lock participants.tsv "
+                      "while the subjects are converted in parallel: pip install filelock") from e
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils import buildcache
+from utils.config import bids_dir, load_config
+
 # Set mne only for errors, no warnings
 mne.set_log_level("ERROR")
 
 # Load configuration file
-with open("config.yml", "r") as f:
-    config = yaml.safe_load(f)
+config = load_config()
 
 # Load general parameters of the study
 STUDY = config["study"]
@@ -18,73 +30,241 @@ TASK = config["task"]
 SESSION = config["session"]
 MEG_DIR = config["meg_dir"]
 RUNS = config["runs"]
+N_WORKERS = config.get("n_workers", 1)
+# How the _meg.fif of the cropped runs are placed in the BIDS dataset: "copy" (rewritten by
+# mne-bids), or without copying the data, "hardlink", "reflink" or "symlink"
+BIDS_LINK = config.get("bids_link", "copy")
 
 # Define paths from config
 BASE_PATH = Path(config["base_path"])
-METADATA = config["metadata"]
-BIDS_PATH = BASE_PATH / 'bids'
+METADATA = Path(config["metadata"])
+# read by the preprocessing and the coregistration
+BIDS_PATH = bids_dir(config)
 RAW_DATA_PATH = BASE_PATH / 'raw'
 TASK = 'distraction'
+# Completed conversions, so that a rerun only converts the new or changed files
+# (hidden, so that it is ignored by the BIDS validator)
+MANIFEST = BIDS_PATH / '.conversions.json'
 
 dict_nip_to_sn = {'fa_123456': '1','mn_240236': '2', 'to_220041': '3', 'sg_230179': '4',
                   'mb_220766': '5', 'ka_230246' : '6', 'tm_240091' : '7', 'fb_210353': '8',
                   'lr_210454': '9', 'da_240251': '10', 'll_180197' : '11'}
 
-# For each of these folders, go into the sub folder
-for folder in RAW_DATA_PATH.iterdir():
-    sub_dir = RAW_DATA_PATH / folder / 'cropped_runs'
-    for file in os.listdir(sub_dir):
-        if file.endswith('.fif'):
-            nip = str(folder).split('/')[-1]
-            sub = dict_nip_to_sn[nip]
+def get_bids_path(sub, run):
+    """BIDS path of the MEG recording of a run"""
+    bids_path = BIDSPath(subject=sub, session=SESSION, run=run,
+                         datatype='meg', root=BIDS_PATH)
+    bids_path.task = TASK
+    return bids_path
 
+def plan_conversions(subs=None):
+    """Manifest of all the (NIP, subject, run) conversions, from dict_nip_to_sn and the cropped runs on disk
+
+    subs restricts it to some subject numbers.
+    """
+    conversions = []
+    for nip, sub in dict_nip_to_sn.items():
+        if subs is not None and sub not in subs:
+            continue
+        sub_dir = RAW_DATA_PATH / nip / 'cropped_runs'
+        if not sub_dir.is_dir():
+            print(f"No cropped runs for {nip} (sub-{sub})")
+            continue
+        for file in sorted(sub_dir.glob('*.fif')):  # not the lists of the runs of crop_runs.py
             # Extract run number
-            match = re.search(r"run_(\d+)\.fif", file)
-            if match:
-                run = match.group(1)
-            else:
-                print(f"No run number found for file: {file}")
+            match = re.search(r"run_(\d+)\.fif", file.name)
+            if not match:
+                print(f"Skipping file {file.name}")
                 continue
+            run = int(match.group(1))
+            bids_fname = get_bids_path(sub, run).update(suffix='meg', extension='.fif').fpath
+            conversions.append(dict(nip=nip, sub=sub, run=run, src=file, dst=bids_fname))
+    unknown = [folder.name for folder in RAW_DATA_PATH.iterdir() if folder.name not in dict_nip_to_sn]
+    if unknown and subs is None:
+        print(f"Folders without subject number in dict_nip_to_sn (not converted): {unknown}")
+    return conversions
 
-            # Check if the BIDS dataset already exists:
-            run = int(run)
-            fname = f"sub-{sub}/ses-01/meg/sub-{sub}_task-{TASK}_run-{run:02d}_meg.fif"
-            if (BIDS_PATH / fname).exists():
-                print(f"The file {fname} already exists: not created again.")
-                continue
+def conversion_fingerprint(conversion):
+    return buildcache.fingerprint([conversion['src']], params=dict(
+        sub=conversion['sub'], run=conversion['run'], task=TASK, session=SESSION))
+
+# ioctl cloning a file on copy-on-write filesystems (Linux FICLONE)
+FICLONE = 0x40049409
+
+def reflink(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+def place_fif(src, dst, mode):
+    """Replace the symlink written by mne-bids at dst by a hardlink (or reflink) of src
+
+    Falls back to reflink, then to a plain copy, when the filesystem does not support
+    it (e.g. src and dst on different filesystems). Returns how the file was placed.
+    """
+    tmp = dst.with_name(f"{dst.name}.{os.getpid()}.tmp")
+    methods = dict(hardlink=["hardlink", "reflink", "copy"], reflink=["reflink", "copy"])[mode]
+    for method in methods:
+        try:
+            if method == "hardlink":
+                os.link(src, tmp)
+            elif method == "reflink":
+                reflink(src, tmp)
+            else:
+                shutil.copyfile(src, tmp)
+        except OSError as e:
+            if tmp.exists():
+                tmp.unlink()
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY):
+                raise
+            continue
+        os.replace(tmp, dst)
+        return method
+
+def link_run(raw, src, bids_path):
+    """Write the sidecars of a run, its _meg.fif being a link to the cropped run"""
+    # Remove the previous conversion ourselves: when overwriting, mne-bids loads the data first
+    dst = bids_path.copy().update(suffix='meg', extension='.fif').fpath
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+
+    # Write the sidecars and a symbolic link to the cropped run, then replace the link if needed
+    write_raw_bids(raw, bids_path=bids_path, overwrite=True, symlink=True)
+    if BIDS_LINK != "symlink":
+        method = place_fif(src, dst, BIDS_LINK)
+        if method != BIDS_LINK:
+            print(f"Could not {BIDS_LINK} {src}, placed by {method}")
+
+def convert(sub, runs):
+    """Write runs of a subject into the BIDS dataset, one after the other
 
+    The runs of a subject share its scans.tsv, so they are written by the same
+    worker. Returns the error of each run (None if it was converted).
+    """
+    errors = []
+    for src, run in runs:
+        try:
             # Open the raw file
-            raw = mne.io.read_raw_fif(sub_dir / file, allow_maxshield=True)
+            raw = mne.io.read_raw_fif(src, allow_maxshield=True)
+            bids_path = get_bids_path(sub, run)
 
-            # Create a BIDS path with the correct parameters
-            bids_path = BIDSPath(subject=sub, session=SESSION, run=run,
-                                 datatype='meg', root=BIDS_PATH)
-            bids_path.task = TASK
+            # The data are written again unless linking is asked for and the cropped run is a
+            # single FIF file (split files refer to each other by their original names)
+            if BIDS_LINK == "copy" or len(raw.filenames) > 1:
+                write_raw_bids(raw, bids_path=bids_path, overwrite=True)
+            else:
+                link_run(raw, src, bids_path)
+        except Exception as e:
+            errors.append(repr(e))
+            continue
+        errors.append(None)
+    return errors
+
+def write_events(conversions, manifest):
+    """Copy the metadata of each run next to the recordings, each metadata file being loaded once for all subjects"""
+    by_run = {}
+    for conversion in conversions:
+        by_run.setdefault(conversion['run'], []).append(conversion)
+
+    for run, run_conversions in sorted(by_run.items()):
+        metadata_fname = METADATA / f'task-distraction_run-{run:02d}_extra_info.csv'
+        if not metadata_fname.exists():
+            print(f"No metadata file for {run}")
+            continue
+        fingerprint = buildcache.fingerprint([metadata_fname])
+        df = None
+        for conversion in run_conversions:
+            sub = conversion['sub']
+            events_fname = conversion['dst'].parent / f'sub-{sub}_task-{TASK}_run-{run:02d}_events.tsv'
+            if manifest.up_to_date(events_fname, fingerprint):
+                continue
+            if df is None:
+                # the columns of the metadata, unchanged (trial_type is parsed when the events are read)
+                df = pd.read_csv(metadata_fname, sep='\t')
+            df.to_csv(events_fname, sep='\t')
+            manifest.record(events_fname, fingerprint)
+
+def pending_conversions(conversions, manifest):
+    """Conversions which are not in the BIDS dataset yet, or whose cropped run changed"""
+    todo = []
+    for conversion in conversions:
+        conversion['fingerprint'] = conversion_fingerprint(conversion)
+        if manifest.up_to_date(conversion['dst'], conversion['fingerprint']):
+            continue
+        if conversion['dst'].exists() and str(conversion['dst']) not in manifest.entries:
+            # converted before the manifest existed
+            print(f"The file {conversion['dst']} already exists: not created again.")
+            manifest.record(conversion['dst'], conversion['fingerprint'])
+            continue
+        todo.append(conversion)
+    return todo
 
-            # Write the BIDS path from the raw file
-            write_raw_bids(raw, bids_path=bids_path, overwrite=True)
-        else:
-            print(f"Skipping file {file}")
+def convert_subject(sub):
+    """Convert the new or changed runs of a subject and copy their events (one task of pipeline.py)"""
+    conversions = plan_conversions([sub])
+    manifest = buildcache.Manifest(MANIFEST)
+    todo = pending_conversions(conversions, manifest)
+    errors = convert(sub, [(c['src'], c['run']) for c in todo])
+    failed = []
+    for conversion, error in zip(todo, errors):
+        if error is not None:
+            print(f"Failed to convert {conversion['src']}: {error}")
+            failed.append(conversion)
             continue
+        manifest.record(conversion['dst'], conversion['fingerprint'])
+    write_events([c for c in conversions if c not in failed and c['dst'].exists()], manifest)
+    if failed:
+        raise RuntimeError(f"Failed to convert {len(failed)} run(s) of sub-{sub}")
+
+def validate(bids_root):
+    """Run the BIDS validator on the dataset if it is installed. Returns whether it passed (None if not run)"""
+    validator = shutil.which("bids-validator")
+    if validator is None:
+        warnings.warn("bids-validator not found: the dataset was not validated "
+                      "(see https://github.com/bids-standard/bids-validator)")
+        return None
+    result = subprocess.run([validator, str(bids_root)], capture_output=True, text=True)
+    print(result.stdout[-5000:])
+    print(f"BIDS validator {'passed' if result.returncode == 0 else 'FAILED'}")
+    return result.returncode == 0
+
+if __name__ == "__main__":
+    conversions = plan_conversions()
+    manifest = buildcache.Manifest(MANIFEST)
+
+    # Only convert the runs which are not in the BIDS dataset yet, or whose cropped run changed
+    todo = pending_conversions(conversions, manifest)
+    print(f"{len(conversions) - len(todo)} of the {len(conversions)} runs already converted, converting {len(todo)}")
 
-# Putting the generated annotation files in the correct directories
-for sub in os.listdir(BIDS_PATH):
-    if sub.startswith('sub-'):
-        SUBJ_PATH_BIDS = BIDS_PATH / f'{sub}/meg'
-        files_bids = os.listdir(SUBJ_PATH_BIDS)
-        for file in files_bids:
-            match = re.search(r"run-(\d+)_meg\.fif", file)
-            if match:
-                run = match.group(1)
-                run = int(run)
-                try:
-                    df = pd.read_csv(METADATA / f'task-distraction_run-{run:02d}_extra_info.csv', sep='\t')
-
-                    df.to_csv(f'{SUBJ_PATH_BIDS}/{sub}_task-{TASK}_run-{run:02d}_events.tsv', sep='\t')
-                except FileNotFoundError:
-                    print(f"No metadata file for {run}")
+    # One job per subject. The files of the dataset shared by all the subjects
+    # (participants.tsv...) are locked by mne-bids, with filelock
+    by_subject = {}
+    for conversion in todo:
+        by_subject.setdefault(conversion['sub'], []).append(conversion)
+
+    failed = []
+    with ProcessPoolExecutor(
+        max_workers=max(1, N_WORKERS), mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = {
+            executor.submit(convert, sub, [(c['src'], c['run']) for c in subject_conversions]): subject_conversions
+            for sub, subject_conversions in by_subject.items()
+        }
+        for future in as_completed(futures):
+            for conversion, error in zip(futures[future], future.result()):
+                if error is not None:
+                    print(f"Failed to convert {conversion['src']}: {error}")
+                    failed.append(conversion)
                     continue
-print(f"\n \n ***************************************************\
+                manifest.record(conversion['dst'], conversion['fingerprint'])
+                print(f"Converted {conversion['src']} -> {conversion['dst']}")
+
+    # Putting the generated annotation files in the correct directories
+    write_events([c for c in conversions if c not in failed and c['dst'].exists()], manifest)
+
+    # Links to the cropped runs must leave a valid dataset
+    validate(BIDS_PATH)
+
+    print(f"\n \n ***************************************************\
 \n Script finished!\n \
 ***************************************************\
-\n Folder created: \n For bids: {BIDS_PATH} \n ")
\ No newline at end of file
+\n Folder created: \n For bids: {BIDS_PATH} \n ")
@@ -1,16 +1,20 @@
 #!/usr/bin/env python
 
-import os, yaml, gc, mne, dataclasses, itertools
+import os, sys, gc, mne, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 import numpy as np
-import pandas as pd
-import typing as tp
-from wordfreq import zipf_frequency
-from mne.preprocessing import find_bad_channels_maxwell
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils import averaging, bads, buildcache, epochstore, lexicon, telemetry
+from utils.config import bids_dir, epochs_fname, load_config, preprocessed_dir
+from utils.events import read_events, set_cache_dir
+from utils.matching import approx_match_samples
+from utils.parallel import set_num_threads
+from utils.sss import ChunkedRun, find_bad_channels_chunked, streaming_maxwell_filter
 
 # Load configuration file
-with open("config.yml", "r") as f:
-    config = yaml.safe_load(f)
+config = load_config()
 
 # Set the number of threads
 NUM_THREADS = str(config["num_threads"])
@@ -18,6 +22,10 @@ os.environ["OMP_NUM_THREADS"] = NUM_THREADS
 os.environ["OPENBLAS_NUM_THREADS"] = NUM_THREADS
 os.environ["MKL_NUM_THREADS"] = NUM_THREADS
 
+# Parallel execution: number of worker processes and BLAS threads per worker
+N_WORKERS = config.get("n_workers", 1)
+THREADS_PER_WORKER = config.get("threads_per_worker", config["num_threads"])
+
 # Load general parameters of the study
 STUDY = config["study"]
 TASK = config["task"]
@@ -27,10 +35,23 @@ RUNS = config["runs"]
 
 # Define paths from config
 BASE_PATH = Path(config["base_path"])
-SUBJECTS_DIR = BASE_PATH / config["subjects_dir"]
+# BIDS dataset of the conversion, and derivatives of the subjects
+BIDS_DIR = bids_dir(config)
+PREPROCESSED_DIR = preprocessed_dir(config)
 METADATA = config["metadata"]
 CROSS_TALK_FILE = BASE_PATH / config["cross_talk_file"]
 CALIBRATION_FILE = BASE_PATH / config["calibration_file"]
+WORDFREQ_CACHE = BASE_PATH / config.get("wordfreq_cache", f"{STUDY}/derivatives/wordfreq.sqlite")
+EVENTS_CACHE = BASE_PATH / config.get("events_cache", f"{STUDY}/derivatives/events_cache")
+
+# Word frequencies are cached on disk, shared by all the runs, subjects and workers
+lexicon.set_cache_file(WORDFREQ_CACHE)
+# and so are the events files parsed (not next to the metadata, which may be read-only)
+set_cache_dir(EVENTS_CACHE)
+
+# Time, CPU, memory and I/O of each stage of each run (see utils/telemetry.py), null to disable
+TELEMETRY = config.get("telemetry", f"{STUDY}/derivatives/telemetry.jsonl")
+telemetry.configure(TELEMETRY and BASE_PATH / TELEMETRY)
 
 # Preprocessing parameters
 MIDDLE_RUN = config["middle_run"]
@@ -39,235 +60,359 @@ FILTER_HIGH = config["filter_high"]
 EPOCH_TMIN = config["epoch_tmin"]
 EPOCH_TMAX = config["epoch_tmax"]
 BASELINE = tuple(config["baseline"])
+# Memory budget of the chunked filtering + Maxwell mode for long runs, and of the median averaging
+# (None: whole run in memory)
+MAX_MEMORY_MB = config.get("max_memory_mb", None)
+# Approximate (streaming) medians of the epochs, without keeping them in memory or on disk
+APPROXIMATE_MEDIAN = config.get("approximate_median", False)
+# Keep the epochs of each run (and their word metadata) for the contrasts of 03_contrasts.py
+EPOCH_STORE = config.get("epoch_store", False)
+# Bad channel detection: scan one 5 s window out of BADS_EVERY, on the runs decimated by BADS_DECIM
+BADS_EVERY = config.get("bads_every", 1)
+BADS_DECIM = config.get("bads_decim", 1)
+# Also mark bad in every run the channels found bad in at least BADS_MIN_RUNS runs of the subject
+BADS_MIN_RUNS = config.get("bads_min_runs", None)
 
 # Optional: List of specific subjects to process
 SPECIFIC_SUBJECTS = config.get("subjects", None)  # Default to an empty list if "subjects" is missing
 if isinstance(SPECIFIC_SUBJECTS, str):  # Handle case where "subjects" is a single string
     SPECIFIC_SUBJECTS = [SPECIFIC_SUBJECTS]
 
+# Matching tolerances
+TOL_MISSING_DICT = {tuple(k): tuple(v) for k, v in config["tolerances"].items()}
 
-class NoApproximateMatch(ValueError):
-    """Error raised when the function could not fully match the two list
-    The error has a 'match' attribute holding the matches so far, for debugging
-    """
+# Version of the code, for the incremental rebuild of the derivatives
+UTILS_DIR = Path(__file__).resolve().parents[1] / "utils"
+CODE_VERSION = buildcache.code_version(
+    __file__, *[UTILS_DIR / f"{module}.py" for module in ["averaging", "bads", "epochstore", "events", "lexicon", "matching", "sss"]]
+)
 
-    def __init__(self, msg: str, matches: tp.Any) -> None:
-        super().__init__(msg)
-        self.matches = matches
-
-@dataclasses.dataclass
-class Tolerance:
-    """Convenience tool for check if a value is  within tolerance"""
-
-    abs_tol: float
-    rel_tol: float
-
-    def __call__(self, value1: float, value2: float) -> bool:
-        diff = abs(value1 - value2)
-        tol = max(self.abs_tol, self.rel_tol * min(abs(value1), abs(value2)))
-        return diff <= tol
-
-@dataclasses.dataclass
-class Sequence:
-    """Handle for current information on the sequence matching"""
-
-    sequence: tp.Sequence[float]  # the sequence to match
-    current: int  # the current index for next match look-up
-    matches: tp.List[int]  # the matches so far in the sequence
-
-    def valid_index(self, shift: int = 0) -> bool:
-        return self.current + shift < len(self.sequence)
-
-    def diff(self, shift: int = 0) -> float:
-        return self.sequence[self.current + shift] - self.last_value
-
-    @property
-    def last_value(self) -> float:
-        return self.sequence[self.matches[-1]]
-
-    def diff_to(self, ind: int) -> np.ndarray:
-        r = self.matches[-1]
-        sub = self.sequence[r : r + ind] if ind > 0 else self.sequence[r + ind : r]
-        return np.array(sub) - self.last_value
-
-def approx_match_samples(
-    s1: tp.Sequence[float],
-    s2: tp.Sequence[float],
-    abs_tol: float,
-    rel_tol: float = 0.003,
-    max_missing: int = 3,
-    first_match: tp.Tuple[int, int] | None = None,
-) -> tp.Tuple[np.ndarray, np.ndarray]:
-    """
-    Approximate sample sequence matching
-    Eg:
-    seq0 = [1100, 2300, 3600]
-    seq1 = [0, 1110, 3620, 6500]
-    will match on 1100-1110 with tolerance 10,
-    and then on 3600-3620 (as the diffs match with tolerance 10)
-
-    Returns
-    -------
-    tuple of indices which match on the first list and the second list
-    """
-    if first_match is None:
-        success: tp.Tuple[np.ndarray, np.ndarray] | None = None
-        error: tp.Any = None
-        for offsets in itertools.product(range(max_missing + 1), repeat=2):
-            try:
-                out = approx_match_samples(
-                    s1, s2, abs_tol=abs_tol, rel_tol=rel_tol, max_missing=max_missing, first_match=offsets  # type: ignore
-                )
-                if success is None or len(out[0]) > len(success[0]):  # type: ignore
-                    success = out
-            except NoApproximateMatch as e:
-                if error is None or error.matches[0][-1] < e.matches[0][-1]:
-                    error = e
-        if success is not None:
-            return success
-        raise error
-    tolerance = Tolerance(abs_tol=abs_tol, rel_tol=rel_tol)
-    seqs = (
-        Sequence(s1, first_match[0] + 1, [first_match[0]]),
-        Sequence(s2, first_match[1] + 1, [first_match[1]]),
-    )
-    while all(s.valid_index() for s in seqs):
-        if tolerance(seqs[0].diff(), seqs[1].diff()):
-            for k, s in enumerate(seqs):
-                s.matches.append(s.current)
-                s.current += 1
-        else:
-            # move one step
-            seqs[1 if seqs[1].diff() < seqs[0].diff() else 0].current += 1
-        # allow for 1 extra (absolute) step if getting closer
-        for k, seq in enumerate(seqs):
-            other = seqs[(k + 1) % 2]
-            if seq.valid_index(shift=1) and other.valid_index():
-                # need to check 2 tolerance so that we can match farther
-                # if it is closer
-                if abs(seq.diff(1) - seq.diff()) <= 2 * abs_tol:
-                    if abs(seq.diff(1) - other.diff()) < abs(seq.diff() - other.diff()):
-                        seq.current += 1
-        # if we are over the limit for matching, then abort
-        if any(m.current - m.matches[-1] > max_missing + 1 for m in seqs):
-            msg = f"Failed to match after indices {[s.matches[-1] for s in seqs]} "
-            msg += f"(values {[s.last_value for s in seqs]}, {first_match=})\n"
-            msg += f"(follows:\n {seqs[0].diff_to(10)}\n {seqs[1].diff_to(10)}"
-            msg += f"(before:\n {seqs[0].diff_to(-10)}\n {seqs[1].diff_to(-10)}"
-            out = tuple(np.array(s.matches) for s in seqs)  # type: ignore
-            raise NoApproximateMatch(msg, matches=out)
-    return tuple(np.array(s.matches) for s in seqs)  # type: ignore
-
-def get_wordfreq(word:str):
-    return zipf_frequency(word, 'fr')
+def get_raw_fname(SUBJECT, run):
+    return BIDS_DIR / f"{SUBJECT}/{MEG_DIR}/{SUBJECT}_{SESSION}task-{TASK}_run-0{run}_meg.fif"
 
-# Matching tolerances
-TOL_MISSING_DICT = {tuple(k): tuple(v) for k, v in config["tolerances"].items()}
+def get_sss_fname(SUBJECT, run):
+    return PREPROCESSED_DIR / f"{SUBJECT}/{SUBJECT}_{SESSION}task-{TASK}_run-0{run}_meg_raw_sss.fif"
 
-def preprocessing(SUBJECT):
-    evo_diff_all = []
+def get_channels_fname(SUBJECT, run):
+    return PREPROCESSED_DIR / f"{SUBJECT}/{SUBJECT}_{SESSION}task-{TASK}_run-0{run}_channels.tsv"
 
-    for i in runs:
-        
-        raw_fname = SUBJECTS_DIR / f"{SUBJECT}/{MEG_DIR}/{SUBJECT}_{SESSION}task-{TASK}_run-0{i}_meg.fif"
-        raw = mne.io.read_raw_fif(raw_fname, allow_maxshield=True)
-        raw_ref = mne.io.read_raw_fif(SUBJECTS_DIR / f"{SUBJECT}/{MEG_DIR}/{SUBJECT}_{SESSION}task-{TASK}_{MIDDLE_RUN}_meg.fif", allow_maxshield=True)
+def get_events_fname(SUBJECT, run):
+    return METADATA + f"{SUBJECT}_{SESSION}task-{TASK}_run-0{run}_events.tsv"
 
-        raw.load_data().filter(FILTER_LOW, FILTER_HIGH)
+def get_evo_diff_fname(SUBJECT):
+    return PREPROCESSED_DIR / f"{SUBJECT}/{SUBJECT}_evo_diff-ave.fif"
 
-        # ------------- Finding bad channels automatically ------------- #
-        raw.info["bads"] = []
-        auto_noisy_chs, auto_flat_chs = find_bad_channels_maxwell(
-            raw, cross_talk=CROSS_TALK_FILE, calibration=CALIBRATION_FILE)
-        bads = raw.info["bads"] + auto_noisy_chs + auto_flat_chs
-        raw.info["bads"] = bads
+def get_epochs_fname(SUBJECT, run):
+    """Folder of the epoch store of a run (see utils/epochstore.py)"""
+    return epochs_fname(config, SUBJECT, run)
 
-        # ------------- Applying Maxwell filter ------------- #
-        destination = raw_ref.info["dev_head_t"]
-        raw_sss = mne.preprocessing.maxwell_filter(
-            raw, cross_talk=CROSS_TALK_FILE, calibration=CALIBRATION_FILE, destination=destination
-        )
+def bads_fingerprint(SUBJECT, run):
+    """Inputs, config keys and code the channels.tsv of a run is built from"""
+    return buildcache.fingerprint(
+        [get_raw_fname(SUBJECT, run), CROSS_TALK_FILE, CALIBRATION_FILE],
+        params=dict(filter_low=FILTER_LOW, filter_high=FILTER_HIGH, bads_every=BADS_EVERY, bads_decim=BADS_DECIM),
+        code=CODE_VERSION,
+    )
+
+def sss_fingerprint(SUBJECT, run):
+    """Inputs, config keys and code the _raw_sss.fif of a run is built from
+
+    The channels.tsv the bad channels are read from (those of all the runs if
+    they are pooled) are inputs, so that editing them by hand is taken into account
+    """
+    middle_fname = BIDS_DIR / f"{SUBJECT}/{MEG_DIR}/{SUBJECT}_{SESSION}task-{TASK}_{MIDDLE_RUN}_meg.fif"
+    bads_runs = RUNS if BADS_MIN_RUNS else [run]
+    return buildcache.fingerprint(
+        [get_raw_fname(SUBJECT, run), middle_fname, CROSS_TALK_FILE, CALIBRATION_FILE],
+        params=dict(
+            filter_low=FILTER_LOW, filter_high=FILTER_HIGH, middle_run=MIDDLE_RUN,
+            bads_every=BADS_EVERY, bads_decim=BADS_DECIM, bads_min_runs=BADS_MIN_RUNS,
+        ),
+        code=CODE_VERSION,
+        optional=[get_channels_fname(SUBJECT, r) for r in bads_runs],
+    )
 
-        del raw_ref
-        gc.collect()
+def evo_diff_fingerprint(SUBJECT):
+    """Inputs, config keys and code the _evo_diff-ave.fif of a subject is built from"""
+    fp = [sss_fingerprint(SUBJECT, run) for run in RUNS]
+    return buildcache.fingerprint(
+        [fname for f in fp for fname in f["inputs"]] + [get_events_fname(SUBJECT, run) for run in RUNS],
+        params=dict(
+            fp[0]["params"], runs=RUNS, epoch_tmin=EPOCH_TMIN, epoch_tmax=EPOCH_TMAX,
+            baseline=BASELINE, tolerances=config["tolerances"], approximate_median=APPROXIMATE_MEDIAN,
+        ),
+        code=CODE_VERSION,
+    )
+
+def epochs_fingerprint(SUBJECT, run):
+    """Inputs, config keys and code the epoch store of a run is built from"""
+    return buildcache.fingerprint(
+        [get_sss_fname(SUBJECT, run), get_events_fname(SUBJECT, run)],
+        params=dict(
+            epoch_tmin=EPOCH_TMIN, epoch_tmax=EPOCH_TMAX, baseline=BASELINE,
+            tolerances=TOL_MISSING_DICT.get((int(SUBJECT.split("-")[1]), int(run))),
+        ),
+        code=CODE_VERSION,
+    )
 
-        os.makedirs(BASE_PATH / f"{STUDY}/derivatives/preprocessed_data/{SUBJECT}", exist_ok=True)
-        raw_sss.save(BASE_PATH / f"{STUDY}/derivatives/preprocessed_data/{SUBJECT}/{SUBJECT}_{SESSION}task-{TASK}_run-0{i}_meg_raw_sss.fif", overwrite=True)
+def epochs_up_to_date(SUBJECT, run):
+    try:
+        return buildcache.up_to_date(get_epochs_fname(SUBJECT, run), epochs_fingerprint(SUBJECT, run))
+    except FileNotFoundError:  # run not Maxwell filtered yet
+        return False
 
-        # ------------- Loading metadata with onsets, words, and duration ------------- #
-        words = pd.read_csv(METADATA + f"{SUBJECT}_{SESSION}task-{TASK}_run-0{i}_events.tsv", sep="\t")
-        words["word"] = words["trial_type"].apply(lambda x: eval(x)["word"] if type(eval(x)) == dict else np.nan)
+def detect_run_bads(SUBJECT, run, filtered_raw=None):
+    """Noisy and flat channels of a run, read from its channels.tsv if it is up to date, detected otherwise
+
+    filtered_raw is the band-pass filtered run if the caller already loaded it
+    """
+    channels_fname = get_channels_fname(SUBJECT, run)
+    fingerprint = bads_fingerprint(SUBJECT, run)
+    if buildcache.up_to_date(channels_fname, fingerprint):
+        return bads.read_channels_tsv(channels_fname)
+
+    kwargs = dict(every=BADS_EVERY, decim=BADS_DECIM, cross_talk=CROSS_TALK_FILE, calibration=CALIBRATION_FILE)
+    if filtered_raw is not None:
+        raw = filtered_raw
+        with telemetry.stage("find_bad_channels_maxwell", SUBJECT, run, every=BADS_EVERY, decim=BADS_DECIM):
+            noisy, flat = bads.find_bad_channels(raw, **kwargs)
+    else:
+        raw = mne.io.read_raw_fif(get_raw_fname(SUBJECT, run), allow_maxshield=True)
+        if MAX_MEMORY_MB:
+            step = int(round(5.0 * raw.info["sfreq"]))  # windows of find_bad_channels_maxwell
+            chunked_run = ChunkedRun(raw, FILTER_LOW, FILTER_HIGH, MAX_MEMORY_MB, step=step)
+            # filtered chunk by chunk along the way
+            with telemetry.stage("find_bad_channels_maxwell", SUBJECT, run, every=BADS_EVERY, decim=BADS_DECIM, chunked=True):
+                noisy, flat = find_bad_channels_chunked(chunked_run, **kwargs)
+        else:
+            with telemetry.stage("filter", SUBJECT, run):
+                raw.load_data().filter(FILTER_LOW, FILTER_HIGH)
+            with telemetry.stage("find_bad_channels_maxwell", SUBJECT, run, every=BADS_EVERY, decim=BADS_DECIM):
+                noisy, flat = bads.find_bad_channels(raw, **kwargs)
+
+    os.makedirs(channels_fname.parent, exist_ok=True)
+    bads.write_channels_tsv(channels_fname, raw.info, noisy, flat, method="find_bad_channels_maxwell")
+    buildcache.record(channels_fname, fingerprint)
+    return noisy, flat
+
+def get_bads(SUBJECT, run, filtered_raw=None):
+    """Bad channels of a run, pooled across the runs of the subject if BADS_MIN_RUNS is set"""
+    noisy, flat = detect_run_bads(SUBJECT, run, filtered_raw)
+    if not BADS_MIN_RUNS:
+        return noisy + flat
+    # the other runs are read from their channels.tsv, once they have all been scanned
+    run_bads = [sum(detect_run_bads(SUBJECT, r), []) if r != run else noisy + flat for r in RUNS]
+    return bads.pool_bads(run_bads, noisy + flat, BADS_MIN_RUNS)
+
+def preprocess_run(SUBJECT, run):
+    """Preprocess one run of a subject and return its rare - frequent evoked difference"""
+    raw = mne.io.read_raw_fif(get_raw_fname(SUBJECT, run), allow_maxshield=True)
+    destination = mne.io.read_info(BIDS_DIR / f"{SUBJECT}/{MEG_DIR}/{SUBJECT}_{SESSION}task-{TASK}_{MIDDLE_RUN}_meg.fif")["dev_head_t"]
+
+    os.makedirs(PREPROCESSED_DIR / SUBJECT, exist_ok=True)
+    sss_fname = get_sss_fname(SUBJECT, run)
+
+    if buildcache.up_to_date(sss_fname, sss_fingerprint(SUBJECT, run)):
+        print(f"Reusing {sss_fname.name} (up to date)")
+        raw_sss = mne.io.read_raw_fif(sss_fname)
+    elif MAX_MEMORY_MB:
+        # ------------- Filtering, bad channels and Maxwell filter, chunk by chunk ------------- #
+        run_bads = get_bads(SUBJECT, run)
+        # filter, Maxwell filter and save are interleaved: a single stage
+        with telemetry.stage("maxwell_filter", SUBJECT, run, chunked=True, max_memory_mb=MAX_MEMORY_MB):
+            streaming_maxwell_filter(
+                raw, sss_fname, FILTER_LOW, FILTER_HIGH, MAX_MEMORY_MB,
+                cross_talk=CROSS_TALK_FILE, calibration=CALIBRATION_FILE, destination=destination, bads=run_bads
+            )
+        buildcache.record(sss_fname, sss_fingerprint(SUBJECT, run))
+        raw_sss = mne.io.read_raw_fif(sss_fname)
+    else:
+        with telemetry.stage("filter", SUBJECT, run):
+            raw.load_data().filter(FILTER_LOW, FILTER_HIGH)
+
+        # ------------- Finding bad channels automatically (or reading them from channels.tsv) ------------- #
+        raw.info["bads"] = get_bads(SUBJECT, run, filtered_raw=raw)
 
-        # ------------- Getting triggers with the right timing ------------- #
+        # ------------- Applying Maxwell filter ------------- #
+        with telemetry.stage("maxwell_filter", SUBJECT, run, n_bads=len(raw.info["bads"])):
+            raw_sss = mne.preprocessing.maxwell_filter(
+                raw, cross_talk=CROSS_TALK_FILE, calibration=CALIBRATION_FILE, destination=destination
+            )
+        with telemetry.stage("save", SUBJECT, run):
+            raw_sss.save(sss_fname, overwrite=True)
+        buildcache.record(sss_fname, sss_fingerprint(SUBJECT, run))
+
+    # ------------- Loading metadata with onsets, words, and duration ------------- #
+    words = read_events(get_events_fname(SUBJECT, run))
+
+    # ------------- Getting triggers with the right timing ------------- #
+    SUBJECT_ = SUBJECT.split("-")[1]
+    abs_tol, max_missing = TOL_MISSING_DICT.get((int(SUBJECT_), int(run)), (10, 5))
+    with telemetry.stage("trigger_matching", SUBJECT, run, n_words=len(words)) as record:
         word_triggers = mne.find_stim_steps(raw, stim_channel="STI008")
         word_triggers = word_triggers[word_triggers[:, 2] == 0]
-        run = i
-        SUBJECT_ = {SUBJECT}.split("-")[1]
-        abs_tol, max_missing = TOL_MISSING_DICT.get((int(SUBJECT_), int(run)), (10, 5))
         i, j = approx_match_samples(
             (words.onset * 1000).tolist(), word_triggers[:, 0], abs_tol=abs_tol, max_missing=max_missing
         )
-        print(f"Found {len(i)/len(words)} of the words in the triggers")
-
-        words = words.iloc[i, :]
-        words.loc[:, "unaligned_start"] = words.loc[:, "onset"]
-        words.loc[words.index, "onset"] = word_triggers[j, 0] / raw.info["sfreq"]
-
-        # ------------- Epoching based on frequent/rare words ------------- #
-        n_words = len(words)
-        events = np.ones((n_words, 3), dtype=int)
-        events[:, 0] = words.onset * raw.info["sfreq"]
-        events[:, 2] = np.arange(n_words)
-
-        words["freq"] = words.word.apply(get_wordfreq)
-        words["is_rare"] = words.freq < np.median(words.freq)
-
+        record.update(n_triggers=len(word_triggers), n_matched=len(i))
+    print(f"Found {len(i)/len(words)} of the words in the triggers")
+
+    words = words.iloc[i, :]
+    words.loc[:, "unaligned_start"] = words.loc[:, "onset"]
+    words.loc[words.index, "onset"] = word_triggers[j, 0] / raw.info["sfreq"]
+
+    # ------------- Epoching based on frequent/rare words ------------- #
+    # events without a word (NaN frequency) are neither rare nor frequent: they are not epoched
+    words["freq"] = lexicon.word_frequencies(words.word, "fr")
+    words = words[words.freq.notna()].copy()
+    words["is_rare"] = words.freq < np.nanmedian(words.freq)
+
+    n_words = len(words)
+    events = np.ones((n_words, 3), dtype=int)
+    events[:, 0] = words.onset * raw.info["sfreq"]
+    events[:, 2] = np.arange(n_words)
+    # features of the words, for the contrasts computed from the epoch store
+    words["run"] = run
+    words["position"] = words.index  # rank of the word in the events of the run
+    words["length"] = words.word.str.len()
+
+    del raw
+    gc.collect()
+
+    # not loaded: the epochs are read once, while both medians are computed
+    with telemetry.stage("epoching", SUBJECT, run, n_events=n_words):
         epochs_run = mne.Epochs(
             raw_sss, events, tmin=EPOCH_TMIN, tmax=EPOCH_TMAX, baseline=BASELINE, metadata=words)
 
-        del raw
-        gc.collect()
-
-        epochs_run.load_data()
+    conditions = dict(rare="is_rare", freq="~is_rare")
+    kwargs = dict(max_memory_mb=MAX_MEMORY_MB, approximate=APPROXIMATE_MEDIAN)
+    write_store = EPOCH_STORE and not epochs_up_to_date(SUBJECT, run)
+    with telemetry.stage("median_averaging", SUBJECT, run, n_epochs=len(epochs_run.events), approximate=APPROXIMATE_MEDIAN,
+                         epoch_store=write_store):
+        if write_store:
+            # the epochs are written to the store as they are read for the medians
+            epochs_fname = get_epochs_fname(SUBJECT, run)
+            with epochstore.writer(epochs_fname, epochs_run) as store:
+                evokeds = averaging.median_evokeds(epochs_run, conditions, copy_to=store, **kwargs)
+            buildcache.record(epochs_fname, epochs_fingerprint(SUBJECT, run))
+        else:
+            evokeds = averaging.median_evokeds(epochs_run, conditions, **kwargs)
+    evo_rare, evo_freq = evokeds["rare"], evokeds["freq"]
 
-        evo_rare = epochs_run["is_rare"].average(method="median")
-        evo_freq = epochs_run["~is_rare"].average(method="median")
+    evo_diff = evo_rare.copy()
+    evo_diff.data -= evo_freq.data
 
-        evo_diff = evo_rare.copy()
-        evo_diff.data -= evo_freq.data
+    return evo_diff
 
-        evo_diff_all.append(evo_diff)
+def preprocessing(SUBJECT):
+    evo_diff_all = [preprocess_run(SUBJECT, run) for run in RUNS]
 
     evo_diff_average = mne.grand_average(evo_diff_all)
     return evo_diff_average
 
-# Process specific subjects or all subjects
-if SPECIFIC_SUBJECTS:
-    print("Processing specific subjects:", SPECIFIC_SUBJECTS)  
-    for SUBJECT in SPECIFIC_SUBJECTS:
-        SUBJECT = SUBJECT.strip()  # Remove trailing spaces
-        print("Current SUBJECT:", SUBJECT) 
-        preprocessed_dir = BASE_PATH / f"{STUDY}/derivatives/preprocessed_data"
-        if (preprocessed_dir / SUBJECT).exists():
-            print(f"Skipping {SUBJECT} (already processed)")
-            continue
+def save_evo_diff(SUBJECT, evo_diff_average):
+    os.makedirs(PREPROCESSED_DIR / SUBJECT, exist_ok=True)
+    evo_diff_average.save(get_evo_diff_fname(SUBJECT), overwrite=True)
+    # fingerprinted once built, with the channels.tsv written along the way
+    buildcache.record(get_evo_diff_fname(SUBJECT), evo_diff_fingerprint(SUBJECT))
 
-        evo_diff_average = preprocessing(SUBJECT)
-        os.makedirs(BASE_PATH / f"{STUDY}/derivatives/preprocessed_data/{SUBJECT}", exist_ok=True)
-        evo_diff_average.save(BASE_PATH / f"{STUDY}/derivatives/preprocessed_data/{SUBJECT}/{SUBJECT}_evo_diff-ave.fif", overwrite=True)
-else:
-    print("Processing all subjects in the subjects directory.")  
-    for subject_folder in SUBJECTS_DIR.iterdir():
-        SUBJECT = subject_folder.name
-        if not SUBJECT.startswith("sub-"):
-            continue
+def save_grand_average(SUBJECT, evo_diff_all):
+    """Reduce the evo_diff of the runs (in run order) into the evo_diff of the subject"""
+    save_evo_diff(SUBJECT, mne.grand_average(evo_diff_all))
 
-        print("Current SUBJECT:", SUBJECT) 
-        preprocessed_dir = BASE_PATH / f"{STUDY}/derivatives/preprocessed_data"
-        if (preprocessed_dir / SUBJECT).exists():
-            print(f"Skipping {SUBJECT} (already processed)")
-            continue
+def evo_diff_up_to_date(SUBJECT):
+    try:
+        return buildcache.up_to_date(get_evo_diff_fname(SUBJECT), evo_diff_fingerprint(SUBJECT))
+    except FileNotFoundError:  # runs not converted yet
+        return False
 
-        evo_diff_average = preprocessing(SUBJECT)
-        os.makedirs(BASE_PATH / f"{STUDY}/derivatives/preprocessed_data/{SUBJECT}", exist_ok=True)
-        evo_diff_average.save(BASE_PATH / f"{STUDY}/derivatives/preprocessed_data/{SUBJECT}/{SUBJECT}_evo_diff-ave.fif", overwrite=True)
\ No newline at end of file
+def outputs_up_to_date(SUBJECT):
+    """Whether the evo_diff and (if kept) the epoch stores of the runs of a subject are up to date"""
+    return evo_diff_up_to_date(SUBJECT) and (
+        not EPOCH_STORE or all(epochs_up_to_date(SUBJECT, run) for run in RUNS))
+
+def preprocessing_parallel(subjects):
+    """
+    Farm out the (subject, run) units to a pool of N_WORKERS processes, each one
+    running with THREADS_PER_WORKER BLAS threads. The per-run evo_diff are reduced
+    into the per-subject grand average as soon as all the runs of a subject are done.
+    """
+    # Spawned workers inherit the environment, so BLAS is loaded with the per-worker budget
+    set_num_threads(THREADS_PER_WORKER)
+    evo_diffs = {SUBJECT: {} for SUBJECT in subjects}
+    failed = set()
+
+    with ProcessPoolExecutor(
+        max_workers=N_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=set_num_threads,
+        initargs=(THREADS_PER_WORKER,),
+    ) as executor:
+        if BADS_MIN_RUNS:
+            # The bad channels are pooled across runs: scan all the runs before Maxwell filtering any of them
+            futures = {
+                executor.submit(detect_run_bads, SUBJECT, run): (SUBJECT, run)
+                for SUBJECT in subjects
+                for run in RUNS
+            }
+            for future in as_completed(futures):
+                SUBJECT, run = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Failed to find the bad channels of {SUBJECT} run {run}: {e!r}")
+                    failed.add(SUBJECT)
+
+        futures = {
+            executor.submit(preprocess_run, SUBJECT, run): (SUBJECT, run)
+            for SUBJECT in subjects
+            for run in RUNS
+            if SUBJECT not in failed
+        }
+        for future in as_completed(futures):
+            SUBJECT, run = futures[future]
+            try:
+                evo_diffs[SUBJECT][run] = future.result()
+            except Exception as e:
+                print(f"Failed to preprocess {SUBJECT} run {run}: {e!r}")
+                failed.add(SUBJECT)
+                continue
+            if SUBJECT in failed or len(evo_diffs[SUBJECT]) < len(RUNS):
+                continue
+
+            # All the runs of the subject are done: reduce them in run order
+            save_grand_average(SUBJECT, [evo_diffs[SUBJECT][r] for r in RUNS])
+            del evo_diffs[SUBJECT]
+            print(f"{SUBJECT} done")
+
+    if failed:
+        print("Subjects with failed runs (not saved):", sorted(failed))
+
+if __name__ == "__main__":
+    # Process specific subjects or all subjects
+    if SPECIFIC_SUBJECTS:
+        print("Processing specific subjects:", SPECIFIC_SUBJECTS)
+        candidates = [SUBJECT.strip() for SUBJECT in SPECIFIC_SUBJECTS]  # Remove trailing spaces
+    else:
+        print("Processing all subjects in the subjects directory.")
+        candidates = [folder.name for folder in BIDS_DIR.iterdir() if folder.name.startswith("sub-")]
+
+    # A subject is only processed again if its evo_diff (or an epoch store) is missing or outdated
+    subjects = []
+    for SUBJECT in candidates:
+        if outputs_up_to_date(SUBJECT):
+            print(f"Skipping {SUBJECT} (up to date)")
+            continue
+        subjects.append(SUBJECT)
+
+    n_words = lexicon.prewarm(METADATA, "fr")
+    print(f"Word frequency cache ready ({n_words} words)")
+
+    if N_WORKERS > 1:
+        print(f"Running {N_WORKERS} workers with {THREADS_PER_WORKER} thread(s) each")
+        preprocessing_parallel(subjects)
+    else:
+        for SUBJECT in subjects:
+            print("Current SUBJECT:", SUBJECT)
+            evo_diff_average = preprocessing(SUBJECT)
+            save_evo_diff(SUBJECT, evo_diff_average)
@@ -1,57 +1,107 @@
 #!/usr/bin/env python
 
-import os, yaml, mne
+import os, sys, mne
 from pathlib import Path
 
-with open("config.yml", "r") as f:
-    config = yaml.safe_load(f)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils import buildcache, telemetry
+from utils.config import bids_dir, load_config, noise_cov_fname, preprocessed_dir
+from utils.covariance import compute_segments_covariance
+
+config = load_config()
 
 NUM_THREADS = str(config["num_threads"])
 os.environ["OMP_NUM_THREADS"] = NUM_THREADS
 os.environ["OPENBLAS_NUM_THREADS"] = NUM_THREADS
 os.environ["MKL_NUM_THREADS"] = NUM_THREADS
 
+STUDY = config["study"]
+TASK = config["task"]
+SESSION = config["session"]
+RUNS = config["runs"]
+N_WORKERS = config.get("n_workers", 1)
+
 BASE_PATH = Path(config["base_path"])
-SUBJECTS_DIR = BASE_PATH / config["subjects_dir"]
+BIDS_DIR = bids_dir(config)
+PREPROCESSED_DIR = preprocessed_dir(config)
 CROSS_TALK_FILE = BASE_PATH / config["cross_talk_file"]
 CALIBRATION_FILE = BASE_PATH / config["calibration_file"]
 
+# Time, CPU, memory and I/O of the covariance of each subject (see utils/telemetry.py)
+TELEMETRY = config.get("telemetry", f"{STUDY}/derivatives/telemetry.jsonl")
+telemetry.configure(TELEMETRY and BASE_PATH / TELEMETRY)
+
 SPECIFIC_SUBJECTS = config.get("subjects", []) 
 if isinstance(SPECIFIC_SUBJECTS, str):  
     SPECIFIC_SUBJECTS = [SPECIFIC_SUBJECTS]
 
-def get_noise_cov(SUBJECT):
-    raw_for_cov = []
+CODE_VERSION = buildcache.code_version(__file__, Path(__file__).resolve().parents[1] / "utils" / "covariance.py")
 
-    for i in range(1, 10):
+def get_sss_fname(SUBJECT, run):
+    return PREPROCESSED_DIR / f"{SUBJECT}/{SUBJECT}_{SESSION}task-{TASK}_run-0{run}_meg_raw_sss.fif"
 
-        raw_fname = BASE_PATH / f"{STUDY}/derivatives/preprocessed_data/{SUBJECT}/{SUBJECT}_{SESSION}task-{TASK}_run-0{i}_meg_raw_sss.fif"
-        raw = mne.io.read_raw_fif(raw_fname, allow_maxshield=True)
+def get_segments(SUBJECT):
+    """(file, tmin, tmax) of each run, cropped between its first two STI101 events"""
+    segments = []
+
+    for run in RUNS:
+
+        raw = mne.io.read_raw_fif(get_sss_fname(SUBJECT, run), allow_maxshield=True)
 
         events = mne.find_events(raw, stim_channel='STI101')
 
         tmin = events[0][0] / raw.info['sfreq']
         tmax=events[1][0]/raw.info['sfreq']
-        raw.crop(tmin=tmin, tmax=tmax)
 
-        raw_for_cov.append(raw)
+        segments.append((get_sss_fname(SUBJECT, run), tmin, tmax))
 
-    concatenated_raws = mne.concatenate_raws(raw_for_cov)
-    noise_cov = mne.compute_raw_covariance(concatenated_raws,method=['shrunk', 'empirical'], rank='info')
+    return segments
+
+def get_noise_cov(SUBJECT):
+    # Same as compute_raw_covariance on the concatenated segments, which are read block
+    # by block instead of being loaded (one run per worker)
+    segments = get_segments(SUBJECT)
+    with telemetry.stage("covariance", SUBJECT, n_runs=len(segments), n_workers=N_WORKERS):
+        noise_cov = compute_segments_covariance(
+            segments, method=['shrunk', 'empirical'], rank='info', n_workers=N_WORKERS)
 
     return noise_cov
 
     #info = evoked.info #load evoked before
     #noise_cov.plot(info, proj=True)
 
-for subject_folder in subjects_dir.iterdir():
-    subject = subject_folder.name
-    if not subject.startswith('sub-'):
-        continue
-    if subject in ['sub-17', 'sub-21', 'sub-23', 'sub-26']:
-        continue
+def get_cov_fname(subject):
+    return noise_cov_fname(config, subject)
+
+def cov_fingerprint(subject):
+    """The noise covariance is only recomputed if the Maxwell filtered runs (or this script) changed"""
+    return buildcache.fingerprint(
+        [get_sss_fname(subject, run) for run in RUNS], params=dict(runs=RUNS), code=CODE_VERSION)
+
+def cov_up_to_date(subject):
+    try:
+        return buildcache.up_to_date(get_cov_fname(subject), cov_fingerprint(subject))
+    except FileNotFoundError:  # runs not Maxwell filtered yet
+        return False
+
+def save_noise_cov(subject):
+    if cov_up_to_date(subject):
+        print(f"Skipping {subject} (up to date)")
+        return
 
     noise_cov = get_noise_cov(subject)
 
-    os.makedirs(BASE_PATH / f'LPP_MEG_auditory/derivatives/preprocessed_data/{subject}', exist_ok=True)
-    noise_cov.save(BASE_PATH / f'LPP_MEG_auditory/derivatives/preprocessed_data/{subject}/{subject}_noise-cov.fif', overwrite=True)
+    cov_fname = get_cov_fname(subject)
+    os.makedirs(cov_fname.parent, exist_ok=True)
+    noise_cov.save(cov_fname, overwrite=True)
+    buildcache.record(cov_fname, cov_fingerprint(subject))
+
+if __name__ == "__main__":
+    for subject_folder in BIDS_DIR.iterdir():
+        subject = subject_folder.name
+        if not subject.startswith('sub-'):
+            continue
+        if subject in ['sub-17', 'sub-21', 'sub-23', 'sub-26']:
+            continue
+
+        save_noise_cov(subject)
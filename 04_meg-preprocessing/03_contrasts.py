@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+import os, sys, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils import buildcache, contrasts, epochstore, telemetry
+from utils.config import bids_dir, epochs_fname, load_config, preprocessed_dir
+from utils.parallel import set_num_threads
+
+config = load_config()
+
+NUM_THREADS = str(config["num_threads"])
+os.environ["OMP_NUM_THREADS"] = NUM_THREADS
+os.environ["OPENBLAS_NUM_THREADS"] = NUM_THREADS
+os.environ["MKL_NUM_THREADS"] = NUM_THREADS
+
+STUDY = config["study"]
+TASK = config["task"]
+SESSION = config["session"]
+RUNS = config["runs"]
+N_WORKERS = config.get("n_workers", 1)
+THREADS_PER_WORKER = config.get("threads_per_worker", config["num_threads"])
+
+BASE_PATH = Path(config["base_path"])
+BIDS_DIR = bids_dir(config)
+PREPROCESSED_DIR = preprocessed_dir(config)
+
+# Contrasts (name: {metadata query: weight}) evaluated on the epoch stores of 01_preprocessing.py
+CONTRASTS = contrasts.check_contrasts(config.get("contrasts", {}))
+CONTRAST_METHOD = config.get("contrast_method", "median")
+# Data read at once from a store (None: the default block size of utils/epochstore.py)
+MAX_MEMORY_MB = config.get("max_memory_mb", None)
+
+# Time, CPU, memory and I/O of the contrasts of each subject (see utils/telemetry.py)
+TELEMETRY = config.get("telemetry", f"{STUDY}/derivatives/telemetry.jsonl")
+telemetry.configure(TELEMETRY and BASE_PATH / TELEMETRY)
+
+SPECIFIC_SUBJECTS = config.get("subjects", None)
+if isinstance(SPECIFIC_SUBJECTS, str):
+    SPECIFIC_SUBJECTS = [SPECIFIC_SUBJECTS]
+
+UTILS_DIR = Path(__file__).resolve().parents[1] / "utils"
+CODE_VERSION = buildcache.code_version(__file__, UTILS_DIR / "contrasts.py", UTILS_DIR / "epochstore.py")
+
+def get_epochs_fname(subject, run):
+    """Written by 01_preprocessing.py"""
+    return epochs_fname(config, subject, run)
+
+def get_contrast_fname(subject, name):
+    return PREPROCESSED_DIR / f"{subject}/{subject}_contrast-{name}-ave.fif"
+
+def contrast_fingerprint(subject, name):
+    """A contrast is only recomputed if the epoch stores, its queries and weights, or this code changed"""
+    return buildcache.fingerprint(
+        [fname for run in RUNS for fname in epochstore.files(get_epochs_fname(subject, run))],
+        params=dict(weights=CONTRASTS[name], method=CONTRAST_METHOD, runs=RUNS),
+        code=CODE_VERSION,
+    )
+
+def pending_contrasts(subject):
+    """Names of the contrasts of the subject which are missing or outdated"""
+    try:
+        return [name for name in CONTRASTS
+                if not buildcache.up_to_date(get_contrast_fname(subject, name), contrast_fingerprint(subject, name))]
+    except FileNotFoundError:  # runs not preprocessed yet
+        return list(CONTRASTS)
+
+def contrasts_up_to_date(subject):
+    return not pending_contrasts(subject)
+
+def save_contrasts(subject):
+    """Compute the pending contrasts of a subject from its epoch stores, without reading the raw files"""
+    names = pending_contrasts(subject)
+    if not names:
+        print(f"Skipping {subject} (up to date)")
+        return
+
+    store_fnames = [get_epochs_fname(subject, run) for run in RUNS]
+    with telemetry.stage("contrasts", subject, n_contrasts=len(names), method=CONTRAST_METHOD):
+        evokeds = contrasts.subject_contrasts(
+            store_fnames, {name: CONTRASTS[name] for name in names}, CONTRAST_METHOD, MAX_MEMORY_MB)
+
+    for name, evoked in evokeds.items():
+        fname = get_contrast_fname(subject, name)
+        os.makedirs(fname.parent, exist_ok=True)
+        evoked.save(fname, overwrite=True)
+        buildcache.record(fname, contrast_fingerprint(subject, name))
+    print(f"{subject}: {', '.join(names)}")
+
+def contrasts_parallel(subjects):
+    """One subject per worker, each one running with THREADS_PER_WORKER BLAS threads"""
+    set_num_threads(THREADS_PER_WORKER)
+    failed = []
+    with ProcessPoolExecutor(
+        max_workers=N_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=set_num_threads,
+        initargs=(THREADS_PER_WORKER,),
+    ) as executor:
+        futures = {executor.submit(save_contrasts, subject): subject for subject in subjects}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to compute the contrasts of {futures[future]}: {e!r}")
+                failed.append(futures[future])
+    if failed:
+        print("Subjects with failed contrasts:", sorted(failed))
+
+if __name__ == "__main__":
+    if SPECIFIC_SUBJECTS:
+        subjects = [subject.strip() for subject in SPECIFIC_SUBJECTS]
+    else:
+        subjects = sorted(folder.name for folder in BIDS_DIR.iterdir() if folder.name.startswith("sub-"))
+
+    if N_WORKERS > 1:
+        print(f"Running {N_WORKERS} workers with {THREADS_PER_WORKER} thread(s) each")
+        contrasts_parallel(subjects)
+    else:
+        for subject in subjects:
+            save_contrasts(subject)
@@ -0,0 +1,193 @@
+#! /usr/bin/env python
+
+import os, sys, time, shutil, subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils.config import freesurfer_dir, load_config
+from utils.parallel import available_cpus, available_memory_gb
+
+config = load_config()
+
+BASE_PATH = Path(config["base_path"])
+# FreeSurfer subjects folder
+FREESURFER_DIR = freesurfer_dir(config)
+# T1 of each subject, in the BIDS dataset
+ANAT_DIR = BASE_PATH / config.get("anat_dir", config["subjects_dir"])
+T1_PATTERN = config.get("t1_pattern", "{subject}/ses-01/anat/{subject}_ses-01_T1w.nii.gz")
+PARTICIPANTS_FILE = Path(__file__).resolve().parents[1] / config.get(
+    "participants_file", "01_finding-data/participants_to_import.tsv")
+
+# Budgets of all the recon-all jobs running at the same time (default: the whole machine)
+RECON_ALL_CORES = config.get("recon_all_cores", None) or available_cpus()
+RECON_ALL_MEMORY_GB = config.get("recon_all_memory_gb", None) or available_memory_gb()
+# Cores (-openmp) and memory of each job
+RECON_ALL_THREADS = config.get("recon_all_threads", 1)
+RECON_ALL_MEMORY_PER_JOB_GB = config.get("recon_all_memory_per_job_gb", 4)
+# Number of times a failed subject is resumed
+RECON_ALL_RETRIES = config.get("recon_all_retries", 1)
+
+# Optional: List of specific subjects to process
+SPECIFIC_SUBJECTS = config.get("subjects", None)
+if isinstance(SPECIFIC_SUBJECTS, str):
+    SPECIFIC_SUBJECTS = [SPECIFIC_SUBJECTS]
+
+TIMINGS_FILE = FREESURFER_DIR / "recon_all_timings.tsv"
+LOG_DIR = FREESURFER_DIR / "recon_all_logs"
+
+def list_subjects():
+    """Participants of participants_to_import.tsv (but those whose to_import is no)"""
+    participants = pd.read_csv(PARTICIPANTS_FILE, sep="\t", dtype=str, keep_default_na=False)
+    to_import = participants.get("to_import", pd.Series("", index=participants.index)).str.strip().str.lower()
+    subjects = participants.loc[~to_import.isin(["0", "no", "false", "n"]), "participant_id"].str.strip().tolist()
+    if SPECIFIC_SUBJECTS:
+        subjects = [subject for subject in subjects if subject in SPECIFIC_SUBJECTS]
+    return subjects
+
+def n_slots():
+    """Number of recon-all jobs which fit in the core and memory budgets"""
+    slots = RECON_ALL_CORES // RECON_ALL_THREADS
+    if RECON_ALL_MEMORY_GB is not None:
+        slots = min(slots, int(RECON_ALL_MEMORY_GB // RECON_ALL_MEMORY_PER_JOB_GB))
+    return max(1, slots)
+
+## ----- FreeSurfer status files ----- ##
+
+def is_done(subject):
+    """recon-all writes scripts/recon-all.done (with its END_TIME) when it finished
+
+    A later run which crashed leaves its IsRunning files, or failed writes recon-all.error.
+    """
+    scripts_dir = FREESURFER_DIR / subject / "scripts"
+    done_file, error_file = scripts_dir / "recon-all.done", scripts_dir / "recon-all.error"
+    if not done_file.exists() or "END_TIME" not in done_file.read_text():
+        return False
+    if any(scripts_dir.glob("IsRunning.*")):
+        return False
+    return not error_file.exists() or error_file.stat().st_mtime < done_file.stat().st_mtime
+
+def is_imported(subject):
+    """The T1 was converted (recon-all -i), so that the subject can be resumed"""
+    return any((FREESURFER_DIR / subject / "mri" / "orig").glob("0*.mgz"))
+
+def is_failed_import(subject):
+    """The folder of the subject only holds what a failed recon-all -i leaves: empty folders and the logs of scripts/"""
+    subject_dir = FREESURFER_DIR / subject
+    return all(path.is_dir() or path.parent == subject_dir / "scripts" for path in subject_dir.rglob("*"))
+
+def last_step(subject):
+    """Last step started by recon-all, from scripts/recon-all-status.log"""
+    status_file = FREESURFER_DIR / subject / "scripts" / "recon-all-status.log"
+    if not status_file.exists():
+        return None
+    steps = [line[len("#@# "):].strip() for line in status_file.read_text().splitlines() if line.startswith("#@# ")]
+    return steps[-1] if steps else None
+
+def recon_all_command(subject):
+    """Command resuming the subject if it was imported, starting it from its T1 otherwise
+
+    A subject is resumed with -make all, which only runs the steps whose
+    outputs are missing or older than their inputs (-all would start again
+    from the motion correction).
+    """
+    subject_dir = FREESURFER_DIR / subject
+    if is_imported(subject):
+        # Left by a recon-all which was killed: it would refuse to run otherwise
+        for running_file in (subject_dir / "scripts").glob("IsRunning.*"):
+            running_file.unlink()
+        cmd = ["recon-all", "-s", subject, "-make", "all"]
+    else:
+        if subject_dir.exists():
+            # recon-all -i needs a new subject: only a failed import is removed, never outputs
+            if not is_failed_import(subject):
+                raise RuntimeError(f"{subject_dir} has no mri/orig/0*.mgz but holds outputs: "
+                                   "import its T1 again by hand, or remove the folder")
+            shutil.rmtree(subject_dir)
+        cmd = ["recon-all", "-s", subject, "-i", str(ANAT_DIR / T1_PATTERN.format(subject=subject)), "-all"]
+    if RECON_ALL_THREADS > 1:
+        cmd += ["-parallel", "-openmp", str(RECON_ALL_THREADS)]
+    return cmd
+
+## ---------------------------------- ##
+
+def run_recon_all(subject):
+    """Run (or resume) recon-all on a subject, its output being written to its log"""
+    resumed_from = last_step(subject) if is_imported(subject) else None
+    cmd = recon_all_command(subject)
+    env = dict(os.environ, SUBJECTS_DIR=str(FREESURFER_DIR))
+    start = time.perf_counter()
+    with open(LOG_DIR / f"{subject}.log", "a") as log:
+        log.write(f"# {datetime.now().isoformat(timespec='seconds')} {' '.join(cmd)}\n")
+        log.flush()
+        returncode = subprocess.run(cmd, env=env, stdout=log, stderr=subprocess.STDOUT).returncode
+    return dict(
+        subject=subject, status="done" if returncode == 0 and is_done(subject) else "failed", returncode=returncode,
+        resumed_from=resumed_from or "", wall_time_s=round(time.perf_counter() - start, 1), threads=RECON_ALL_THREADS,
+        date=datetime.now().isoformat(timespec="seconds"),
+    )
+
+def log_timing(row):
+    """Append the wall time of a recon-all job to the timing log"""
+    pd.DataFrame([row]).to_csv(TIMINGS_FILE, sep="\t", index=False, mode="a", header=not TIMINGS_FILE.exists())
+
+def recon_all_subject(subject):
+    """recon-all of a subject (one task of pipeline.py), failing if it did not finish"""
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
+    row = run_recon_all(subject)
+    log_timing(row)
+    if row["status"] != "done":
+        raise RuntimeError(f"recon-all failed for {subject} (see {LOG_DIR / f'{subject}.log'})")
+
+def run_all(subjects, slots):
+    """recon-all of the subjects, at most slots at a time, the failed ones being resumed up to RECON_ALL_RETRIES times
+
+    Returns the subjects which still failed.
+    """
+    failed = []
+    for attempt in range(1 + RECON_ALL_RETRIES):
+        if attempt:
+            print(f"Resuming {len(subjects)} subject(s) ({attempt}/{RECON_ALL_RETRIES}): {subjects}")
+        failed = []
+        # recon-all runs in its own process: threads are enough to wait for the jobs
+        with ThreadPoolExecutor(max_workers=min(slots, len(subjects))) as executor:
+            futures = {executor.submit(run_recon_all, subject): subject for subject in subjects}
+            for future in as_completed(futures):
+                subject = futures[future]
+                try:
+                    row = future.result()
+                except Exception as e:  # e.g. recon-all not found
+                    row = dict(subject=subject, status="failed", returncode="", resumed_from="", wall_time_s="",
+                               threads=RECON_ALL_THREADS, date=datetime.now().isoformat(timespec="seconds"))
+                    print(f"recon-all failed to start for {subject}: {e!r}")
+                else:
+                    print(f"recon-all {row['status']} for {subject} ({row['wall_time_s']} s)")
+                log_timing(row)
+                if row["status"] != "done":
+                    failed.append(subject)
+        subjects = sorted(failed)
+        if not subjects:
+            break
+    return failed
+
+if __name__ == "__main__":
+    FREESURFER_DIR.mkdir(parents=True, exist_ok=True)
+    LOG_DIR.mkdir(exist_ok=True)
+
+    subjects = []
+    for subject in list_subjects():
+        if is_done(subject):
+            print(f"recon-all already done for {subject}. Skipping.")
+            continue
+        if is_imported(subject):
+            print(f"Resuming {subject} (last step started: {last_step(subject)})")
+        subjects.append(subject)
+
+    slots = n_slots()
+    print(f"{len(subjects)} subject(s) to process, {slots} at a time with {RECON_ALL_THREADS} core(s) each")
+    failed = run_all(subjects, slots) if subjects else []
+    if failed:
+        print("Failed subjects:", sorted(failed))
+        sys.exit(1)
@@ -1,23 +0,0 @@
-#! /bin/bash
-
-GROUP1="2 3 4 5 6"
-GROUP2="7 8 11 12 14"
-GROUP3="15 16 17 18 19"
-GROUP4="20 21 22 24 27"
-GROUP5="28 29 30 31 32"
-GROUP6="33 34 35 36 37"
-GROUP7="38 39 40 41 42"
-GROUP8="43 44 45 46 47"
-GROUP9="48 49 50 51 52"
-GROUP10="53 54 55 56 57 58"
-
-./run_freesurfer_on_subjectid.sh $GROUP1
-./run_freesurfer_on_subjectid.sh $GROUP2
-./run_freesurfer_on_subjectid.sh $GROUP3
-./run_freesurfer_on_subjectid.sh $GROUP4
-./run_freesurfer_on_subjectid.sh $GROUP5
-./run_freesurfer_on_subjectid.sh $GROUP6
-./run_freesurfer_on_subjectid.sh $GROUP7
-./run_freesurfer_on_subjectid.sh $GROUP8
-./run_freesurfer_on_subjectid.sh $GROUP9
-./run_freesurfer_on_subjectid.sh $GROUP10
\ No newline at end of file
@@ -1,34 +1,146 @@
 #! /usr/bin/env python
 
-import os, mne
+import os, sys, json, time, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
 
-# Subjects folder
-subjects_dir = "/neurospin/unicog/protocols/IRMf/LePetitPrince_Pallier_2018/MEG/workspace-LPP/data/MEG/LPP/freesurfer"
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils import buildcache
+from utils.config import freesurfer_dir, load_config
+from utils.parallel import set_num_threads
+
+config = load_config()
+
+NUM_THREADS = config["num_threads"]
+
+# FreeSurfer subjects folder
+FREESURFER_DIR = freesurfer_dir(config)
+
+# Number of subjects processed at the same time, and number of times a failed subject is tried again
+BEM_WORKERS = config.get("bem_workers", config.get("n_workers", 1))
+BEM_RETRIES = config.get("bem_retries", 1)
+
+# Optional: List of specific subjects to process
+SPECIFIC_SUBJECTS = config.get("subjects", None)
+if isinstance(SPECIFIC_SUBJECTS, str):
+    SPECIFIC_SUBJECTS = [SPECIFIC_SUBJECTS]
+
+CODE_VERSION = buildcache.code_version(__file__)
+
+def get_marker_fname(subject_id):
+    return FREESURFER_DIR / subject_id / "bem" / f"{subject_id}-bem-done.json"
+
+def bem_surfaces(subject_id):
+    """Surfaces written by make_watershed_bem and make_scalp_surfaces"""
+    bem_dir = FREESURFER_DIR / subject_id / "bem"
+    surfaces = [bem_dir / f"{surf}.surf" for surf in ["brain", "inner_skull", "outer_skull", "outer_skin"]]
+    return surfaces + [bem_dir / f"{subject_id}-head{level}.fif" for level in ["", "-dense", "-medium", "-sparse"]]
+
+def bem_fingerprint(subject_id):
+    """The T1 the surfaces are segmented from, and the code"""
+    return buildcache.fingerprint([FREESURFER_DIR / subject_id / "mri" / "T1.mgz"], code=CODE_VERSION)
+
+def bem_done(subject_id):
+    """Whether the marker of the subject matches its T1 and its surfaces are unchanged
+
+    A crashed run leaves no marker, so the subject is processed again.
+    """
+    marker = get_marker_fname(subject_id)
+    if not marker.exists():
+        return False
+    try:
+        done = json.loads(marker.read_text())
+    except ValueError:
+        return False
+    try:
+        fingerprint = bem_fingerprint(subject_id)
+    except FileNotFoundError:  # no T1: left to run_bem to report
+        return False
+    if not buildcache.same_fingerprint(done.get("fingerprint", {}), fingerprint):
+        return False
+    surfaces = done.get("surfaces", {})
+    for fname in bem_surfaces(subject_id):
+        if str(fname) not in surfaces or not buildcache.unchanged(fname, surfaces[str(fname)]):
+            return False
+    return True
 
 # BEM function
-def run_bem(subjects_dir, subject_id):
-    bem_dir = os.path.join(subjects_dir, subject_id, "bem")
-    if not os.path.exists(bem_dir):
-        mne.bem.make_watershed_bem(
-            subject=subject_id,
-            subjects_dir=subjects_dir,
-            copy=True,
-            overwrite=True,
-            show=False
-        )
-
-        mne.bem.make_scalp_surfaces(
-            subject=subject_id,
-            subjects_dir=subjects_dir,
-            force=True,
-            overwrite=True
-        )
-        print(f"BEM done for subject {subject_id}")
-    else:
-        print(f"BEM folder already exists for subject {subject_id}. Skipping BEM processing.")
+def run_bem(subject_id):
+    import mne
+
+    start = time.perf_counter()
+    fingerprint = bem_fingerprint(subject_id)
+    marker = get_marker_fname(subject_id)
+    # Removed first, so that a crash below leaves the subject to do
+    marker.unlink(missing_ok=True)
+
+    mne.bem.make_watershed_bem(
+        subject=subject_id,
+        subjects_dir=FREESURFER_DIR,
+        copy=True,
+        overwrite=True,
+        show=False
+    )
+
+    mne.bem.make_scalp_surfaces(
+        subject=subject_id,
+        subjects_dir=FREESURFER_DIR,
+        force=True,
+        overwrite=True
+    )
+
+    # Checksums of the surfaces, to detect a surface modified or removed afterwards
+    surfaces = {str(fname): buildcache.file_stamp(fname) for fname in bem_surfaces(subject_id)}
+    tmp = marker.with_name(f"{marker.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(dict(fingerprint=fingerprint, surfaces=surfaces), indent=2, sort_keys=True))
+    os.replace(tmp, marker)
+    return time.perf_counter() - start
+
+def run_all(subjects):
+    """BEM of the subjects, BEM_WORKERS at a time, the failed subjects being tried again up to BEM_RETRIES times
+
+    Returns the error of the subjects which still failed.
+    """
+    failed = {}
+    for attempt in range(1 + BEM_RETRIES):
+        if attempt:
+            print(f"Retrying {len(subjects)} subject(s) ({attempt}/{BEM_RETRIES}): {subjects}")
+        failed = {}
+        # Each subject runs in its own process, and a new pool is started for each attempt,
+        # so that a crash of FreeSurfer (or of a worker) only fails the subjects it was running
+        with ProcessPoolExecutor(
+            max_workers=min(BEM_WORKERS, len(subjects)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=set_num_threads,
+            initargs=(NUM_THREADS,),
+        ) as executor:
+            futures = {executor.submit(run_bem, subject_id): subject_id for subject_id in subjects}
+            for future in as_completed(futures):
+                subject_id = futures[future]
+                try:
+                    print(f"BEM done for subject {subject_id} ({future.result():.0f} s)")
+                except Exception as e:
+                    print(f"BEM failed for subject {subject_id}: {e!r}")
+                    failed[subject_id] = repr(e)
+        subjects = sorted(failed)
+        if not subjects:
+            break
+    return failed
 
 if __name__ == "__main__":
-    # Iterate over subjects in the directory
-    for subject_id in os.listdir(subjects_dir):
-        if subject_id.startswith("sub-"):
-            run_bem(subjects_dir, subject_id)
+    if SPECIFIC_SUBJECTS:
+        candidates = [subject_id.strip() for subject_id in SPECIFIC_SUBJECTS]
+    else:
+        candidates = sorted(folder.name for folder in FREESURFER_DIR.iterdir() if folder.name.startswith("sub-"))
+
+    subjects = []
+    for subject_id in candidates:
+        if bem_done(subject_id):
+            print(f"BEM already done for subject {subject_id}. Skipping BEM processing.")
+            continue
+        subjects.append(subject_id)
+
+    failed = run_all(subjects) if subjects else {}
+    if failed:
+        print("Failed subjects:", sorted(failed))
+        sys.exit(1)
@@ -2,33 +2,55 @@
 # coding: UTF-8
 
 from pathlib import Path
-import mne, argparse
+import sys, fcntl, argparse, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import mne
 from mne.coreg import Coregistration
 from mne.io import read_info
 import numpy as np
+import pandas as pd
 
-def automated_coreg(subject, subjects_dir, meg_dir):
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils.config import bids_dir, freesurfer_dir, load_config, preprocessed_dir, trans_fname
+from utils.parallel import available_cpus, set_num_threads
+
+config = load_config()
+
+TASK = config["task"]
+SESSION = config["session"]
+MEG_DIR = config["meg_dir"]
+MIDDLE_RUN = config["middle_run"]
+
+# Middle runs in the BIDS dataset, FreeSurfer subjects, and transforms with the other derivatives of the subjects
+BIDS_DIR = bids_dir(config)
+FREESURFER_DIR = freesurfer_dir(config)
+PREPROCESSED_DIR = preprocessed_dir(config)
+
+# Batch mode: (nasion, lpa, rpa) weights of the final ICP, tried in turn until a fit is accepted
+ICP_WEIGHTS = [(5.0, 1.0, 1.0), (10.0, 5.0, 5.0)]
+OMIT_DISTANCE = 5.0 / 1000  # head shape points further from the head surface after the first ICP are omitted
+# A fit is accepted if the distances (mm) between the head shape points and the MRI head are within these
+MAX_MEAN_DISTANCE = 3.0
+MAX_DISTANCE = 10.0
+
+def automated_coreg(subject, task=TASK):
     """
     Coregister MEG runs for a given subject and session.
     
     Parameters:
     - subject: str, subject identifier (e.g., 'sub-11')
-    - subjects_dir: str or Path, path to the directory where the Freesurfer subjects are stored
-    - meg_dir: str or Path, path to the directory where the MEG .fif files are stored
     - task: str, task identifier (e.g., 'read', 'listen' or 'distraction')
     """
 
-    task = input("Task: ")
-    meg_dir = Path(meg_dir)
-    subjects_dir = Path(subjects_dir)
-    output_dir = Path("/neurospin/unicog/protocols/IRMf/LePetitPrince_Pallier_2018/MEG/workspace-LPP/data/MEG/LPP/LPP_MEG_distraction/derivatives/preprocessed_data/")
+    subjects_dir = FREESURFER_DIR
+    paths = get_paths(subject, task)
 
     # Ensure the output directory exists
-    if not output_dir.exists():
-        print(f"Creating output directory at {output_dir}")
-        output_dir.mkdir(parents=True, exist_ok=True)
+    if not paths["trans"].parent.exists():
+        print(f"Creating output directory at {paths['trans'].parent}")
+        paths["trans"].parent.mkdir(parents=True, exist_ok=True)
 
-    middle_run_path = meg_dir / f'{subject}_task-{task}_run-14_meg.fif' # TO CHANGE WITH YOUR RUN NUMBER
+    middle_run_path = paths["meg"]
 
     # Extract run number from the file name
     run_number = middle_run_path.stem.split('_')[-2]
@@ -108,7 +130,7 @@ def automated_coreg(subject, subjects_dir, meg_dir):
     )
 
     # Save the transformation
-    trans_fname = output_dir / f'{subject}/{subject}_task-{task}_{run_number}_meg_trans.fif'
+    trans_fname = paths["trans"]
     mne.write_trans(str(trans_fname), coreg.trans, overwrite = True)
 
     print(CGREEN + "Coregistration saved for", subject, run_number,"!" + CEND)
@@ -127,19 +149,171 @@ def automated_coreg(subject, subjects_dir, meg_dir):
     print(CGREEN + "Coregistration completed for", subject, "on the middle run." + CEND)
 
 
+## ----- Batch mode ----- ##
+
+def get_paths(subject, task=TASK):
+    """Middle run of the subject, its transform (read by the source reconstruction) and the candidate transform left for review"""
+    trans = trans_fname(config, subject, task)
+    return dict(
+        meg=BIDS_DIR / subject / MEG_DIR / f"{subject}_{SESSION}task-{task}_{MIDDLE_RUN}_meg.fif",
+        trans=trans,
+        candidate=trans.with_name(trans.name.replace("_trans.fif", "_candidate-trans.fif")),
+    )
+
+def get_review_fname(task):
+    return PREPROCESSED_DIR / f"coreg_review_task-{task}.tsv"
+
+def fit_subject(subject, task):
+    """Same fits as automated_coreg, without the plots and questions
+
+    The weights of ICP_WEIGHTS are tried in turn, and the first fit whose
+    distances are within the thresholds is saved. If none is, the closest
+    one is saved as a candidate, to be reviewed in the GUI.
+    """
+    paths = get_paths(subject, task)
+    info = read_info(str(paths["meg"]), verbose=False)
+
+    # the head surfaces are read once, the fit being reset for each weights
+    coreg = Coregistration(info, subject, str(FREESURFER_DIR), fiducials="auto")
+    coreg.set_fid_match("matched")
+    best = None
+    for nasion_weight, lpa_weight, rpa_weight in ICP_WEIGHTS:
+        coreg.reset()
+        coreg.fit_fiducials(verbose=False)
+        coreg.fit_icp(n_iterations=6, verbose=False)
+        coreg.omit_head_shape_points(distance=OMIT_DISTANCE)
+        coreg.fit_icp(n_iterations=20, nasion_weight=nasion_weight, lpa_weight=lpa_weight, rpa_weight=rpa_weight,
+                      verbose=False)
+        dists = coreg.compute_dig_mri_distances() * 1e3  # in mm
+        fit = dict(subject=subject, mean_mm=round(float(np.mean(dists)), 2), max_mm=round(float(np.max(dists)), 2),
+                   weights=f"{nasion_weight:g}/{lpa_weight:g}/{rpa_weight:g}")
+        if best is None or fit["mean_mm"] < best[0]["mean_mm"]:
+            best = fit, coreg.trans
+        if fit["mean_mm"] <= MAX_MEAN_DISTANCE and fit["max_mm"] <= MAX_DISTANCE:
+            break
+
+    fit, trans = best
+    accepted = fit["mean_mm"] <= MAX_MEAN_DISTANCE and fit["max_mm"] <= MAX_DISTANCE
+    fname = paths["trans"] if accepted else paths["candidate"]
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    mne.write_trans(str(fname), trans, overwrite=True, verbose=False)
+    if accepted:
+        paths["candidate"].unlink(missing_ok=True)
+    return dict(fit, status="accepted" if accepted else "review", trans=str(fname))
+
+def update_review_queue(task, results):
+    """Subjects left to review in the GUI: the fits rejected by this run are added, the accepted ones removed"""
+    review_fname = get_review_fname(task)
+    review_fname.parent.mkdir(parents=True, exist_ok=True)
+    # the subjects may be fitted by several processes (see pipeline.py)
+    with open(review_fname.with_name(f"{review_fname.name}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        queue = pd.read_csv(review_fname, sep="\t", dtype=str) if review_fname.exists() else pd.DataFrame(columns=["subject"])
+        queue = queue[~queue["subject"].isin([result["subject"] for result in results])]
+        rejected = pd.DataFrame([result for result in results if result["status"] != "accepted"])
+        queue = pd.concat([queue, rejected], ignore_index=True).sort_values("subject")
+        queue.to_csv(review_fname, sep="\t", index=False)
+    return queue
+
+def coreg_subject(subject, task=TASK):
+    """Fit a subject (one task of pipeline.py), failing if the fit is queued for review"""
+    if get_paths(subject, task)["trans"].exists():
+        print(f"Transform already exists for {subject}. Skipping.")
+        return
+    result = fit_subject(subject, task)
+    update_review_queue(task, [result])
+    if result["status"] != "accepted":
+        raise RuntimeError(f"Coregistration of {subject} queued for review ({result['mean_mm']:.2f} mm mean / "
+                           f"{result['max_mm']:.2f} mm max)")
+
+def run_batch(subjects, task, n_workers, overwrite=False):
+    """Fit the subjects in parallel, one process per subject. Returns the review queue
+
+    The subjects which already have a transform (e.g. corrected by hand) are
+    skipped, unless overwrite.
+    """
+    todo = []
+    for subject in subjects:
+        paths = get_paths(subject, task)
+        if paths["trans"].exists() and not overwrite:
+            print(f"Transform already exists for {subject}. Skipping.")
+        elif not paths["meg"].exists():
+            print(f"No {paths['meg'].name} for {subject}. Skipping.")
+        else:
+            todo.append(subject)
+
+    results = []
+    if todo:
+        n_workers = min(n_workers, len(todo))
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=set_num_threads,
+            initargs=(max(1, available_cpus() // n_workers),),
+        ) as executor:
+            futures = {executor.submit(fit_subject, subject, task): subject for subject in todo}
+            for future in as_completed(futures):
+                subject = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = dict(subject=subject, status="failed", error=repr(e))
+                    print(f"Coregistration failed for {subject}: {e!r}")
+                else:
+                    print(f"Coregistration {result['status']} for {subject}: {result['mean_mm']:.2f} mm mean / "
+                          f"{result['max_mm']:.2f} mm max (weights {result['weights']})")
+                results.append(result)
+    return update_review_queue(task, results)
+
+def review(task):
+    """Open the coregistration GUI on each subject of the review queue, one after the other
+
+    The transform has to be saved as the _trans.fif of the subject: the
+    subject is then removed from the queue.
+    """
+    review_fname = get_review_fname(task)
+    if not review_fname.exists():
+        print(f"Nothing to review: no {review_fname}")
+        return
+    queue = pd.read_csv(review_fname, sep="\t", dtype=str, keep_default_na=False)
+    for _, row in queue.iterrows():
+        paths = get_paths(row["subject"], task)
+        if paths["trans"].exists():
+            continue
+        print(f"Reviewing {row['subject']} ({row.get('status')}, {row.get('mean_mm')} mm mean / {row.get('max_mm')} mm max). "
+              f"Save the transform as {paths['trans']}")
+        mne.gui.coregistration(
+            inst=str(paths["meg"]), subject=row["subject"], subjects_dir=str(FREESURFER_DIR), head_high_res=True,
+            trans=str(paths["candidate"]) if paths["candidate"].exists() else None, interaction="terrain", block=True,
+        )
+    queue = queue[[not get_paths(subject, task)["trans"].exists() for subject in queue["subject"]]]
+    queue.to_csv(review_fname, sep="\t", index=False)
+    print(f"{len(queue)} subject(s) left to review")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Coregister MEG run for a given subject and session.")
-    parser.add_argument('--subject', required=True, help='Subject identifier (e.g., sub-11)')
+    parser.add_argument('--subject', help='Subject identifier (e.g., sub-11), coregistered interactively')
+    parser.add_argument('--batch', action='store_true', help='Coregister the subjects without interaction, queuing the rejected fits for review')
+    parser.add_argument('--review', action='store_true', help='Open the GUI on each subject of the review queue')
+    parser.add_argument('--subjects', nargs='+', help='Subjects of the batch mode (default: all the FreeSurfer subjects)')
+    parser.add_argument('--task', default=TASK, help='Task identifier (e.g., read, listen or distraction), that of config.yml by default')
+    parser.add_argument('--n-workers', type=int, default=1, help='Number of subjects fitted at the same time')
+    parser.add_argument('--overwrite', action='store_true', help='Fit again the subjects which already have a transform')
 
     #parser.add_argument('--output_dir', required=True, help='Path to the directory where the coregistration results will be saved')
 
     args = parser.parse_args()
 
-    # Define directories based on the subject and output directory
-    base_meg_dir = Path("/neurospin/unicog/protocols/IRMf/LePetitPrince_Pallier_2018/MEG/workspace-LPP/data/MEG/LPP/LPP_MEG_distraction/")
-    subjects_dir = Path("/neurospin/unicog/protocols/IRMf/LePetitPrince_Pallier_2018/MEG/workspace-LPP/data/MEG/LPP/LPP_MEG_distraction/derivatives/freesurfer/")
-
-    meg_dir = base_meg_dir / args.subject / 'meg'
-    #output_dir = Path(args.output_dir) / args.subject
-
-    automated_coreg(args.subject, subjects_dir, meg_dir)
\ No newline at end of file
+    if args.batch or args.review:
+        if args.batch:
+            subjects = args.subjects or sorted(folder.name for folder in FREESURFER_DIR.iterdir() if folder.name.startswith("sub-"))
+            queue = run_batch(subjects, args.task, args.n_workers, args.overwrite)
+            print(f"{len(queue)} subject(s) to review: {get_review_fname(args.task)}")
+        if args.review:
+            review(args.task)
+    else:
+        if args.subject is None:
+            parser.error("--subject is required without --batch or --review")
+
+        automated_coreg(args.subject, args.task)
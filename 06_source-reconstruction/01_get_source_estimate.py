@@ -1,102 +1,268 @@
 #! /usr/bin/env python
 
-import os
+import argparse, os, sys, time, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import pandas as pd
 
-# To set the number of threads
-num_threads = '1'
-os.environ["OMP_NUM_THREADS"] = num_threads
-os.environ["OPENBLAS_NUM_THREADS"] = num_threads
-os.environ["MKL_NUM_THREADS"] = num_threads
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils.config import derivatives_dir, freesurfer_dir, load_config, noise_cov_fname, preprocessed_dir, trans_fname
+from utils.parallel import set_num_threads, split_resources
 
-from pathlib import Path
-import mne
-from mne.minimum_norm import (make_inverse_operator, apply_inverse, write_inverse_operator)
+config = load_config()
 
 ## ----- DEFINE PATHS ----- ##
-BASE_PATH = Path('/neurospin/unicog/protocols/IRMf/LePetitPrince_Pallier_2018/MEG/workspace-LPP/data/MEG/LPP/LPP_MEG_auditory/')
-cross_talk_file = BASE_PATH / 'calibration_MEG/old_MEG/ct_sparse_nspn.fif'
-calibration_file = BASE_PATH / 'calibration_MEG/old_MEG/sss_cal_nspn.dat'
-subjects_dir = BASE_PATH / 'derivatives/freesurfer/'
+BASE_PATH = Path(config['base_path'])
+cross_talk_file = BASE_PATH / config['cross_talk_file']
+calibration_file = BASE_PATH / config['calibration_file']
+subjects_dir = freesurfer_dir(config)
+# Source spaces and BEM solutions, computed once per subject and parameters
+anatomy_dir = derivatives_dir(config) / 'anatomy'
+# Evoked responses and noise covariances of the preprocessing, and the outputs of this script
+output_dir = preprocessed_dir(config)
 ## ----------------------- ##
 
-for subject_folder in subjects_dir.iterdir():    
-    subject = subject_folder.name
-    if not subject.startswith('sub-'):
-        continue
-    if subject in ['sub-17', 'sub-21', 'sub-23', 'sub-26']:
-        continue
+## ----- PARAMETERS ----- ##
+spacing = 'oct6'
+ico = 4
+conductivity = (0.3,)
+mindist = 5.0
+loose, depth = 0.2, 0.8
+method = "dSPM"
+snr = 3.
+lambda2 = 1. / snr ** 2
+## ---------------------- ##
+
+## ----- PARALLELISM ----- ##
+# Memory needed by a worker, to derive the number of subjects processed in parallel
+memory_per_subject_gb = 4.
+## ----------------------- ##
+
+def list_subjects():
+    subjects = []
+    for subject_folder in sorted(subjects_dir.iterdir()):
+        subject = subject_folder.name
+        if not subject.startswith('sub-'):
+            continue
+        if subject in ['sub-17', 'sub-21', 'sub-23', 'sub-26']:
+            continue
+        subjects.append(subject)
+    return subjects
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Forward solution, inverse operator and source estimate of each subject")
+    parser.add_argument("--n-workers", type=int, help="number of subjects processed in parallel")
+    parser.add_argument("--n-jobs", type=int, help="n_jobs of make_forward_solution in each worker")
+    parser.add_argument("--threads", type=int, help="number of BLAS threads of each worker")
+    parser.add_argument("--plot", action="store_true", help="show the source estimate of the last subject at the end")
+    args = parser.parse_args()
+
+    # By default, derived from the available cores and memory
+    subjects = list_subjects()
+    n_workers, n_jobs, num_threads = split_resources(
+        len(subjects), memory_per_subject_gb, args.n_workers, args.n_jobs, args.threads)
+    # The number of threads is read when BLAS is loaded (by numpy, through mne), and inherited by the workers
+    set_num_threads(num_threads)
+
+import mne
+from mne.minimum_norm import make_inverse_operator, write_inverse_operator
+from utils import anatomy, buildcache, inverse, telemetry
+
+# Time, CPU, memory and I/O of each step of each subject (see utils/telemetry.py)
+TELEMETRY = config.get('telemetry', f"{config['study']}/derivatives/telemetry.jsonl")
+telemetry.configure(TELEMETRY and BASE_PATH / TELEMETRY)
+
+# The -fwd, -inv and -stc outputs are only rebuilt when their inputs, parameters or this script changed
+CODE_VERSION = buildcache.code_version(__file__)
+
+def anatomy_files(subject):
+    """FreeSurfer files of the source space and of the single layer BEM"""
+    files = [f'surf/{hemi}.{surf}' for hemi in ['lh', 'rh'] for surf in ['white', 'sphere']]
+    return [subjects_dir / subject / f for f in files + ['bem/inner_skull.surf']]
+
+def get_evo_diff_fname(subject):
+    return output_dir / f'{subject}/{subject}_evo_diff-ave.fif'
+
+def get_trans_fname(subject):
+    """Written by 04_coreg.py"""
+    return trans_fname(config, subject)
+
+def get_fwd_fname(subject):
+    return output_dir / f'{subject}/{subject}-fwd.fif'
+
+def get_cov_fname(subject):
+    """Written by 02_get_noise_cov.py"""
+    return noise_cov_fname(config, subject)
 
-    evo_diff_dir = BASE_PATH / f'derivatives/preprocessed_data/{subject}/{subject}_evo_diff-ave.fif'
-    evo_diff = mne.read_evokeds(evo_diff_dir)
+def get_inv_fname(subject):
+    return output_dir / f'{subject}/{subject}-inv.fif'
 
-    trans_fname = subjects_dir / subject / f'coreg/coreg_{subject}_ses-01_task-listen_run-05_meg_trans.fif'
-    noise_cov = mne.read_cov(BASE_PATH / f'derivatives/preprocessed_data/{subject}/{subject}_noise-cov.fif')
+def get_stc_fname(subject):
+    return output_dir / f'{subject}/{subject}-stc.h5'
+
+def fwd_fingerprint(subject):
+    return buildcache.fingerprint(
+        [get_evo_diff_fname(subject), get_trans_fname(subject), *anatomy_files(subject)],
+        params=dict(spacing=spacing, ico=ico, conductivity=conductivity, mindist=mindist),
+        code=CODE_VERSION)
+
+def inv_fingerprint(subject):
+    return buildcache.fingerprint(
+        [get_fwd_fname(subject), get_cov_fname(subject), get_evo_diff_fname(subject)],
+        params=dict(loose=loose, depth=depth, rank='info'),
+        code=CODE_VERSION)
+
+def stc_fingerprint(subject):
+    return buildcache.fingerprint(
+        [get_inv_fname(subject), get_evo_diff_fname(subject)],
+        params=dict(method=method, lambda2=lambda2),
+        code=CODE_VERSION)
+
+def up_to_date(fname, fingerprint, subject):
+    """Whether the output of a step is up to date (False if an input is missing, e.g. not computed yet)"""
+    try:
+        return buildcache.up_to_date(fname(subject), fingerprint(subject))
+    except FileNotFoundError:
+        return False
+
+def make_forward(subject, n_jobs=1):
+    """Forward solution of a subject (if outdated). Returns it if it was computed"""
+    fwd_fname = get_fwd_fname(subject)
+    if up_to_date(get_fwd_fname, fwd_fingerprint, subject):
+        return None
+    os.makedirs(fwd_fname.parent, exist_ok=True)
+    evo_diff_dir = get_evo_diff_fname(subject)
+    trans_fname = get_trans_fname(subject)
 
-    evo_diff = evo_diff[0]
-    info = evo_diff.info
-    
     # ------------- Source space ------------- #
 
-    src = mne.setup_source_space(subject=subject,
-                                spacing='oct6', 
-                                subjects_dir=subjects_dir,
-                                add_dist=False) 
+    with telemetry.stage('source_space', subject, spacing=spacing):
+        src = anatomy.source_space(anatomy_dir, subjects_dir, subject, spacing=spacing)
 
     #mne.viz.plot_alignment(info=info, trans=trans_fname, subject=subject,
     #                    src=src, subjects_dir=subjects_dir, dig=True,
     #                    surfaces=['head-dense', 'white'], coord_frame='meg')
-    
-    preprocessed_dir = BASE_PATH / f'derivatives/preprocessed_data/'
-    os.makedirs(preprocessed_dir / subject, exist_ok=True)
-    src.save(preprocessed_dir / f'{subject}/{subject}-src.fif', overwrite=True)
 
     # ------------- Forward solution ------------- #
 
-    conductivity = (0.3,) 
-    model = mne.make_bem_model(subject=subject, ico=4,
-                            conductivity=conductivity,
-                            subjects_dir=subjects_dir)
+    bem_sol = anatomy.bem_solution(anatomy_dir, subjects_dir, subject, ico=ico, conductivity=conductivity)
+
+    with telemetry.stage('forward', subject, n_jobs=n_jobs):
+        fwd = mne.make_forward_solution(evo_diff_dir,
+                                        trans=trans_fname,
+                                        src=src,
+                                        bem=bem_sol,
+                                        meg=True, # include MEG channels
+                                        eeg=False, # exclude EEG channels
+                                        mindist=mindist, # ignore sources <= 5mm from inner skull
+                                        n_jobs=n_jobs) # number of jobs to run in parallel
+
+        del bem_sol, src
+
+        fwd = mne.convert_forward_solution(fwd, surf_ori=True)
 
-    bem_sol = mne.make_bem_solution(model)
+        fwd = mne.pick_types_forward(fwd, meg=True, eeg=False)
 
-    fwd = mne.make_forward_solution(evo_diff_dir,
-                                    trans=trans_fname,
-                                    src=src,
-                                    bem=bem_sol,
-                                    meg=True, # include MEG channels
-                                    eeg=False, # exclude EEG channels
-                                    mindist=5.0, # ignore sources <= 5mm from inner skull
-                                    n_jobs=1) # number of jobs to run in parallel
+        mne.write_forward_solution(fwd_fname, fwd, overwrite=True)
+    buildcache.record(fwd_fname, fwd_fingerprint(subject))
+    return fwd
 
-    del bem_sol, src
+def make_inverse(subject, fwd=None):
+    """Inverse operator of a subject (if outdated), from its forward solution (read if not given)"""
+    inv_fname = get_inv_fname(subject)
+    if up_to_date(get_inv_fname, inv_fingerprint, subject):
+        return
+    if fwd is None:
+        fwd = mne.read_forward_solution(get_fwd_fname(subject))
+    info = mne.read_evokeds(get_evo_diff_fname(subject))[0].info
+    noise_cov = mne.read_cov(get_cov_fname(subject))
 
-    fwd = mne.convert_forward_solution(fwd, surf_ori=True)
+    with telemetry.stage('inverse', subject):
+        inverse_operator = make_inverse_operator(info, fwd, noise_cov,
+                                                loose=loose, depth=depth, rank = 'info')
 
-    fwd = mne.pick_types_forward(fwd, meg=True, eeg=False)
+        write_inverse_operator(inv_fname, inverse_operator, overwrite=True)
+    buildcache.record(inv_fname, inv_fingerprint(subject))
 
-    fwd_fname = preprocessed_dir / f'{subject}/{subject}-fwd.fif'
-    mne.write_forward_solution(fwd_fname, fwd, overwrite=True)
+def apply_inverse(subject):
+    """Source estimate of the evo_diff of a subject (if outdated)"""
+    stc_fname = get_stc_fname(subject)
+    if up_to_date(get_stc_fname, stc_fingerprint, subject):
+        print(f"Skipping {subject} (up to date)")
+        return
+    evo_diff = mne.read_evokeds(get_evo_diff_fname(subject))[0]
+
+    # The kernel of (subject, nave, lambda2, method) is stored next to the inverse operator,
+    # and reused for any other evoked or epochs (see utils/inverse.py)
+    with telemetry.stage('apply_inverse', subject, method=method):
+        kernel = inverse.get_kernel(get_inv_fname(subject), evo_diff.nave, lambda2, method=method)
+        stc = kernel.apply_evoked(evo_diff)
+
+        stc.save(stc_fname, ftype='h5', overwrite=True)
+    buildcache.record(stc_fname, stc_fingerprint(subject))
+
+def source_reconstruction(subject, n_jobs=1):
+    """Forward solution, inverse operator and source estimate of a subject (each one only if outdated)
+
+    Returns the time spent in each step.
+    """
+    timings = dict(subject=subject)
+    start = time.perf_counter()
+
+    # ------------- Forward solution ------------- #
+
+    fwd = make_forward(subject, n_jobs)
+    timings['forward'] = time.perf_counter() - start
 
     # ------------- Inverse operator ------------- #
 
-    inverse_operator = make_inverse_operator(info, fwd, noise_cov,
-                                            loose=0.2, depth=0.8, rank = 'info')
-    
+    make_inverse(subject, fwd)
+    del fwd
+    timings['inverse'] = time.perf_counter() - start - timings['forward']
 
-    write_inverse_operator(preprocessed_dir / f'{subject}/{subject}-inv.fif', inverse_operator, overwrite=True)
-    
     # ------------- Applying inverse operator ------------- #
 
-    method = "dSPM"
-    snr = 3.
-    lambda2 = 1. / snr ** 2
-    stc = apply_inverse(evo_diff, inverse_operator, lambda2,
-                        method=method, pick_ori=None)
+    apply_inverse(subject)
+
+    timings['apply'] = time.perf_counter() - start - timings['forward'] - timings['inverse']
+    timings['total'] = time.perf_counter() - start
+    return timings
 
-    stc.save(preprocessed_dir / f'{subject}/{subject}-stc.h5', overwrite=True)
+def log_timings(timings, n_workers, n_jobs, num_threads):
+    """Append the timing of a subject (and the split of the cores it ran with) to the timing log"""
+    log_fname = output_dir / 'source_reconstruction_timings.tsv'
+    row = dict(timings, n_workers=n_workers, n_jobs=n_jobs, threads=num_threads)
+    pd.DataFrame([row]).to_csv(log_fname, sep='\t', index=False, mode='a', header=not log_fname.exists())
+    print(f"{timings['subject']}: forward {timings['forward']:.1f} s, inverse {timings['inverse']:.1f} s, "
+          f"apply {timings['apply']:.1f} s")
 
+if __name__ == "__main__":
+    print(f"{len(subjects)} subjects, {n_workers} in parallel, each with n_jobs={n_jobs} and {num_threads} BLAS thread(s)")
+    resources = (n_workers, n_jobs, num_threads)
+    failed = []
+    if n_workers == 1:
+        for subject in subjects:
+            log_timings(source_reconstruction(subject, n_jobs), *resources)
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=set_num_threads,
+            initargs=(num_threads,),
+        ) as executor:
+            futures = {executor.submit(source_reconstruction, subject, n_jobs): subject for subject in subjects}
+            for future in as_completed(futures):
+                try:
+                    log_timings(future.result(), *resources)
+                except Exception as e:
+                    print(f"Failed to process {futures[future]}: {e!r}")
+                    failed.append(futures[future])
+    if failed:
+        print("Failed subjects:", sorted(failed))
 
-brain = stc.plot(surface='inflated',
-                 hemi='both',
-                 subjects_dir=subjects_dir,
-                 time_viewer=True)
+    if args.plot and subjects and subjects[-1] not in failed:
+        stc = mne.read_source_estimate(get_stc_fname(subjects[-1]))
+        brain = stc.plot(surface='inflated',
+                         hemi='both',
+                         subjects_dir=subjects_dir,
+                         time_viewer=True)
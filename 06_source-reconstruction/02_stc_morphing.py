@@ -8,48 +8,123 @@ os.environ["OMP_NUM_THREADS"] = num_threads
 os.environ["OPENBLAS_NUM_THREADS"] = num_threads
 os.environ["MKL_NUM_THREADS"] = num_threads
 
-import mne
-import numpy as np
+import sys
 from mne import read_source_estimate
 from pathlib import Path
 from mne.datasets import fetch_fsaverage
 
-BASE_PATH = Path('/neurospin/unicog/protocols/IRMf/LePetitPrince_Pallier_2018/MEG/workspace-LPP/data/MEG/LPP/LPP_MEG_auditory')
-subjects_dir = BASE_PATH / 'derivatives/freesurfer/'
-stc_list = []
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils import buildcache, telemetry
+from utils.config import derivatives_dir, freesurfer_dir, load_config, preprocessed_dir
+from utils.group import GroupAccumulator
+from utils.morph import apply_morph, get_morph
+
+config = load_config()
+
+subjects_dir = freesurfer_dir(config)
+anatomy_dir = derivatives_dir(config) / 'anatomy'
+# Source estimates of 01_get_source_estimate.py, and the outputs of this script
+output_dir = preprocessed_dir(config)
+# Running sums of the subjects already averaged, to only read the new (or changed) ones
+accumulator_fname = output_dir / 'stc_avg_accumulator.npz'
+# Each subject is divided by its maximum before averaging (see utils/group.py)
+normalization = 'max'
 
 #fsaverage_dir = fetch_fsaverage(subjects_dir=subjects_dir) # si besoin de récupérer fichier fsaverage
 
 fsaverage = 'fsaverage'
 
-for subject_folder in subjects_dir.iterdir():
-    subject = subject_folder.name
-    if not subject.startswith('sub-'):
-        continue
-    if subject in ['sub-17', 'sub-21', 'sub-23', 'sub-26']:
-        continue
-    
-    stc_fname = BASE_PATH / f'derivatives/preprocessed_data/{subject}/{subject}-stc.h5'
-    stc = read_source_estimate(stc_fname)
-    
-    morph = mne.compute_source_morph(stc, subject_from=subject, subject_to=fsaverage, 
-                                     subjects_dir=subjects_dir)
-    
-    stc_fsaverage = morph.apply(stc)
-    
-    stc_fsaverage.data /= np.max(stc_fsaverage.data)
-
-    stc_list.append(stc_fsaverage)
-
-stc_mean = np.mean([s.data for s in stc_list], axis=0)
-
-stc_avg = stc_list[0].copy()
-stc_avg._data = stc_mean
-
-output_stc_avg = BASE_PATH / 'derivatives/preprocessed_data/stc_avg.h5'
-stc_avg.save(output_stc_avg, ftype='h5', overwrite=True)
-
-#stc_avg = mne.read_source_estimate(output_stc_avg) # to read it
-
-brain = stc_avg.plot(subject=fsaverage, subjects_dir=subjects_dir, time_viewer=True,
-                     hemi='both', smoothing_steps=5, time_unit='s')
+# Time, CPU, memory and I/O of the morph of each subject (see utils/telemetry.py)
+TELEMETRY = config.get('telemetry', f"{config['study']}/derivatives/telemetry.jsonl")
+telemetry.configure(TELEMETRY and Path(config['base_path']) / TELEMETRY)
+
+# The morphed estimates are only rebuilt when their estimate or this script changed
+CODE_VERSION = buildcache.code_version(__file__)
+
+def get_morphed_fname(subject):
+    """Estimate of a subject morphed to fsaverage (read by 04_make_report.py)"""
+    return output_dir / f'{subject}/{subject}-{fsaverage}-stc.h5'
+
+def list_subjects():
+    """Source estimate of each subject"""
+    subjects = {}
+    for subject_folder in sorted(subjects_dir.iterdir()):
+        subject = subject_folder.name
+        if not subject.startswith('sub-'):
+            continue
+        if subject in ['sub-17', 'sub-21', 'sub-23', 'sub-26']:
+            continue
+        subjects[subject] = output_dir / f'{subject}/{subject}-stc.h5'
+    return subjects
+
+def morphed_fingerprint(subject):
+    return buildcache.fingerprint(
+        [output_dir / f'{subject}/{subject}-stc.h5'], params=dict(subject_to=fsaverage), code=CODE_VERSION)
+
+def morphed_up_to_date(subject):
+    try:
+        return buildcache.up_to_date(get_morphed_fname(subject), morphed_fingerprint(subject))
+    except FileNotFoundError:  # no source estimate yet
+        return False
+
+def morph_subject(subject):
+    """Estimate of a subject morphed to fsaverage, read if up to date, else computed and saved"""
+    morphed_fname = get_morphed_fname(subject)
+    if morphed_up_to_date(subject):
+        return read_source_estimate(morphed_fname)
+
+    stc = read_source_estimate(output_dir / f'{subject}/{subject}-stc.h5')
+
+    with telemetry.stage('morph', subject, subject_to=fsaverage):
+        # computed once per subject, and shared with the other scripts
+        morph = get_morph(anatomy_dir, subjects_dir, stc, subject, subject_to=fsaverage)
+
+        stc_fsaverage, = apply_morph(morph, [stc])
+        stc_fsaverage.save(morphed_fname, ftype='h5', overwrite=True)
+    buildcache.record(morphed_fname, morphed_fingerprint(subject))
+    return stc_fsaverage
+
+def average(subjects=None):
+    """Average (and variance) of the morphed estimates of the subjects, only reading the new or changed ones"""
+    if subjects is None:
+        subjects = list_subjects()
+
+    # The sums can not be updated for a subject which changed or was removed: start over then
+    accumulator = None
+    if accumulator_fname.exists():
+        accumulator = GroupAccumulator.load(accumulator_fname)
+        if accumulator.normalization != normalization or any(
+            subject not in subjects or not accumulator.up_to_date(subject, subjects[subject])
+            for subject in accumulator.inputs
+        ):
+            accumulator = None
+    if accumulator is None:
+        accumulator = GroupAccumulator(normalization)
+    n_averaged = accumulator.n
+
+    for subject, stc_fname in subjects.items():
+        if subject in accumulator.inputs and morphed_up_to_date(subject):
+            print(f"Skipping {subject} (already averaged)")
+            continue
+
+        stc_fsaverage = morph_subject(subject)
+        if subject not in accumulator.inputs:
+            accumulator.add(subject, stc_fsaverage, stc_fname)
+        del stc_fsaverage
+
+    output_stc_avg = output_dir / 'stc_avg.h5'
+    # Only rewritten when subjects were added, so that the reports built from them stay up to date
+    if accumulator.n != n_averaged or not output_stc_avg.exists():
+        accumulator.save(accumulator_fname)
+        accumulator.mean().save(output_stc_avg, ftype='h5', overwrite=True)
+        if accumulator.n > 1:
+            accumulator.variance().save(output_dir / 'stc_var.h5', ftype='h5', overwrite=True)
+    return accumulator.mean()
+
+if __name__ == "__main__":
+    stc_avg = average()
+
+    #stc_avg = read_source_estimate(output_stc_avg) # to read it
+
+    brain = stc_avg.plot(subject=fsaverage, subjects_dir=subjects_dir, time_viewer=True,
+                         hemi='both', smoothing_steps=5, time_unit='s')
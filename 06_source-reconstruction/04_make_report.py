@@ -1,89 +1,109 @@
-import matplotlib, nibabel, pyvista, PyQt5, os, scipy.ndimage
-import matplotlib.pyplot as plt
+import matplotlib, argparse, os, sys
 matplotlib.use('Agg')
-pyvista.OFF_SCREEN = True
-import mne_bids, mne
-from mne.preprocessing import find_bad_channels_maxwell
-from mne.preprocessing import maxwell_filter
-from mne.minimum_norm import (make_inverse_operator, apply_inverse, write_inverse_operator)
-import tempfile
 from pathlib import Path
 import numpy as np
-import pandas as pd
-import seaborn as sns
-from mne.report import Report
-
-## ----------- Evo diff plotting ----------- ##
-
-BASE_PATH = Path('/neurospin/unicog/protocols/IRMf/LePetitPrince_Pallier_2018/MEG/workspace-LPP/data/MEG/LPP/LPP_MEG_auditory')
-subjects_dir = BASE_PATH / 'derivatives/preprocessed_data/'
-
-all_evokeds = []
-
-for subject in os.listdir(subjects_dir):
-    if not subject.startswith('sub-'):
-        continue
-    if subject in ['sub-17', 'sub-21', 'sub-23', 'sub-26']:
-        continue
-    epo_file = subjects_dir / subject / f'{subject}_evo_diff-ave.fif'   
-    evoked_list = mne.read_evokeds(epo_file)
-    evoked = evoked_list[0] 
-    all_evokeds.append(evoked)
-
-evo_diff_all = mne.grand_average(all_evokeds)
-
-times = np.linspace(-0.5, 0.8, 10)
-fig = evo_diff_all.plot_joint(times=times, title='Auditory response', picks='meg', exclude = 'bads')
-
-
-report = mne.Report(title="Source Reconstruction - LPP auditory paradigm (all subjects)")
-report.add_figure(fig=fig, title="Evo diff across all subjects")  
-report.save("report_evoked_response.html", overwrite=True)
-
-## STC ##
-
-
-from mne import read_source_estimate
-from pathlib import Path
-from mne.datasets import fetch_fsaverage
-
-BASE_PATH = Path('/neurospin/unicog/protocols/IRMf/LePetitPrince_Pallier_2018/MEG/workspace-LPP/data/MEG/LPP/LPP_MEG_auditory')
-subjects_dir = BASE_PATH / 'derivatives/freesurfer/'
-stc_list = []
-
-#fsaverage_dir = fetch_fsaverage(subjects_dir=subjects_dir) # si besoin de récupérer fichier fsaverage
-
+import mne
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils import buildcache
+from utils.config import derivatives_dir, freesurfer_dir, load_config, preprocessed_dir
+from utils.parallel import split_resources
+from utils.report import Section, assemble, render_evoked, render_sections, render_stc
+
+## ----- DEFINE PATHS ----- ##
+config = load_config()
+output_dir = preprocessed_dir(config)
+subjects_dir = freesurfer_dir(config)
+# Rendered sections of the reports, only rendered again when their inputs changed
+report_cache_dir = derivatives_dir(config) / 'report_sections'
+## ----------------------- ##
+
+## ----- PARAMETERS ----- ##
 fsaverage = 'fsaverage'
-
-for subject_folder in subjects_dir.iterdir():
-    subject = subject_folder.name
-    if not subject.startswith('sub-'):
-        continue
-    if subject in ['sub-17', 'sub-21', 'sub-23', 'sub-26']:
-        continue
-    
-    stc_fname = BASE_PATH / f'derivatives/preprocessed_data/{subject}/{subject}-stc.h5'
-    stc = read_source_estimate(stc_fname)
-    
-    morph = mne.compute_source_morph(stc, subject_from=subject, subject_to=fsaverage, 
-                                     subjects_dir=subjects_dir)
-    
-    stc_fsaverage = morph.apply(stc)
-    
-    stc_fsaverage.data /= np.max(stc_fsaverage.data)
-
-    stc_list.append(stc_fsaverage)
-
-stc_mean = np.mean([s.data for s in stc_list], axis=0)
-
-stc_avg = stc_list[0].copy()
-stc_avg._data = stc_mean
-
-report.add_stc(
-    stc=stc_avg,
-    subject=fsaverage,
-    subjects_dir=subjects_dir,
-    title="Source estimate",
-    n_time_points=100  
-)
-report.save("report_stc.html", overwrite=True)
+title = "Source Reconstruction - LPP auditory paradigm (all subjects)"
+joint_times = np.linspace(-0.5, 0.8, 10).tolist()
+n_time_points = 100
+subject_n_time_points = 20
+# Memory needed by a worker, to derive the number of sections rendered in parallel
+memory_per_section_gb = 2.
+## ---------------------- ##
+
+CODE_VERSION = buildcache.code_version(__file__)
+
+def list_subjects():
+    subjects = []
+    for subject in sorted(os.listdir(output_dir)):
+        if not subject.startswith('sub-'):
+            continue
+        if subject in ['sub-17', 'sub-21', 'sub-23', 'sub-26']:
+            continue
+        subjects.append(subject)
+    return subjects
+
+def get_evo_diff_fname(subject):
+    return output_dir / subject / f'{subject}_evo_diff-ave.fif'
+
+def get_morphed_fname(subject):
+    """Estimate of a subject morphed to fsaverage, written by 02_stc_morphing.py"""
+    return output_dir / f'{subject}/{subject}-{fsaverage}-stc.h5'
+
+def grand_average(subjects):
+    """Grand average of the evo diff of the subjects, only recomputed when one of them changed"""
+    fname = output_dir / 'evo_diff_grand-ave.fif'
+    fingerprint = buildcache.fingerprint([get_evo_diff_fname(subject) for subject in subjects], code=CODE_VERSION)
+    if not buildcache.up_to_date(fname, fingerprint):
+        all_evokeds = [mne.read_evokeds(get_evo_diff_fname(subject))[0] for subject in subjects]
+        mne.write_evokeds(fname, mne.grand_average(all_evokeds), overwrite=True)
+        buildcache.record(fname, fingerprint)
+    return fname
+
+## ----------- Sections ----------- ##
+
+def report_sections(subjects):
+    """Sections of the group results, then of each subject
+
+    Rendered by the functions of utils/report.py, which the worker processes
+    import (unlike this script, when it is loaded by pipeline.py).
+    """
+    evo_diff_all = grand_average(subjects)
+    stc_avg = output_dir / 'stc_avg.h5'  # written by 02_stc_morphing.py
+    # the estimates are morphed to fsaverage
+    stc_kwargs = dict(subject=fsaverage, subjects_dir=str(subjects_dir))
+    sections = [
+        Section('group-evoked', render_evoked, [evo_diff_all], dict(
+            fname=str(evo_diff_all), title="Evo diff across all subjects", plot_title='Auditory response',
+            times=joint_times), tags=('evoked',)),
+        Section('group-stc', render_stc, [stc_avg], dict(
+            fname=str(stc_avg), title="Source estimate", n_time_points=n_time_points, **stc_kwargs), tags=('stc',)),
+    ]
+    for subject in subjects:
+        sections.append(Section(f'{subject}-evoked', render_evoked, [get_evo_diff_fname(subject)], dict(
+            fname=str(get_evo_diff_fname(subject)), title="Evo diff", plot_title=subject, times=joint_times,
+            section=subject), tags=('evoked',)))
+        morphed_fname = get_morphed_fname(subject)
+        if not morphed_fname.exists():
+            print(f"No morphed estimate for {subject}, run 02_stc_morphing.py")
+            continue
+        sections.append(Section(f'{subject}-stc', render_stc, [morphed_fname], dict(
+            fname=str(morphed_fname), title="Source estimate", n_time_points=subject_n_time_points, section=subject,
+            **stc_kwargs), tags=('stc',)))
+    return sections
+
+def make_reports(n_workers=None):
+    """Render the outdated sections, and assemble the two reports. Returns the sections which failed"""
+    sections = report_sections(list_subjects())
+    n_workers, _, _ = split_resources(len(sections), memory_per_section_gb, n_workers)
+    failed = render_sections(sections, report_cache_dir, code=CODE_VERSION, n_workers=n_workers)
+    if failed:
+        print("Failed sections:", sorted(failed))
+
+    assemble(title, sections, report_cache_dir, "report_evoked_response.html", tags=['evoked'])
+    assemble(title, sections, report_cache_dir, "report_stc.html")
+    return failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTML reports of the evoked responses and source estimates")
+    parser.add_argument("--n-workers", type=int, help="number of sections rendered in parallel")
+    args = parser.parse_args()
+
+    make_reports(args.n_workers)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""Run the pipeline as a graph of per-subject and per-run tasks
+
+Each stage is expanded into one task per acquisition file (crop), run
+(bads, preprocessing), subject, or for the group (average, report), calling
+the function of its script which builds one unit. A task starts as soon as the
+tasks it depends on are done, so the subjects go through the stages
+independently, and a failed subject does not stop the others. The tasks whose
+outputs are up to date (see the build sidecars of utils/buildcache.py) are not
+run, unless a task they depend on runs.
+
+All the scripts read the config.yml given by --config (by default, that of
+04_meg-preprocessing), and derive the folders they share from it (see
+utils/config.py):
+    python pipeline.py --subjects sub-1 sub-2 --until coreg --dry-run
+"""
+
+import argparse, sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT))
+from utils import dag, telemetry
+from utils.config import load_config, set_config
+from utils.parallel import split_resources
+
+SCRIPTS = dict(
+    crop=ROOT / "02_data-preparation/crop_runs.py",
+    bids=ROOT / "03_bids-conversion/formatting_distraction.py",
+    preprocessing=ROOT / "04_meg-preprocessing/01_preprocessing.py",
+    noise_cov=ROOT / "04_meg-preprocessing/02_get_noise_cov.py",
+    contrasts=ROOT / "04_meg-preprocessing/03_contrasts.py",
+    recon_all=ROOT / "05_anat-preprocessing/01_recon_all.py",
+    bem=ROOT / "05_anat-preprocessing/03_bem.py",
+    coreg=ROOT / "05_anat-preprocessing/04_coreg.py",
+    source=ROOT / "06_source-reconstruction/01_get_source_estimate.py",
+    morph=ROOT / "06_source-reconstruction/02_stc_morphing.py",
+    report=ROOT / "06_source-reconstruction/04_make_report.py",
+)
+
+# In dependency order: --until keeps the stages up to the one given
+STAGES = ["crop", "bids", "bads", "preprocessing", "evoked", "contrasts", "noise_cov", "recon_all", "bem", "coreg",
+          "forward", "inverse", "stc", "morph", "average", "report"]
+
+# Memory needed by a worker, to derive the number of tasks run in parallel
+MEMORY_PER_TASK_GB = 4.
+
+def subject_key(subject):
+    """sub-2 before sub-10"""
+    number = subject.split("-")[-1]
+    return (0, int(number), "") if number.isdigit() else (1, 0, subject)
+
+def default_subjects(config):
+    """The subjects of config.yml, or those of the BIDS conversion"""
+    subjects = config.get("subjects", None)
+    if subjects:
+        return [subjects] if isinstance(subjects, str) else list(subjects)
+    bids = dag.load_script(SCRIPTS["bids"])
+    return sorted({f"sub-{sub}" for sub in bids.dict_nip_to_sn.values()}, key=subject_key)
+
+def build_tasks(subjects, stages, config):
+    """Tasks of the stages for the subjects, each one after its dependencies
+
+    The dependencies on the stages left out are taken as done.
+    """
+    tasks = []
+
+    def add(stage, subject, run, script, func, args, deps=(), done=False, collect=False):
+        if stage in stages:
+            tasks.append(dag.Task(stage, subject, run, str(SCRIPTS[script]), func, tuple(args), list(deps), done, collect))
+        return dag.task_name(stage, subject, run)
+
+    # ----- Cropping and BIDS conversion ----- #
+    bids_tasks = {}
+    if {"crop", "bids"} & set(stages):
+        crop = dag.load_script(SCRIPTS["crop"])
+        bids = dag.load_script(SCRIPTS["bids"])
+        manifest = bids.buildcache.Manifest(bids.MANIFEST)
+        for nip, sub in bids.dict_nip_to_sn.items():
+            subject = f"sub-{sub}"
+            if subject not in subjects:
+                continue
+            nip_dir = bids.RAW_DATA_PATH / nip
+            output_dir = nip_dir / "cropped_runs"
+            acquisitions = sorted(
+                fif_file for folder in (sorted(nip_dir.iterdir()) if nip_dir.is_dir() else [])
+                if folder.is_dir() and folder.name != "cropped_runs" for fif_file in folder.glob("*.fif"))
+            crop_tasks = [
+                add("crop", subject, fif_file.stem, "crop", "split_runs", [str(fif_file), str(output_dir)],
+                    done=crop.split_up_to_date(fif_file, output_dir))
+                for fif_file in acquisitions
+            ]
+            done = not bids.pending_conversions(bids.plan_conversions([sub]), manifest)
+            bids_tasks[subject] = add("bids", subject, None, "bids", "convert_subject", [sub], crop_tasks, done)
+
+    # ----- MEG preprocessing ----- #
+    if {"bads", "preprocessing", "evoked", "contrasts", "noise_cov"} & set(stages):
+        preprocessing = dag.load_script(SCRIPTS["preprocessing"])
+        noise_cov = dag.load_script(SCRIPTS["noise_cov"])
+        contrasts = dag.load_script(SCRIPTS["contrasts"])
+        for subject in subjects:
+            bids_deps = [bids_tasks[subject]] if subject in bids_tasks else []
+            # the runs are only preprocessed to build the evo_diff and the epoch stores of the subject
+            done = preprocessing.outputs_up_to_date(subject)
+            bads_tasks = []
+            if preprocessing.BADS_MIN_RUNS:
+                # pooled across the runs: all of them are scanned before any is Maxwell filtered
+                bads_tasks = [add("bads", subject, run, "preprocessing", "detect_run_bads", [subject, run], bids_deps, done)
+                              for run in preprocessing.RUNS]
+            run_tasks = [add("preprocessing", subject, run, "preprocessing", "preprocess_run", [subject, run],
+                             bids_deps + bads_tasks, done) for run in preprocessing.RUNS]
+            add("evoked", subject, None, "preprocessing", "save_grand_average", [subject], run_tasks, done, collect=True)
+            # from the epoch stores written by the runs
+            if preprocessing.EPOCH_STORE and contrasts.CONTRASTS:
+                add("contrasts", subject, None, "contrasts", "save_contrasts", [subject], run_tasks,
+                    contrasts.contrasts_up_to_date(subject))
+            add("noise_cov", subject, None, "noise_cov", "save_noise_cov", [subject], run_tasks,
+                noise_cov.cov_up_to_date(subject))
+
+    # ----- Anatomy ----- #
+    if {"recon_all", "bem", "coreg"} & set(stages):
+        recon_all = dag.load_script(SCRIPTS["recon_all"])
+        bem = dag.load_script(SCRIPTS["bem"])
+        coreg = dag.load_script(SCRIPTS["coreg"])
+        for subject in subjects:
+            add("recon_all", subject, None, "recon_all", "recon_all_subject", [subject], done=recon_all.is_done(subject))
+            add("bem", subject, None, "bem", "run_bem", [subject], [dag.task_name("recon_all", subject)],
+                bem.bem_done(subject))
+            # the transform read by the forward solution
+            trans_fname = coreg.get_paths(subject, config["task"])["trans"]
+            add("coreg", subject, None, "coreg", "coreg_subject", [subject, config["task"]],
+                [dag.task_name("bem", subject)] + ([bids_tasks[subject]] if subject in bids_tasks else []),
+                trans_fname.exists())
+
+    # ----- Source reconstruction ----- #
+    if {"forward", "inverse", "stc", "morph", "average", "report"} & set(stages):
+        source = dag.load_script(SCRIPTS["source"])
+        morph = dag.load_script(SCRIPTS["morph"])
+        morph_tasks, evoked_tasks = [], []
+        for subject in subjects:
+            evoked = dag.task_name("evoked", subject)
+            evoked_tasks.append(evoked)
+            forward = add("forward", subject, None, "source", "make_forward", [subject],
+                          [evoked, dag.task_name("coreg", subject), dag.task_name("bem", subject)],
+                          source.up_to_date(source.get_fwd_fname, source.fwd_fingerprint, subject))
+            inverse = add("inverse", subject, None, "source", "make_inverse", [subject],
+                          [forward, dag.task_name("noise_cov", subject), evoked],
+                          source.up_to_date(source.get_inv_fname, source.inv_fingerprint, subject))
+            stc = add("stc", subject, None, "source", "apply_inverse", [subject], [inverse, evoked],
+                      source.up_to_date(source.get_stc_fname, source.stc_fingerprint, subject))
+            morph_tasks.append(add("morph", subject, None, "morph", "morph_subject", [subject], [stc],
+                                   morph.morphed_up_to_date(subject)))
+        # both only read the new or changed subjects: they are run every time
+        average = add("average", None, None, "morph", "average", [], morph_tasks)
+        add("report", None, None, "report", "make_reports", [], [average] + evoked_tasks)
+
+    # by stage, so that each task comes after its dependencies
+    return sorted(tasks, key=lambda task: STAGES.index(task.stage))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the stages of the pipeline for each subject and run, in parallel")
+    parser.add_argument("--config", type=Path, default=ROOT / "04_meg-preprocessing/config.yml",
+                        help="configuration of all the stages (default: %(default)s)")
+    parser.add_argument("--subjects", nargs="+", help="subjects to process (default: those of config.yml, or all)")
+    parser.add_argument("--until", choices=STAGES, default=STAGES[-1], help="last stage to run")
+    parser.add_argument("--dry-run", action="store_true", help="list the tasks, without running them")
+    parser.add_argument("--n-workers", type=int, help="number of tasks run in parallel")
+    parser.add_argument("--threads", type=int, help="number of BLAS threads of each worker")
+    args = parser.parse_args()
+
+    # before the scripts are loaded, here and in the workers
+    set_config(args.config)
+    config = load_config()
+    # before the scripts are loaded, so that all the stages (in all the workers) go to the same log
+    log = config.get("telemetry", f"{config['study']}/derivatives/telemetry.jsonl")
+    telemetry.configure(log and Path(config["base_path"]) / log)
+
+    subjects = args.subjects or default_subjects(config)
+    stages = STAGES[:STAGES.index(args.until) + 1]
+    tasks = build_tasks(subjects, stages, config)
+    todo = dag.to_run(tasks)
+
+    if args.dry_run:
+        names = {task.name for task in todo}
+        for task in tasks:
+            print(f"{'run' if task.name in names else 'up to date':<12}{task.name}")
+        print(f"{len(todo)} of the {len(tasks)} tasks to run")
+        sys.exit(0)
+
+    if any(task.stage == "preprocessing" for task in todo):
+        # the word frequencies are read by all the workers from a shared cache
+        preprocessing = dag.load_script(SCRIPTS["preprocessing"])
+        preprocessing.lexicon.prewarm(preprocessing.METADATA, "fr")
+
+    n_workers, _, num_threads = split_resources(len(todo), MEMORY_PER_TASK_GB, args.n_workers, None, args.threads)
+    print(f"{len(todo)} of the {len(tasks)} tasks to run, {n_workers} at a time with {num_threads} thread(s) each")
+    # the later stages first, so that the subjects are finished one after the other
+    status = dag.run(todo, n_workers, num_threads, priority=lambda task: STAGES.index(task.stage)) if todo else {}
+
+    failed = sorted(name for name, state in status.items() if state != "done")
+    if failed:
+        print("Failed or skipped tasks:", failed)
+        sys.exit(1)
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""Timings of the hot paths of the pipeline on synthetic data, compared to stored baselines
+
+Runs offline and on CPU, without the study data: the runs, acquisition file,
+events.tsv and anatomy are simulated (see synthetic.py), and the parameters
+are those of 04_meg-preprocessing/config.yml. Each case calls the same
+functions as the scripts, and is timed with utils/telemetry.py (best wall time
+of --repeat runs, and its peak memory). With --save, the timings become the
+baselines of this machine. Otherwise, the exit status is 1 if a case is slower
+than its baseline by more than --tolerance (and by more than MIN_REGRESSION_S).
+
+    python test/benchmark.py --save                  # once, on the reference code
+    python test/benchmark.py --only crop maxwell     # after a change
+"""
+
+import argparse, contextlib, io, json, os, platform, shutil, socket, sys, tempfile, time, yaml
+from functools import cached_property
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+import mne
+import numpy as np
+from mne.minimum_norm import make_inverse_operator, write_inverse_operator
+from utils import anatomy, averaging, bads, contrasts, dag, epochstore, inverse, lexicon, morph, telemetry
+from utils.covariance import compute_segments_covariance
+from utils.matching import approx_match_samples
+from utils.parallel import set_num_threads
+from utils.sss import streaming_maxwell_filter
+
+import synthetic
+
+BASELINES = Path(__file__).resolve().parent / "benchmark_baselines.json"
+CONFIG = yaml.safe_load((ROOT / "04_meg-preprocessing" / "config.yml").read_text())
+# Differences below this are noise, whatever the ratio
+MIN_REGRESSION_S = 0.01
+SPACING, ICO, LAMBDA2 = "oct5", 4, 1. / 9
+
+
+class Study:
+    """Synthetic inputs and intermediate outputs of a subject, built on first use"""
+
+    def __init__(self, root: Path, duration: float):
+        self.root = root
+        self.duration = duration
+        self.subjects_dir = root / "freesurfer"
+        self.store = root / "anatomy"
+
+    @cached_property
+    def raw_fname(self):
+        raw, words = synthetic.simulate_run(self.duration)
+        raw.save(self.root / "run_raw.fif", verbose=False)
+        synthetic.write_events_tsv(words, self.root / "run_events.tsv")
+        return self.root / "run_raw.fif"
+
+    @cached_property
+    def words(self):
+        """Words of the run aligned on their triggers, with their frequency, as in 01_preprocessing.py"""
+        from utils.events import read_events
+        raw = mne.io.read_raw_fif(self.raw_fname, verbose=False)
+        words = read_events(self.root / "run_events.tsv", cache=False)
+        triggers = mne.find_stim_steps(raw, stim_channel="STI008")
+        triggers = triggers[triggers[:, 2] == 0]
+        i, j = approx_match_samples((words.onset * 1000).tolist(), triggers[:, 0], abs_tol=10, max_missing=5)
+        words = words.iloc[i].copy()
+        words["onset"] = triggers[j, 0] / raw.info["sfreq"]
+        words["freq"] = lexicon.word_frequencies(words.word, "fr")
+        words["is_rare"] = words.freq < np.median(words.freq)
+        words["run"] = 1
+        words["position"] = words.index
+        words["length"] = words.word.str.len()
+        return words
+
+    @cached_property
+    def sss_fname(self):
+        raw = mne.io.read_raw_fif(self.raw_fname, verbose=False).load_data()
+        raw.filter(CONFIG["filter_low"], CONFIG["filter_high"], verbose=False)
+        noisy, flat = bads.find_bad_channels(raw)
+        raw.info["bads"] = noisy + flat
+        raw_sss = mne.preprocessing.maxwell_filter(raw, destination=raw.info["dev_head_t"], verbose=False)
+        raw_sss.save(self.root / "run_raw_sss.fif", verbose=False)
+        return self.root / "run_raw_sss.fif"
+
+    @cached_property
+    def acquisition_fname(self):
+        """Two runs recorded in one file, named like the acquisitions (the run numbers are in the name)"""
+        fname = self.root / "acquisition" / "run_1_2_meg.fif"
+        fname.parent.mkdir()
+        synthetic.simulate_acquisition((self.duration / 2, self.duration / 2)).save(fname, verbose=False)
+        return fname
+
+    def epochs(self):
+        raw_sss = mne.io.read_raw_fif(self.sss_fname, verbose=False)
+        events = np.ones((len(self.words), 3), dtype=int)
+        events[:, 0] = self.words.onset * raw_sss.info["sfreq"]
+        events[:, 2] = np.arange(len(self.words))
+        return mne.Epochs(raw_sss, events, tmin=CONFIG["epoch_tmin"], tmax=CONFIG["epoch_tmax"],
+                          baseline=tuple(CONFIG["baseline"]), metadata=self.words, verbose=False)
+
+    @cached_property
+    def evo_diff(self):
+        return evo_diff(self.epochs())
+
+    @cached_property
+    def epochs_fname(self):
+        """Epoch store of the run"""
+        epochstore.write(self.root / "run_epochs", self.epochs())
+        return self.root / "run_epochs"
+
+    @cached_property
+    def noise_cov(self):
+        return compute_segments_covariance(self.segments(), method="empirical")
+
+    def segments(self):
+        raw = mne.io.read_raw_fif(self.sss_fname, verbose=False)
+        events = mne.find_events(raw, stim_channel="STI101", verbose=False)
+        return [(self.sss_fname, events[0][0] / raw.info["sfreq"], events[1][0] / raw.info["sfreq"])]
+
+    @cached_property
+    def fwd(self):
+        for subject in ["sub-01", "fsaverage"]:
+            synthetic.make_anatomy(self.subjects_dir, subject)
+        src = anatomy.source_space(self.store, self.subjects_dir, "sub-01", spacing=SPACING)
+        bem_sol = anatomy.bem_solution(self.store, self.subjects_dir, "sub-01", ico=ICO)
+        trans = mne.transforms.Transform("head", "mri", np.eye(4))
+        fwd = mne.make_forward_solution(self.evo_diff.info, trans=trans, src=src, bem=bem_sol, eeg=False,
+                                        mindist=5.0, verbose=False)
+        return mne.convert_forward_solution(fwd, surf_ori=True, verbose=False)
+
+    @cached_property
+    def stc(self):
+        inv_fname = self.root / "sub-01-inv.fif"
+        write_inverse_operator(inv_fname, make_inverse_operator(
+            self.evo_diff.info, self.fwd, self.noise_cov, loose=0.2, depth=0.8, verbose=False),
+            overwrite=True, verbose=False)
+        return inverse.get_kernel(inv_fname, self.evo_diff.nave, LAMBDA2, store=False).apply_evoked(self.evo_diff)
+
+
+def evo_diff(epochs, **kwargs):
+    """Rare - frequent difference of the median evoked responses, as in 01_preprocessing.py"""
+    evokeds = averaging.median_evokeds(epochs, dict(rare="is_rare", freq="~is_rare"), **kwargs)
+    evokeds["rare"].data -= evokeds["freq"].data
+    return evokeds["rare"]
+
+
+# ----- Cases: each one builds its inputs (not timed) and returns the function timed ----- #
+
+def matching(study):
+    """The words of the 9 runs of a subject (about 1500 each), a few triggers being missing"""
+    rng = np.random.default_rng(0)
+    runs = []
+    for _ in range(9):
+        onsets = synthetic.word_onsets(1500, 0., np.inf, rng) * 1000
+        missing = rng.choice(len(onsets), 5, replace=False)
+        runs.append((onsets.tolist(), np.delete(onsets, missing) + 5000 + rng.integers(0, 3, len(onsets) - 5)))
+    return lambda: [approx_match_samples(onsets, triggers, abs_tol=10, max_missing=5) for onsets, triggers in runs]
+
+
+def crop(study):
+    crop_runs = dag.load_script(ROOT / "02_data-preparation" / "crop_runs.py")
+    fif_file = study.acquisition_fname
+    return lambda: crop_runs.split_runs(fif_file, tempfile.mkdtemp(dir=study.root))
+
+
+def filter_maxwell(study):
+    fname = study.raw_fname
+
+    def run():
+        raw = mne.io.read_raw_fif(fname, verbose=False).load_data()
+        raw.filter(CONFIG["filter_low"], CONFIG["filter_high"], verbose=False)
+        noisy, flat = bads.find_bad_channels(raw)
+        raw.info["bads"] = noisy + flat
+        mne.preprocessing.maxwell_filter(raw, destination=raw.info["dev_head_t"], verbose=False)
+    return run
+
+
+def streaming_maxwell(study):
+    fname = study.raw_fname
+    return lambda: streaming_maxwell_filter(
+        mne.io.read_raw_fif(fname, verbose=False), study.root / "stream_raw_sss.fif",
+        CONFIG["filter_low"], CONFIG["filter_high"], max_memory_mb=200)
+
+
+def epoching_median(study):
+    study.words, study.sss_fname  # built before the timing
+    return lambda: evo_diff(study.epochs())
+
+
+def approximate_median(study):
+    study.words, study.sss_fname
+    return lambda: evo_diff(study.epochs(), approximate=True, max_memory_mb=64)
+
+
+def epoch_store(study):
+    """The medians, with the epochs written to a store along the way"""
+    study.words, study.sss_fname
+
+    def run():
+        epochs = study.epochs()
+        with epochstore.writer(study.root / "bench_epochs", epochs) as data:
+            return averaging.median_evokeds(epochs, dict(rare="is_rare", freq="~is_rare"), copy_to=data)
+    return run
+
+
+def contrast(study):
+    """The contrasts of config.yml, from the epoch store of the run"""
+    fname = study.epochs_fname
+    weights = contrasts.check_contrasts(CONFIG["contrasts"])
+    return lambda: contrasts.subject_contrasts([fname], weights, CONFIG.get("contrast_method", "median"))
+
+
+def covariance(study):
+    segments = study.segments()
+    return lambda: compute_segments_covariance(segments, method=["shrunk", "empirical"], rank="info")
+
+
+def inverse_operator(study):
+    fwd, noise_cov, evoked = study.fwd, study.noise_cov, study.evo_diff
+    inv_fname = study.root / "bench-inv.fif"
+
+    def run():
+        write_inverse_operator(inv_fname, make_inverse_operator(
+            evoked.info, fwd, noise_cov, loose=0.2, depth=0.8, rank="info", verbose=False),
+            overwrite=True, verbose=False)
+        inverse._KERNELS.clear()
+        return inverse.get_kernel(inv_fname, evoked.nave, LAMBDA2, store=False).apply_evoked(evoked)
+    return run
+
+
+def morphing(study):
+    stc = study.stc
+
+    def run():
+        morph._MORPHS.clear()
+        stc_morph = morph.get_morph(tempfile.mkdtemp(dir=study.root), study.subjects_dir, stc, "sub-01")
+        return morph.apply_morph(stc_morph, [stc])
+    return run
+
+
+CASES = dict(
+    matching=matching, crop=crop, maxwell=filter_maxwell, streaming_maxwell=streaming_maxwell,
+    epoching_median=epoching_median, approximate_median=approximate_median, epoch_store=epoch_store,
+    contrasts=contrast, covariance=covariance, inverse=inverse_operator, morph=morphing,
+)
+
+
+def machine(num_threads):
+    return dict(host=socket.gethostname(), machine=platform.machine(), python=platform.python_version(),
+                numpy=np.__version__, mne=mne.__version__, threads=num_threads)
+
+
+def time_case(name, func, repeat, log):
+    """Best wall time of repeat runs, with the CPU time and peak memory of that run"""
+    for k in range(repeat):
+        # without the progress messages of the scripts
+        with contextlib.redirect_stdout(io.StringIO()), telemetry.stage(name, run=k):
+            func()
+    records = [record for record in telemetry.read_log(log) if record["stage"] == name]
+    return min(records, key=lambda record: record["wall_s"])
+
+
+def compare(results, baselines, tolerance):
+    """Print the table of the cases against their baselines, and return the regressed ones"""
+    regressed = []
+    print(f"{'case':<20}{'time (s)':>10}{'baseline':>10}{'ratio':>8}{'cpu (s)':>10}{'peak (MB)':>11}")
+    for name, result in results.items():
+        baseline = baselines.get(name, {}).get("wall_s")
+        ratio = result["wall_s"] / baseline if baseline else float("nan")
+        slower = baseline is not None and ratio > 1 + tolerance and result["wall_s"] - baseline > MIN_REGRESSION_S
+        if slower:
+            regressed.append(name)
+        print(f"{name:<20}{result['wall_s']:>10.3f}{baseline if baseline is not None else float('nan'):>10.3f}"
+              f"{ratio:>8.2f}{result['cpu_s']:>10.2f}{result['peak_rss_mb']:>11.0f}{'  REGRESSION' if slower else ''}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the hot paths of the pipeline on synthetic data")
+    parser.add_argument("--only", nargs="+", choices=list(CASES), help="cases to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each case, the best one is kept")
+    parser.add_argument("--duration", type=float, default=60., help="duration (s) of the simulated run")
+    parser.add_argument("--threads", type=int, default=1, help="BLAS threads")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="slowdown allowed, relative to the baseline")
+    parser.add_argument("--baselines", type=Path, default=BASELINES, help="JSON file of the baselines")
+    parser.add_argument("--save", action="store_true", help="store the timings as the baselines")
+    args = parser.parse_args()
+
+    set_num_threads(args.threads)
+    mne.set_log_level("ERROR")
+    # no shared cache of the word frequencies: the benchmark leaves nothing behind
+    lexicon.set_cache_file(None)
+    stored = json.loads(args.baselines.read_text()) if args.baselines.exists() else dict(cases={})
+    if stored.get("machine", {}) and {k: v for k, v in stored["machine"].items() if k != "date"} != machine(args.threads):
+        print(f"The baselines come from another setup ({stored['machine']}): the ratios may not be meaningful")
+
+    root = Path(tempfile.mkdtemp(prefix="benchmark-"))
+    log = root / "telemetry.jsonl"
+    # not configure(), which would keep a PIPELINE_TELEMETRY log already set in the environment
+    os.environ[telemetry.LOG_VAR] = str(log)
+    try:
+        study = Study(root, args.duration)
+        results = {}
+        for name in args.only or CASES:
+            start = time.perf_counter()
+            func = CASES[name](study)
+            print(f"{name}: inputs ready in {time.perf_counter() - start:.1f} s", flush=True)
+            results[name] = time_case(name, func, args.repeat, log)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    regressed = compare(results, stored["cases"], args.tolerance)
+    if args.save:
+        stored["cases"].update({name: {k: result[k] for k in ["wall_s", "cpu_s", "peak_rss_mb"]}
+                                for name, result in results.items()})
+        stored["machine"] = dict(machine(args.threads), date=time.strftime("%Y-%m-%d"))
+        args.baselines.write_text(json.dumps(stored, indent=2) + "\n")
+        print(f"Baselines saved to {args.baselines}")
+    elif regressed:
+        print(f"Slower than the baselines by more than {args.tolerance:.0%}: {regressed}")
+        sys.exit(1)
+    elif not stored["cases"]:
+        print(f"No baselines yet: run with --save to store them in {args.baselines}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Runtime and agreement of the fast bad channel detection against find_bad_channels_maxwell on the full runs"""
+
+import os, sys, time, yaml
+from pathlib import Path
+import mne
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils import bads
+
+# Load configuration file
+with open("config.yml", "r") as f:
+    config = yaml.safe_load(f)
+
+NUM_THREADS = str(config["num_threads"])
+os.environ["OMP_NUM_THREADS"] = NUM_THREADS
+os.environ["OPENBLAS_NUM_THREADS"] = NUM_THREADS
+os.environ["MKL_NUM_THREADS"] = NUM_THREADS
+
+TASK = config["task"]
+SESSION = config["session"]
+MEG_DIR = config["meg_dir"]
+RUNS = config["runs"]
+
+BASE_PATH = Path(config["base_path"])
+SUBJECTS_DIR = BASE_PATH / config["subjects_dir"]
+CROSS_TALK_FILE = BASE_PATH / config["cross_talk_file"]
+CALIBRATION_FILE = BASE_PATH / config["calibration_file"]
+FILTER_LOW = config["filter_low"]
+FILTER_HIGH = config["filter_high"]
+
+SPECIFIC_SUBJECTS = config.get("subjects", None)
+if isinstance(SPECIFIC_SUBJECTS, str):
+    SPECIFIC_SUBJECTS = [SPECIFIC_SUBJECTS]
+
+# (bads_every, bads_decim) settings compared to the full-data call
+SETTINGS = [(1, 5), (1, 10), (2, 5), (4, 5), (4, 10)]
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    out = func(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+rows = []
+for SUBJECT in SPECIFIC_SUBJECTS:
+    SUBJECT = SUBJECT.strip()
+    for run in RUNS:
+        raw_fname = SUBJECTS_DIR / f"{SUBJECT}/{MEG_DIR}/{SUBJECT}_{SESSION}task-{TASK}_run-0{run}_meg.fif"
+        raw = mne.io.read_raw_fif(raw_fname, allow_maxshield=True, verbose=False)
+        raw.load_data().filter(FILTER_LOW, FILTER_HIGH, verbose=False)
+        kwargs = dict(cross_talk=CROSS_TALK_FILE, calibration=CALIBRATION_FILE)
+
+        (noisy, flat), full_time = timed(bads.find_bad_channels, raw, **kwargs)
+        reference = set(noisy + flat)
+        for every, decim in SETTINGS:
+            (noisy, flat), fast_time = timed(bads.find_bad_channels, raw, every=every, decim=decim, **kwargs)
+            found = set(noisy + flat)
+            union = reference | found
+            rows.append(dict(
+                subject=SUBJECT, run=run, every=every, decim=decim,
+                speedup=full_time / fast_time,
+                jaccard=len(reference & found) / len(union) if union else 1.0,
+                missed=sorted(reference - found), extra=sorted(found - reference),
+            ))
+            print(f"{SUBJECT} run {run} every={every} decim={decim}: {full_time:.1f} s -> {fast_time:.1f} s, "
+                  f"missed {rows[-1]['missed']}, extra {rows[-1]['extra']}")
+
+print("\nSummary (median speedup, mean Jaccard agreement with the full-data call)")
+for every, decim in SETTINGS:
+    sub = [row for row in rows if row["every"] == every and row["decim"] == decim]
+    speedups = sorted(row["speedup"] for row in sub)
+    jaccard = sum(row["jaccard"] for row in sub) / len(sub)
+    print(f"every={every} decim={decim}: x{speedups[len(speedups) // 2]:.1f}, agreement {jaccard:.3f}")
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""Check of 05_anat-preprocessing/03_bem.py with stubs in place of the FreeSurfer binaries
+
+mri_watershed and mkheadsurf are replaced by scripts writing nested spheres,
+in a temporary FreeSurfer home and subjects folder, with their own config.yml.
+One subject fails once (retried), one has no T1 (fails every attempt). A
+second run must skip the finished subjects, and a third one only redo the
+subject whose surface was modified.
+"""
+
+import os, sys, subprocess, tempfile, textwrap, yaml
+from pathlib import Path
+import nibabel as nib
+import numpy as np
+
+BEM_SCRIPT = Path(__file__).resolve().parents[1] / "05_anat-preprocessing" / "03_bem.py"
+
+STUB = """#!{python}
+import os, sys
+from pathlib import Path
+import nibabel as nib
+from mne.surface import _get_ico_surface
+
+log = Path(os.environ["STUB_LOG"])
+with open(log, "a") as f:
+    f.write(f"{{os.environ['SUBJECT']}} {{Path(sys.argv[0]).name}}\\n")
+
+def write_sphere(fname, radius, grade):
+    ico = _get_ico_surface(grade)
+    # volume info of the surfaces written by FreeSurfer
+    volume_info = dict(head=[2, 0, 20], valid="1  # volume info valid", filename="T1.mgz", volume=[16, 16, 16],
+                       voxelsize=[1., 1., 1.], xras=[-1., 0., 0.], yras=[0., 0., 1.], zras=[0., -1., 0.],
+                       cras=[0., 0., 0.])
+    nib.freesurfer.write_geometry(fname, ico["rr"] * radius, ico["tris"], volume_info=volume_info)
+"""
+
+WATERSHED = STUB + """
+# fails on the first call for the subjects listed in STUB_FAIL_ONCE
+flag = log.with_name(f"failed-{{os.environ['SUBJECT']}}")
+if os.environ["SUBJECT"] in os.environ.get("STUB_FAIL_ONCE", "").split() and not flag.exists():
+    flag.touch()
+    sys.exit("mri_watershed: simulated failure")
+prefix = sys.argv[sys.argv.index("-surf") + 1]
+for surf, radius in [("brain", 70), ("inner_skull", 75), ("outer_skull", 80), ("outer_skin", 90)]:
+    write_sphere(f"{{prefix}}_{{surf}}_surface", radius, 4)
+"""
+
+MKHEADSURF = STUB + """
+subject_dir = Path(os.environ["SUBJECTS_DIR"]) / os.environ["SUBJECT"]
+(subject_dir / "surf").mkdir(exist_ok=True)
+write_sphere(subject_dir / "surf" / "lh.seghead", 92, 6)
+"""
+
+def write_stub(fname, source):
+    fname.write_text(source.format(python=sys.executable))
+    fname.chmod(0o755)
+
+def run_bem(tmp, env, subjects):
+    config = dict(base_path=str(tmp), freesurfer_dir="freesurfer", num_threads=1, bem_workers=2, bem_retries=1,
+                  subjects=subjects)
+    (tmp / "config.yml").write_text(yaml.safe_dump(config))
+    (tmp / "stub.log").write_text("")
+    result = subprocess.run([sys.executable, str(BEM_SCRIPT)], cwd=tmp, env=env, capture_output=True, text=True)
+    print(textwrap.indent(result.stdout, "    "))
+    calls = (tmp / "stub.log").read_text().split()
+    return result.returncode, sorted(set(calls[::2]))
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        fs_home, subjects_dir = tmp / "freesurfer_home", tmp / "freesurfer"
+        (fs_home / "bin").mkdir(parents=True)
+        write_stub(fs_home / "bin" / "mri_watershed", WATERSHED)
+        write_stub(fs_home / "bin" / "mkheadsurf", MKHEADSURF)
+        for subject in ["sub-01", "sub-02", "sub-03"]:
+            (subjects_dir / subject / "mri").mkdir(parents=True)
+        for subject in ["sub-01", "sub-02"]:
+            volume = nib.MGHImage(np.zeros((16, 16, 16), np.uint8), np.eye(4))
+            nib.save(volume, subjects_dir / subject / "mri" / "T1.mgz")
+
+        env = dict(os.environ, FREESURFER_HOME=str(fs_home), PATH=f"{fs_home / 'bin'}{os.pathsep}{os.environ['PATH']}",
+                   STUB_LOG=str(tmp / "stub.log"), STUB_FAIL_ONCE="sub-02", MNE_LOGGING_LEVEL="warning")
+
+        print("First run (sub-02 fails once, sub-03 has no T1):")
+        returncode, _ = run_bem(tmp, env, [])
+        assert returncode == 1, "sub-03 should make the run fail"
+        assert (tmp / "failed-sub-02").exists(), "sub-02 should have failed once"
+        for subject in ["sub-01", "sub-02"]:
+            assert (subjects_dir / subject / "bem" / f"{subject}-bem-done.json").exists(), subject
+        assert not (subjects_dir / "sub-03" / "bem" / "sub-03-bem-done.json").exists()
+
+        print("Second run (nothing to do):")
+        returncode, processed = run_bem(tmp, env, ["sub-01", "sub-02"])
+        assert returncode == 0 and processed == [], processed
+
+        print("Third run (a surface of sub-01 modified):")
+        with open(subjects_dir / "sub-01" / "bem" / "inner_skull.surf", "ab") as f:
+            f.write(b"\0")
+        returncode, processed = run_bem(tmp, env, ["sub-01", "sub-02"])
+        assert returncode == 0 and processed == ["sub-01"], processed
+    print("OK")
+
+if __name__ == "__main__":
+    main()
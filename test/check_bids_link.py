@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Check of the bids_link modes of 03_bids-conversion/formatting_distraction.py
+
+A synthetic cropped run (see synthetic.py) and its metadata are converted by
+the script, in a temporary dataset with its own config.yml, with each bids_link
+mode. The datasets must hold the same files as with "copy", with the same
+sidecars and events, and the same recording read back by mne-bids. The
+_meg.fif must be a hardlink, a symbolic link or a copy of the cropped run as
+asked, except reflink which falls back to a copy on the filesystems without
+it. A hardlink across filesystems (the cropped runs on /dev/shm, if it is
+another filesystem) must also fall back to a copy. The BIDS validator must
+pass if it is installed, and the script must warn that it was not run if not.
+"""
+
+import os, re, shutil, subprocess, sys, tempfile, textwrap, yaml
+from pathlib import Path
+import mne
+import numpy as np
+from mne_bids import BIDSPath, read_raw_bids
+
+import synthetic
+
+SCRIPT = Path(__file__).resolve().parents[1] / "03_bids-conversion" / "formatting_distraction.py"
+NIP, SUB, RUN = "fa_123456", "1", 1
+OTHER_FILESYSTEM = Path("/dev/shm")
+
+
+def convert(base_path, mode, raw_fname, metadata, cropped_dir=None):
+    """Dataset of the run converted by the script with bids_link: mode, and the output of the script
+
+    The cropped runs are in cropped_dir (e.g. on another filesystem) if given.
+    """
+    cropped = base_path / "raw" / NIP / "cropped_runs"
+    cropped.parent.mkdir(parents=True)
+    if cropped_dir is not None:
+        cropped.symlink_to(cropped_dir)
+    else:
+        cropped.mkdir()
+    shutil.copyfile(raw_fname, cropped / f"run_{RUN:02d}.fif")
+    config = dict(study="study", task="distraction", session="01", meg_dir="meg", base_path=str(base_path),
+                  bids_dir="bids", metadata=str(metadata), runs=[RUN], n_workers=1, bids_link=mode)
+    (base_path / "config.yml").write_text(yaml.safe_dump(config))
+    result = subprocess.run([sys.executable, str(SCRIPT)], cwd=base_path, capture_output=True, text=True)
+    output = result.stdout + result.stderr
+    print(textwrap.indent(output[-2000:], "    "))
+    assert result.returncode == 0, mode
+    return base_path / "bids", cropped / f"run_{RUN:02d}.fif", output
+
+
+def files(bids_root):
+    return sorted(str(path.relative_to(bids_root)) for path in bids_root.rglob("*") if not path.is_dir())
+
+
+def main():
+    mne.set_log_level("ERROR")
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        raw, words = synthetic.simulate_run(20.)
+        raw_fname = tmp / "cropped" / "run.fif"
+        raw_fname.parent.mkdir()
+        raw.save(raw_fname)
+        metadata = tmp / "metadata"
+        metadata.mkdir()
+        synthetic.write_events_tsv(words, metadata / f"task-distraction_run-{RUN:02d}_extra_info.csv")
+
+        modes = [("copy", "copy"), ("hardlink", "hardlink"), ("symlink", "symlink"), ("reflink", "reflink")]
+        other = None
+        if OTHER_FILESYSTEM.is_dir() and os.stat(OTHER_FILESYSTEM).st_dev != os.stat(tmp).st_dev:
+            other = Path(tempfile.mkdtemp(dir=OTHER_FILESYSTEM))
+            modes.append(("hardlink", "hardlink across filesystems"))
+        else:
+            print(f"{OTHER_FILESYSTEM} is not another filesystem: the fallback across filesystems is not checked")
+
+        try:
+            datasets = {}
+            for mode, label in modes:
+                print(f"{label}:")
+                cropped_dir = other if label.endswith("filesystems") else None
+                datasets[label] = convert(tmp / label.replace(" ", "_"), mode, raw_fname, metadata, cropped_dir)
+
+            reference_root, _, _ = datasets["copy"]
+            bids_path = BIDSPath(subject=SUB, session="01", task="distraction", run=RUN, datatype="meg")
+            reference = read_raw_bids(bids_path.copy().update(root=reference_root))
+            for (mode, label), (bids_root, cropped, output) in zip(modes, datasets.values()):
+                assert files(bids_root) == files(reference_root), (label, files(bids_root))
+                for name in files(reference_root):
+                    # the manifest of the conversions holds the paths of the dataset
+                    if not name.endswith(".fif") and name != ".conversions.json":
+                        assert (bids_root / name).read_bytes() == (reference_root / name).read_bytes(), (label, name)
+                converted = read_raw_bids(bids_path.copy().update(root=bids_root))
+                assert converted.ch_names == reference.ch_names and np.array_equal(
+                    converted.get_data(), reference.get_data()), label
+                assert len(converted.annotations) == len(reference.annotations), label
+
+                # how the _meg.fif was placed (see place_fif)
+                meg_fif = bids_path.copy().update(root=bids_root, suffix="meg", extension=".fif").fpath
+                fallback = re.search(r"placed by (\w+)", output)
+                placed = fallback.group(1) if fallback else mode
+                if label.endswith("filesystems"):
+                    assert placed in ["reflink", "copy"], (label, placed)
+                if placed == "hardlink":
+                    assert not meg_fif.is_symlink() and os.path.samefile(meg_fif, cropped), label
+                elif placed == "symlink":
+                    assert meg_fif.is_symlink() and os.path.samefile(meg_fif, cropped), label
+                elif mode != "copy":
+                    assert not meg_fif.is_symlink() and not os.path.samefile(meg_fif, cropped), label
+                    assert meg_fif.read_bytes() == cropped.read_bytes(), label
+                if "bids-validator not found" in output:
+                    print(f"{label}: placed by {placed}, bids-validator not installed (warned)")
+                else:
+                    assert "BIDS validator passed" in output, label
+                    print(f"{label}: placed by {placed}, BIDS validator passed")
+        finally:
+            if other is not None:
+                shutil.rmtree(other)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Check of the batch mode of 05_anat-preprocessing/04_coreg.py on synthetic subjects
+
+Each subject has a spherical head (and an identity talairach.xfm, so that the
+fiducials of fsaverage are used as is), and a middle run whose head shape
+points lie on the sphere, in a shifted head frame. The points of sub-02 are
+scaled up, so that its fit must be queued for review instead of accepted. A
+second run must skip sub-01, whose transform exists, and refit sub-02 only.
+"""
+
+import subprocess, sys, tempfile, textwrap, yaml
+from pathlib import Path
+import mne
+import nibabel as nib
+import numpy as np
+import pandas as pd
+from mne.io.constants import FIFF
+from mne.surface import _get_ico_surface
+
+COREG_SCRIPT = Path(__file__).resolve().parents[1] / "05_anat-preprocessing" / "04_coreg.py"
+TASK, MIDDLE_RUN, RADIUS = "read", "run-14", 0.092
+# the folders of utils/config.py, relative to the temporary base_path
+CONFIG = dict(study="study", task=TASK, session="", meg_dir="meg", middle_run=MIDDLE_RUN, bids_dir="bids",
+              freesurfer_dir="freesurfer")
+
+def make_subject(base_path, subject, scale):
+    subject_dir = base_path / "freesurfer" / subject
+    (subject_dir / "bem").mkdir(parents=True)
+    (subject_dir / "mri" / "transforms").mkdir(parents=True)
+    nib.save(nib.MGHImage(np.zeros((16, 16, 16), np.uint8), np.eye(4)), subject_dir / "mri" / "T1.mgz")
+    (subject_dir / "mri" / "transforms" / "talairach.xfm").write_text(
+        "MNI Transform File\n\nTransform_Type = Linear;\nLinear_Transform =\n"
+        "1 0 0 0\n0 1 0 0\n0 0 1 0;\n")
+    for name, grade in [("head", 3), ("head-dense", 5)]:
+        ico = _get_ico_surface(grade)
+        surf = dict(rr=ico["rr"] * RADIUS, tris=ico["tris"], id=FIFF.FIFFV_BEM_SURF_ID_HEAD, sigma=1.,
+                    coord_frame=FIFF.FIFFV_COORD_MRI, np=len(ico["rr"]), ntri=len(ico["tris"]))
+        mne.write_bem_surfaces(subject_dir / "bem" / f"{subject}-{name}.fif", [surf], overwrite=True)
+
+    # fiducials of fsaverage, and head shape points on the upper half of the sphere
+    fids = {fid["ident"]: fid["r"] for fid in mne.coreg.get_mni_fiducials(
+        subject, base_path / "freesurfer")}
+    rng = np.random.default_rng(0)
+    hsp = rng.normal(size=(200, 3))
+    hsp[:, 2] = np.abs(hsp[:, 2])
+    hsp = hsp / np.linalg.norm(hsp, axis=1, keepdims=True) * RADIUS * scale
+    shift = np.array([0.003, -0.005, 0.01])
+    montage = mne.channels.make_dig_montage(
+        nasion=fids[FIFF.FIFFV_POINT_NASION] + shift, lpa=fids[FIFF.FIFFV_POINT_LPA] + shift,
+        rpa=fids[FIFF.FIFFV_POINT_RPA] + shift, hsp=hsp + shift, coord_frame="unknown")
+    info = mne.create_info(["MISC001"], 1000., "misc")
+    info.set_montage(montage)
+    raw = mne.io.RawArray(np.zeros((1, 1000)), info, verbose=False)
+    fname = base_path / "bids" / subject / "meg" / f"{subject}_task-{TASK}_{MIDDLE_RUN}_meg.fif"
+    fname.parent.mkdir(parents=True)
+    raw.save(fname, verbose=False)
+
+def run_batch(base_path):
+    (base_path / "config.yml").write_text(yaml.safe_dump(dict(CONFIG, base_path=str(base_path))))
+    result = subprocess.run(
+        [sys.executable, str(COREG_SCRIPT), "--batch", "--n-workers", "2"], cwd=base_path, capture_output=True, text=True)
+    print(textwrap.indent(result.stdout + result.stderr[-2000:], "    "))
+    assert result.returncode == 0
+    return result.stdout
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        base_path = Path(tmp)
+        make_subject(base_path, "sub-01", scale=1.0)
+        make_subject(base_path, "sub-02", scale=1.3)
+        output_dir = base_path / "study" / "derivatives" / "preprocessed_data"
+
+        print("First run:")
+        run_batch(base_path)
+        assert (output_dir / "sub-01" / f"sub-01_task-{TASK}_{MIDDLE_RUN}_meg_trans.fif").exists()
+        assert not (output_dir / "sub-02" / f"sub-02_task-{TASK}_{MIDDLE_RUN}_meg_trans.fif").exists()
+        assert (output_dir / "sub-02" / f"sub-02_task-{TASK}_{MIDDLE_RUN}_meg_candidate-trans.fif").exists()
+        queue = pd.read_csv(output_dir / f"coreg_review_task-{TASK}.tsv", sep="\t")
+        assert queue["subject"].tolist() == ["sub-02"] and queue["status"].tolist() == ["review"], queue
+
+        print("Second run (sub-01 has its transform):")
+        stdout = run_batch(base_path)
+        assert "Skipping" in stdout and "sub-01" not in stdout.split("Skipping")[-1], stdout
+        queue = pd.read_csv(output_dir / f"coreg_review_task-{TASK}.tsv", sep="\t")
+        assert queue["subject"].tolist() == ["sub-02"], queue
+    print("OK")
+
+if __name__ == "__main__":
+    main()
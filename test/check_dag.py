@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Checks of the executor of utils/dag.py
+
+- when a worker crashes: two workers run a graph where the task of s2 kills
+  its worker (like the out of memory killer would) while the task of s1 runs
+  beside it. Both are interrupted: s1 must be run again alone and succeed,
+  with its dependents, while s2 must fail and only its dependent be skipped.
+- when a task starts its own pool: like the report of 04_make_report.py, a
+  task of a loaded script renders report sections (utils/report.py) in a
+  pool of spawned processes, which must all render.
+"""
+
+import os, sys, tempfile, textwrap, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils import dag
+
+TASKS = """
+import os, time
+
+def ok(*args):
+    time.sleep(5)
+
+def crash(*args):
+    time.sleep(1)
+    os._exit(1)
+"""
+
+REPORT = """
+import sys
+from pathlib import Path
+import mne
+
+sys.path.insert(0, {root!r})
+sys.path.insert(0, {test!r})
+from utils.report import Section, assemble, render_evoked, render_sections
+import synthetic
+
+def report(tmp):
+    tmp = Path(tmp)
+    raw, _ = synthetic.simulate_run(10.)
+    raw.pick("mag")
+    fname = tmp / "evoked-ave.fif"
+    mne.write_evokeds(fname, mne.EvokedArray(raw.get_data()[:, :600], raw.info, tmin=-0.1))
+    sections = [Section(f"section-{{k}}", render_evoked, [fname], dict(
+        fname=str(fname), title=f"Section {{k}}", plot_title="Synthetic", times=[0.1, 0.2])) for k in range(2)]
+    failed = render_sections(sections, tmp / "sections", n_workers=2)
+    if failed:
+        raise RuntimeError(f"Sections not rendered: {{failed}}")
+    assemble("Check", sections, tmp / "sections", tmp / "report.html")
+"""
+
+
+def check_crash():
+    with tempfile.TemporaryDirectory() as tmp:
+        script = str(Path(tmp) / "tasks.py")
+        Path(script).write_text(textwrap.dedent(TASKS))
+        tasks = [
+            dag.Task("a", "s1", None, script, "ok"),
+            dag.Task("a", "s2", None, script, "crash"),
+            dag.Task("b", "s1", None, script, "ok", deps=["a/s1"]),
+            dag.Task("b", "s2", None, script, "ok", deps=["a/s2"]),
+            dag.Task("group", None, None, script, "ok", deps=["b/s1"], collect=True),
+        ]
+        start = time.perf_counter()
+        status = dag.run(tasks, n_workers=2, num_threads=1)
+        print(f"{status} ({time.perf_counter() - start:.0f} s)")
+    assert status == {"a/s1": "done", "a/s2": "failed", "b/s1": "done", "b/s2": "skipped", "group": "done"}, status
+
+
+def check_nested_pool():
+    test = Path(__file__).resolve().parent
+    with tempfile.TemporaryDirectory() as tmp:
+        script = str(Path(tmp) / "report.py")
+        Path(script).write_text(REPORT.format(root=str(test.parent), test=str(test)))
+        status = dag.run([dag.Task("report", None, None, script, "report", (tmp,))], n_workers=1, num_threads=1)
+        print(status)
+        assert status == {"report": "done"}, status
+        assert (Path(tmp) / "report.html").exists()
+
+
+def main():
+    check_crash()
+    check_nested_pool()
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Check of the epoch stores (utils/epochstore.py) and of the contrasts computed from them (utils/contrasts.py)
+
+On a synthetic run (see synthetic.py), the store written while the medians are
+computed must hold the epochs (up to float32 rounding) and their metadata,
+without changing the medians. The mean and median evoked responses of a
+metadata query, and a weighted contrast of two queries, must match those of
+the loaded epochs. A run where a query matches no epoch is left out of its
+contrast, unless no run matches. A store whose writing fails leaves nothing
+behind.
+"""
+
+import sys, tempfile, time
+from pathlib import Path
+import mne
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils import contrasts, epochstore
+from utils.averaging import data_picks, median_evokeds
+
+import synthetic
+
+CONDITIONS = dict(rare="is_rare", freq="~is_rare")
+CONTRASTS = dict(rare_minus_frequent={"is_rare": 1., "~is_rare": -1.}, long_words={"length >= 6": 1.})
+# Maximum difference from the float64 epochs, relative to their largest value
+RTOL = 1e-6
+
+
+def make_epochs(fname, words):
+    raw = mne.io.read_raw_fif(fname, verbose=False)
+    triggers = mne.find_stim_steps(raw, stim_channel="STI008")
+    triggers = triggers[triggers[:, 2] == 0]
+    words = words.iloc[:len(triggers)].copy()
+    words["is_rare"] = np.arange(len(words)) % 3 == 0
+    words["length"] = words.word.str.len()
+    words["position"] = np.arange(len(words))
+    events = np.c_[triggers[:, 0], np.ones(len(triggers), int), np.arange(len(triggers))]
+    return mne.Epochs(raw, events, tmin=-0.5, tmax=0.8, baseline=(-0.5, 0), metadata=words, verbose=False)
+
+
+def assert_close(actual, expected, scale, what):
+    error = np.abs(actual - expected).max() / scale
+    print(f"    {what}: {error:.2e} of the largest value")
+    assert error < RTOL, what
+
+
+def main():
+    mne.set_log_level("ERROR")
+    with tempfile.TemporaryDirectory() as tmp:
+        raw, words = synthetic.simulate_run(60., n_missing=0)
+        fname = Path(tmp) / "run_raw.fif"
+        raw.save(fname)
+        del raw
+
+        reference = median_evokeds(make_epochs(fname, words), CONDITIONS)
+        store_fname = Path(tmp) / "run_epochs"
+        start = time.perf_counter()
+        epochs = make_epochs(fname, words)
+        with epochstore.writer(store_fname, epochs) as data:
+            evokeds = median_evokeds(epochs, CONDITIONS, copy_to=data)
+        print(f"Medians with the store written along the way: {time.perf_counter() - start:.2f} s")
+        for name, evoked in evokeds.items():
+            np.testing.assert_array_equal(evoked.data, reference[name].data)
+
+        loaded = make_epochs(fname, words).load_data()
+        expected = loaded.get_data(picks=data_picks(loaded.info))
+        scale = np.abs(expected).max()
+        store = epochstore.EpochStore(store_fname)
+        assert store.data.dtype == epochstore.DTYPE and len(store) == len(loaded)
+        assert store.info.ch_names == [loaded.ch_names[k] for k in data_picks(loaded.info)]
+        assert store.metadata.word.tolist() == loaded.metadata.word.tolist()
+        assert store.metadata.is_rare.tolist() == loaded.metadata.is_rare.tolist()
+        print(f"Store of {len(store)} epochs:")
+        assert_close(store.data, expected, scale, "data")
+
+        epochstore.write(Path(tmp) / "written", make_epochs(fname, words), max_memory_mb=20)
+        np.testing.assert_array_equal(np.load(Path(tmp) / "written/data.npy"), store.data)
+
+        for method in ["mean", "median"]:
+            evoked = store.evoked("length >= 6", method, max_memory_mb=5)
+            subset = loaded["length >= 6"]
+            assert evoked.nave == len(subset) and evoked.baseline == subset.average().baseline
+            np.testing.assert_allclose(evoked.times, loaded.times)
+            assert_close(evoked.data, subset.average(method=method).data, scale, f"{method} of length >= 6")
+
+        results = contrasts.subject_contrasts([store_fname, store_fname], CONTRASTS, "median")
+        assert_close(results["rare_minus_frequent"].data, reference["rare"].data - reference["freq"].data, scale,
+                     "rare - frequent contrast of two runs")
+        assert results["rare_minus_frequent"].comment == "rare_minus_frequent"
+
+        # a short run without late words is left out of their contrast
+        short_fname = Path(tmp) / "short_epochs"
+        epochstore.write(short_fname, make_epochs(fname, words)[:10])
+        late = dict(late_words={"position >= 10": 1.})
+        results = contrasts.subject_contrasts([store_fname, short_fname], late, "mean")
+        assert_close(results["late_words"].data, store.evoked("position >= 10", "mean").data, scale,
+                     "contrast of the only run with late words")
+        try:
+            contrasts.subject_contrasts([short_fname], late, "mean")
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("a contrast matching no run did not fail")
+
+        failed = Path(tmp) / "failed"
+        try:
+            with epochstore.writer(failed, make_epochs(fname, words)):
+                raise RuntimeError("crash")
+        except RuntimeError:
+            pass
+        assert not list(Path(tmp).glob("failed*")), "partial store left behind"
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
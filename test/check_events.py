@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""Check that a cached read of utils/events.py gives the same table as a fresh read
+
+The events file has a trial_type whose dicts hold a boolean with missing
+values, a column mixing ints, floats and strings, a None, an entry which is
+not a dict, and a text column with a missing value. The second read comes
+from the cache (in its own directory, not next to the file), and so does a
+third one after the file was touched.
+"""
+
+import os, sys, tempfile
+from pathlib import Path
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils.events import cache_file, read_events, set_cache_dir
+
+ROWS = [
+    dict(onset=0.1, trial_type=repr(dict(word="le", is_last=True, value=1))),
+    dict(onset=0.2, trial_type=repr(dict(word="chat", is_last=False, value="a"))),
+    dict(onset=0.3, trial_type="n/a"),
+    dict(onset=0.4, trial_type=repr(dict(word="dort", is_last=True, value=2.5, extra=None))),
+]
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = Path(tmp) / "sub-1_task-distraction_run-01_events.tsv"
+        pd.DataFrame(ROWS).assign(note=["x", None, "z", "w"]).to_csv(fname, sep="\t", index=False)
+        set_cache_dir(Path(tmp) / "cache")
+
+        fresh = read_events(fname, cache=False)
+        first = read_events(fname)
+        assert cache_file(fname).exists() and cache_file(fname).parent == Path(tmp) / "cache"
+        assert sorted(path.name for path in Path(tmp).iterdir()) == ["cache", fname.name]  # nothing next to it
+        cached = read_events(fname)
+        os.utime(fname)
+        touched = read_events(fname)
+        for name, events in [("first", first), ("cached", cached), ("touched", touched)]:
+            print(f"{name}: {dict(events.dtypes.astype(str))}")
+            pd.testing.assert_frame_equal(events, fresh)
+            assert events.equals(fresh), name
+        # not the strings "True" and "False"
+        assert cached["is_last"].tolist()[:2] == [True, False] and pd.isna(cached["is_last"][2])
+        assert cached["value"].tolist()[:2] == [1, "a"]
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
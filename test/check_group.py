@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""Check of the group average of utils/group.py against the stacked computation
+
+Random estimates on the same vertices (with an offset, as the sums of squares
+are sensitive to it) are averaged by a GroupAccumulator, with the "max" and
+"none" normalizations. The mean must be np.mean of the stacked estimates (each
+divided by its maximum for "max"), and the variance np.var(..., ddof=1), up to
+MAX_RELATIVE_ERROR of their largest value. An accumulator saved after some
+subjects and loaded again to add the others must give the same result, and it
+must tell which subjects were added from their current file.
+"""
+
+import sys, tempfile
+from pathlib import Path
+import mne
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils.group import GroupAccumulator
+
+N_SUBJECTS, N_VERTICES, N_TIMES = 6, 300, 50
+MAX_RELATIVE_ERROR = 1e-10
+
+
+def relative_error(data, reference):
+    return np.abs(data - reference).max() / np.abs(reference).max()
+
+
+def compare(acc, stacked, label):
+    for name, data, reference in [("mean", acc.mean().data, stacked.mean(0)),
+                                  ("variance", acc.variance().data, stacked.var(0, ddof=1))]:
+        error = relative_error(data, reference)
+        print(f"{label}, {name}: relative error {error:.1e}")
+        assert error <= MAX_RELATIVE_ERROR, error
+
+
+def main():
+    mne.set_log_level("ERROR")
+    rng = np.random.default_rng(0)
+    vertices = [np.arange(N_VERTICES // 2), np.arange(N_VERTICES // 2)]
+    stcs = [mne.SourceEstimate(rng.uniform(1., 2.) * (5. + rng.standard_normal((N_VERTICES, N_TIMES))), vertices,
+                               tmin=-0.1, tstep=0.01, subject="fsaverage") for _ in range(N_SUBJECTS)]
+    with tempfile.TemporaryDirectory() as tmp:
+        fnames = {}
+        for k, stc in enumerate(stcs):
+            fnames[f"sub-{k:02d}"] = Path(tmp) / f"sub-{k:02d}-stc.h5"
+            stc.save(fnames[f"sub-{k:02d}"], ftype="h5")
+
+        for normalization, normalize in [("max", lambda data: data / np.max(data)), ("none", lambda data: data)]:
+            stacked = np.stack([normalize(stc.data) for stc in stcs])
+            acc = GroupAccumulator(normalization)
+            for (subject, fname), stc in zip(fnames.items(), stcs):
+                acc.add(subject, stc, fname)
+            compare(acc, stacked, f"{normalization}, all subjects")
+            mean = acc.mean()
+            assert all(np.array_equal(a, b) for a, b in zip(mean.vertices, vertices))
+            assert (mean.tmin, mean.tstep, mean.subject) == (-0.1, 0.01, "fsaverage")
+
+            # the first half, saved then resumed with the second half
+            acc = GroupAccumulator(normalization)
+            for (subject, fname), stc in list(zip(fnames.items(), stcs))[:N_SUBJECTS // 2]:
+                acc.add(subject, stc, fname)
+            acc.save(Path(tmp) / "accumulator.npz")
+            acc = GroupAccumulator.load(Path(tmp) / "accumulator.npz")
+            assert acc.normalization == normalization and acc.n == N_SUBJECTS // 2
+            for (subject, fname), stc in list(zip(fnames.items(), stcs))[N_SUBJECTS // 2:]:
+                acc.add(subject, stc, fname)
+            compare(acc, stacked, f"{normalization}, resumed")
+
+        # the subjects added, from their current file
+        assert all(acc.up_to_date(subject, fname) for subject, fname in fnames.items())
+        (stcs[0] * 2).save(fnames["sub-00"], ftype="h5", overwrite=True)
+        assert not acc.up_to_date("sub-00", fnames["sub-00"])
+        try:
+            acc.add("sub-01", stcs[1])
+        except ValueError as e:
+            print(f"subject added twice refused: {e}")
+        else:
+            raise AssertionError("subject added twice")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
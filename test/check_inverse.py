@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Check of the imaging kernels of utils/inverse.py against apply_inverse and apply_inverse_epochs
+
+On a synthetic run (see synthetic.py) and spherical anatomy, the estimates of
+the stored kernel must be those of apply_inverse for an evoked response (free
+and normal orientations, dSPM and MNE), and those of apply_inverse_epochs for
+the epochs of the run, up to MAX_RELATIVE_ERROR of their largest value. A kernel
+read back from disk must give the same estimates, and epochs must be refused a
+kernel which was not prepared for nave=1.
+"""
+
+import sys, tempfile
+from pathlib import Path
+import mne
+import numpy as np
+from mne.minimum_norm import (apply_inverse, apply_inverse_epochs, make_inverse_operator, read_inverse_operator,
+                              write_inverse_operator)
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils import anatomy, inverse
+
+import synthetic
+
+SPACING, ICO, LAMBDA2 = "oct5", 4, 1. / 9
+MAX_RELATIVE_ERROR = 1e-10
+
+
+def relative_error(data, reference):
+    return np.abs(data - reference).max() / np.abs(reference).max()
+
+
+def make_inverse(tmp, raw, info):
+    """Inverse operator of the run, on a spherical anatomy, written to tmp and read back (as the kernels)"""
+    subjects_dir = Path(tmp) / "freesurfer"
+    synthetic.make_anatomy(subjects_dir, "sub-01")
+    src = anatomy.source_space(Path(tmp) / "anatomy", subjects_dir, "sub-01", spacing=SPACING)
+    bem_sol = anatomy.bem_solution(Path(tmp) / "anatomy", subjects_dir, "sub-01", ico=ICO)
+    fwd = mne.make_forward_solution(info, trans=mne.transforms.Transform("head", "mri", np.eye(4)), src=src,
+                                    bem=bem_sol, eeg=False, mindist=5.0)
+    noise_cov = mne.compute_raw_covariance(raw, tmax=10., method="empirical")
+    inv = make_inverse_operator(info, fwd, noise_cov, loose=0.2, depth=0.8)
+    inv_fname = Path(tmp) / "sub-01-inv.fif"
+    write_inverse_operator(inv_fname, inv, overwrite=True)
+    return inv_fname, read_inverse_operator(inv_fname)
+
+
+def main():
+    mne.set_log_level("ERROR")
+    with tempfile.TemporaryDirectory() as tmp:
+        raw, _ = synthetic.simulate_run(30.)
+        raw.pick(["meg", "stim"])
+        # the falling edges of the word triggers
+        triggers = mne.find_stim_steps(raw, stim_channel="STI008")
+        onsets = triggers[triggers[:, 2] == 0, 0]
+        events = np.c_[onsets, np.zeros(len(onsets), int), np.ones(len(onsets), int)]
+        epochs = mne.Epochs(raw, events, tmin=-0.1, tmax=0.3, baseline=(-0.1, 0), picks="meg", preload=True)
+        evoked = epochs.average()
+        inv_fname, inv = make_inverse(tmp, raw, epochs.info)
+
+        for method in ["dSPM", "MNE"]:
+            for pick_ori in [None, "normal"]:
+                reference = apply_inverse(evoked, inv, LAMBDA2, method, pick_ori=pick_ori).data
+                inverse._KERNELS.clear()
+                kernel = inverse.get_kernel(inv_fname, evoked.nave, LAMBDA2, method, pick_ori)
+                inverse._KERNELS.clear()
+                stored = inverse.get_kernel(inv_fname, evoked.nave, LAMBDA2, method, pick_ori)
+                assert stored is not kernel
+                for label, data in [
+                    ("apply_evoked", kernel.apply_evoked(evoked).data),
+                    ("stored kernel", stored.apply_evoked(evoked).data),
+                    ("apply_kernel", inverse.apply_kernel(kernel, [evoked], Path(tmp) / "evoked.npy",
+                                                          dtype=np.float64)[0]),
+                ]:
+                    error = relative_error(data, reference)
+                    print(f"evoked, {method}, pick_ori={pick_ori}, {label}: relative error {error:.1e}")
+                    assert error <= MAX_RELATIVE_ERROR, error
+
+        for method in ["dSPM", "MNE"]:
+            reference = np.stack([stc.data for stc in apply_inverse_epochs(epochs, inv, LAMBDA2, method)])
+            kernel = inverse.get_kernel(inv_fname, 1, LAMBDA2, method)
+            data = inverse.apply_kernel(kernel, epochs, Path(tmp) / "epochs.npy", max_block_mb=1., dtype=np.float64)
+            error = relative_error(np.asarray(data), reference)
+            print(f"{len(epochs)} epochs, {method}: relative error {error:.1e}")
+            assert data.shape == reference.shape and error <= MAX_RELATIVE_ERROR, error
+
+        try:
+            inverse.apply_kernel(inverse.get_kernel(inv_fname, evoked.nave, LAMBDA2), epochs, Path(tmp) / "bad.npy")
+        except ValueError as e:
+            print(f"kernel of nave={evoked.nave} refused for the epochs: {e}")
+        else:
+            raise AssertionError("epochs accepted with a kernel of nave != 1")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
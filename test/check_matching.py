@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Check of approx_match_samples (utils/matching.py) against the walk by walk matcher it replaced
+
+On random trigger sequences, with missing and extra triggers and jittered
+onsets, the matches (or the partial matches of the error, when none succeeds)
+must be the same as those of the reference implementation below, which
+tries the start offsets one after the other. With max_missing >= 8 there are
+at least 81 walks, so most of each match runs on the vectorized path.
+"""
+
+import dataclasses, itertools, sys
+import typing as tp
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils.matching import NoApproximateMatch, approx_match_samples
+
+N_CASES = 3000
+MAX_MISSING = [8, 10, 3]
+
+
+@dataclasses.dataclass
+class Sequence:
+    sequence: tp.Sequence[float]
+    current: int
+    matches: tp.List[int]
+
+    def valid_index(self, shift: int = 0) -> bool:
+        return self.current + shift < len(self.sequence)
+
+    def diff(self, shift: int = 0) -> float:
+        return self.sequence[self.current + shift] - self.sequence[self.matches[-1]]
+
+
+def reference_match(s1, s2, abs_tol, rel_tol=0.003, max_missing=3, first_match=None):
+    """The matcher of 01_preprocessing.py before utils/matching.py, without its error message"""
+    if first_match is None:
+        success, error = None, None
+        for offsets in itertools.product(range(max_missing + 1), repeat=2):
+            try:
+                out = reference_match(s1, s2, abs_tol, rel_tol, max_missing, offsets)
+                if success is None or len(out[0]) > len(success[0]):
+                    success = out
+            except NoApproximateMatch as e:
+                if error is None or error.matches[0][-1] < e.matches[0][-1]:
+                    error = e
+        if success is not None:
+            return success
+        raise error
+
+    def within(value1, value2):
+        return abs(value1 - value2) <= max(abs_tol, rel_tol * min(abs(value1), abs(value2)))
+
+    seqs = (Sequence(s1, first_match[0] + 1, [first_match[0]]), Sequence(s2, first_match[1] + 1, [first_match[1]]))
+    while all(s.valid_index() for s in seqs):
+        if within(seqs[0].diff(), seqs[1].diff()):
+            for s in seqs:
+                s.matches.append(s.current)
+                s.current += 1
+        else:
+            seqs[1 if seqs[1].diff() < seqs[0].diff() else 0].current += 1
+        for k, seq in enumerate(seqs):
+            other = seqs[(k + 1) % 2]
+            if seq.valid_index(shift=1) and other.valid_index():
+                if abs(seq.diff(1) - seq.diff()) <= 2 * abs_tol:
+                    if abs(seq.diff(1) - other.diff()) < abs(seq.diff() - other.diff()):
+                        seq.current += 1
+        if any(m.current - m.matches[-1] > max_missing + 1 for m in seqs):
+            raise NoApproximateMatch("", matches=tuple(np.array(s.matches) for s in seqs))
+    return tuple(np.array(s.matches) for s in seqs)
+
+
+def random_case(rng):
+    """Word onsets (in samples) and triggers with missing, extra and jittered onsets"""
+    onsets = np.cumsum(rng.integers(100, 600, size=rng.integers(5, 200)))
+    triggers = onsets[rng.random(len(onsets)) > rng.uniform(0, 0.3)]
+    extra = rng.integers(0, onsets[-1], size=rng.integers(0, 5))
+    triggers = np.sort(np.r_[triggers, extra]) + rng.integers(-3, 4, size=len(triggers) + len(extra))
+    return onsets.tolist(), (triggers + rng.integers(0, 2000)).tolist()
+
+
+def outcome(match, *args, **kwargs):
+    try:
+        return "match", match(*args, **kwargs)
+    except NoApproximateMatch as e:
+        return "error", e.matches
+
+
+def main():
+    rng = np.random.default_rng(0)
+    counts = {"match": 0, "error": 0}
+    for case in range(N_CASES):
+        s1, s2 = random_case(rng)
+        kwargs = dict(abs_tol=10, max_missing=MAX_MISSING[case % len(MAX_MISSING)])
+        kind, (m1, m2) = outcome(approx_match_samples, s1, s2, **kwargs)
+        ref_kind, (r1, r2) = outcome(reference_match, s1, s2, **kwargs)
+        assert kind == ref_kind, (case, kind, ref_kind)
+        assert np.array_equal(m1, r1) and np.array_equal(m2, r2), (case, kwargs)
+        counts[kind] += 1
+    print(f"{N_CASES} cases, {counts['match']} matched and {counts['error']} failed like the reference")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Check of the one-pass median averaging (utils/averaging.py) against average(method="median")
+
+On a synthetic run (see synthetic.py), the rare and frequent evoked responses
+must be the same as those of the loaded epochs, in memory and when spilled to
+a memory map in channel blocks. The error of the approximate (remedian)
+medians is measured in standard errors of the median (1.2533 std / sqrt(n) of
+the epochs), the sampling error of the exact median itself.
+"""
+
+import sys, tempfile, time
+from pathlib import Path
+import mne
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils.averaging import median_evokeds
+
+import synthetic
+
+CONDITIONS = dict(rare="is_rare", freq="~is_rare")
+# Maximum mean error of the remedian, in standard errors of the median
+APPROXIMATE_MAX_ERROR = 1.
+
+
+def make_epochs(fname, words):
+    raw = mne.io.read_raw_fif(fname, verbose=False)
+    triggers = mne.find_stim_steps(raw, stim_channel="STI008")
+    triggers = triggers[triggers[:, 2] == 0]
+    words = words.iloc[:len(triggers)].copy()
+    words["is_rare"] = np.arange(len(words)) % 3 == 0
+    events = np.c_[triggers[:, 0], np.ones(len(triggers), int), np.arange(len(triggers))]
+    return mne.Epochs(raw, events, tmin=-0.5, tmax=0.8, baseline=(-0.5, 0), metadata=words, verbose=False)
+
+
+def main():
+    mne.set_log_level("ERROR")
+    with tempfile.TemporaryDirectory() as tmp:
+        raw, words = synthetic.simulate_run(120., n_missing=0)
+        fname = Path(tmp) / "run_raw.fif"
+        raw.save(fname)
+        del raw
+
+        start = time.perf_counter()
+        epochs = make_epochs(fname, words).load_data()
+        reference = {name: epochs[query].average(method="median") for name, query in CONDITIONS.items()}
+        standard_error = {name: 1.2533 * epochs[query].get_data(picks="data").std(axis=0) / np.sqrt(len(epochs[query]))
+                          for name, query in CONDITIONS.items()}
+        print(f"average(method='median') on the loaded epochs: {time.perf_counter() - start:.2f} s, "
+              f"{len(epochs)} epochs")
+        del epochs
+
+        for label, kwargs in [("in memory", {}), ("spilled, 20 MB", dict(max_memory_mb=20, tmp_dir=tmp)),
+                              ("approximate", dict(approximate=True, max_memory_mb=20))]:
+            start = time.perf_counter()
+            evokeds = median_evokeds(make_epochs(fname, words), CONDITIONS, **kwargs)
+            print(f"median_evokeds ({label}): {time.perf_counter() - start:.2f} s")
+            for name, evoked in evokeds.items():
+                expected = reference[name]
+                assert evoked.ch_names == expected.ch_names and evoked.nave == expected.nave
+                assert evoked.comment == expected.comment and evoked.baseline == expected.baseline
+                np.testing.assert_array_equal(evoked.times, expected.times)
+                error = np.abs(evoked.data - expected.data) / standard_error[name]
+                print(f"    {name}: nave {evoked.nave}, difference of {error.mean():.3f} standard error on average, "
+                      f"{error.max():.3f} at most")
+                if kwargs.get("approximate"):
+                    assert error.mean() < APPROXIMATE_MAX_ERROR
+                else:
+                    np.testing.assert_array_equal(evoked.data, expected.data)
+        assert not list(Path(tmp).glob("*.npy")), "memory map left behind"
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
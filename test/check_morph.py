@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Check of the stored morphs of utils/morph.py against compute_source_morph(...).apply
+
+On spherical anatomies (see synthetic.py), with random estimates on the
+vertices of a source space of the subject:
+- the morph of the store, computed or read back from it, must give the
+  estimates of compute_source_morph(...).apply, up to MAX_RELATIVE_ERROR
+- estimates on other vertices (another spacing of the source space) must get
+  their own entry of the store, giving their own morph, while the morph of the
+  first vertices must refuse them
+- a change of the spherical registration of the subject must make the stored
+  morph outdated, and computed again from the new registration (not from the
+  morph maps MNE cached for the previous one)
+"""
+
+import sys, tempfile
+from pathlib import Path
+import mne
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils import anatomy, buildcache, morph
+
+import synthetic
+
+SMOOTH = 5
+# the morph maps of MNE are written in single precision, and read back by the computations after the first
+MAX_RELATIVE_ERROR = 1e-6
+
+
+def random_stc(src, rng, n_times=20):
+    vertices = [s["vertno"] for s in src]
+    n_vertices = sum(len(v) for v in vertices)
+    return mne.SourceEstimate(rng.standard_normal((n_vertices, n_times)), vertices, tmin=0., tstep=0.001,
+                              subject="sub-01")
+
+
+def check(store, subjects_dir, stcs, label):
+    """Estimates of the stored morph against those of compute_source_morph, computed then read back"""
+    references = None
+    for source in ["computed", "stored"]:
+        morph._MORPHS.clear()
+        stc_morph = morph.get_morph(store, subjects_dir, stcs[0], "sub-01", smooth=SMOOTH)
+        # after get_morph, which removes the morph maps of MNE outdated by the registrations
+        references = references or [mne.compute_source_morph(stc, "sub-01", "fsaverage", subjects_dir, spacing=5,
+                                                             smooth=SMOOTH).apply(stc).data for stc in stcs]
+        for stc, reference in zip(morph.apply_morph(stc_morph, stcs), references):
+            error = np.abs(stc.data - reference).max() / np.abs(reference).max()
+            print(f"{label}, {source}: relative error {error:.1e}")
+            assert error <= MAX_RELATIVE_ERROR, error
+    return stc_morph
+
+
+def main():
+    mne.set_log_level("ERROR")
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        subjects_dir, store = Path(tmp) / "freesurfer", Path(tmp) / "anatomy"
+        for subject in ["sub-01", "fsaverage"]:
+            synthetic.make_anatomy(subjects_dir, subject)
+        oct4 = anatomy.source_space(store, subjects_dir, "sub-01", spacing="oct4")
+        oct5 = anatomy.source_space(store, subjects_dir, "sub-01", spacing="oct5")
+
+        stcs = [random_stc(oct5, rng) for _ in range(3)]
+        oct5_morph = check(store, subjects_dir, stcs, "oct5, 3 estimates")
+        fname = morph.morph_fname(store, "sub-01", stcs[0].vertices, smooth=SMOOTH)
+        assert fname.exists()
+
+        other = random_stc(oct4, rng)
+        check(store, subjects_dir, [other], "oct4")
+        assert morph.morph_fname(store, "sub-01", other.vertices, smooth=SMOOTH) != fname
+        try:
+            morph.apply_morph(oct5_morph, [other])
+        except ValueError as e:
+            print(f"morph of the oct5 vertices refused for oct4: {e}")
+        else:
+            raise AssertionError("estimates on other vertices accepted")
+
+        # another registration (rotated) of the subject
+        sphere = subjects_dir / "sub-01/surf/lh.sphere.reg"
+        rr, tris = mne.read_surface(sphere)
+        rotation = mne.transforms.rotation(0.3, 0.2, 0.1)[:3, :3]
+        mne.write_surface(sphere, rr @ rotation.T, tris, overwrite=True)
+        fingerprint = morph.morph_fingerprint(subjects_dir, "sub-01", stcs[0].vertices, smooth=SMOOTH)
+        assert not buildcache.up_to_date(fname, fingerprint)
+        check(store, subjects_dir, stcs[:1], "oct5, rotated registration")
+        # which the outdated morph would have got wrong
+        stale, = morph.apply_morph(oct5_morph, stcs[:1])
+        rotated, = morph.apply_morph(morph.get_morph(store, subjects_dir, stcs[0], "sub-01", smooth=SMOOTH), stcs[:1])
+        assert not np.allclose(stale.data, rotated.data)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
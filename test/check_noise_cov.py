@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Check of the streamed noise covariance (utils/covariance.py) against compute_raw_covariance
+
+On two segments of a synthetic run (see synthetic.py), read from disk by two
+workers, the covariance must be the one of compute_raw_covariance on the
+concatenated segments: the same selected estimator, the same shrinkage of each
+channel type, the same log-likelihoods and the same covariances, up to
+rounding (RTOL of the largest entry).
+"""
+
+import sys, tempfile, time
+from pathlib import Path
+import mne
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils.covariance import compute_segments_covariance
+
+import synthetic
+
+SEGMENTS = [(1., 2.4), (3., 4.2)]  # s, few samples for 306 channels: the shrinkage matters
+METHODS = ["shrunk", "empirical"]
+RTOL = 1e-8
+
+
+def relative_error(a, b):
+    return np.abs(a - b).max() / np.abs(b).max()
+
+
+def main():
+    mne.set_log_level("ERROR")
+    with tempfile.TemporaryDirectory() as tmp:
+        raw, _ = synthetic.simulate_run(60.)
+        fname = Path(tmp) / "run_raw.fif"
+        raw.save(fname)
+        raw = mne.io.read_raw_fif(fname)
+        segments = [(fname, tmin, tmax) for tmin, tmax in SEGMENTS]
+
+        start = time.perf_counter()
+        concatenated = mne.concatenate_raws([raw.copy().crop(tmin=tmin, tmax=tmax) for tmin, tmax in SEGMENTS])
+        refs = mne.compute_raw_covariance(concatenated, method=METHODS, rank="info", return_estimators=True)
+        ref_time, start = time.perf_counter() - start, time.perf_counter()
+        covs = compute_segments_covariance(segments, method=METHODS, rank="info", n_workers=2,
+                                           return_estimators=True)
+        print(f"compute_raw_covariance {ref_time:.1f} s, streamed {time.perf_counter() - start:.1f} s")
+
+        # both sorted by log-likelihood, the selected estimator first
+        assert [cov["method"] for cov in covs] == [ref["method"] for ref in refs], (covs, refs)
+        print(f"selected {covs[0]['method']}")
+        for cov, ref in zip(covs, refs):
+            error = relative_error(cov.data, ref.data)
+            loglik_error = abs(cov["loglik"] - ref["loglik"]) / abs(ref["loglik"])
+            print(f"  {cov['method']}: relative error {error:.1e}, of the log-likelihood {loglik_error:.1e}")
+            assert cov.ch_names == ref.ch_names and cov["nfree"] == ref["nfree"]
+            assert error <= RTOL and loglik_error <= RTOL, (cov["method"], error, loglik_error)
+            if cov["method"] == "shrunk":
+                shrinkage = {ch_type: float(value) for ch_type, value, _ in ref["estimator"].shrinkage}
+                print(f"  shrinkage {cov['shrinkage']} (reference {shrinkage})")
+                # the same values of the grid
+                assert cov["shrinkage"] == shrinkage, (cov["shrinkage"], shrinkage)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""Check of 05_anat-preprocessing/01_recon_all.py with a fake recon-all
+
+The fake recon-all writes the FreeSurfer status files (IsRunning, the status
+log, recon-all.done) of a few steps, in a temporary subjects folder, with its
+own config.yml and participants list. Like FreeSurfer, it starts again from
+the first step with -all, and only redoes the steps from the last one with
+-make all. One subject is killed halfway through its first run (and must be
+resumed from that step, not imported again), one has no T1. sub-06 has a
+folder with outputs but no imported T1, which must be kept and the subject
+failed; sub-07 has the logs of a failed import, which must be replaced. The
+jobs must not exceed the core budget, and a second run must skip the
+finished subjects.
+"""
+
+import os, sys, subprocess, tempfile, textwrap, yaml
+from pathlib import Path
+import pandas as pd
+
+RECON_ALL_SCRIPT = Path(__file__).resolve().parents[1] / "05_anat-preprocessing" / "01_recon_all.py"
+STEPS = ["MotionCor", "Talairach", "SkullStrip", "WhiteSurf", "Cortical Parc"]
+
+FAKE_RECON_ALL = """#!{python}
+import os, sys, time
+from pathlib import Path
+
+args = sys.argv[1:]
+subject = args[args.index("-s") + 1]
+subject_dir = Path(os.environ["SUBJECTS_DIR"]) / subject
+log = Path(os.environ["FAKE_LOG"])
+with open(log, "a") as f:
+    f.write(f"start {{subject}} {{time.time()}} {{'-i' in args}}\\n")
+
+def finish(code=0, message=""):
+    with open(log, "a") as f:
+        f.write(f"end {{subject}} {{time.time()}} False\\n")
+    print(message)
+    os._exit(code)  # on a crash, the IsRunning file is left behind
+
+if "-i" in args:
+    t1 = Path(args[args.index("-i") + 1])
+    if subject_dir.exists():
+        finish(1, f"ERROR: {{subject}} already exists")
+    if not t1.exists():
+        finish(1, f"ERROR: cannot find {{t1}}")
+    (subject_dir / "mri" / "orig").mkdir(parents=True)
+    (subject_dir / "mri" / "orig" / "001.mgz").write_bytes(t1.read_bytes())
+scripts = subject_dir / "scripts"
+scripts.mkdir(exist_ok=True)
+running = scripts / "IsRunning.lh+rh"
+if running.exists():
+    finish(1, "ERROR: it appears that recon-all is already running")
+running.touch()
+(scripts / "recon-all.done").unlink(missing_ok=True)
+
+# -make all redoes the steps already started from the last one, -all all of them
+status = scripts / "recon-all-status.log"
+done = [line[4:] for line in status.read_text().splitlines()] if status.exists() and "-make" in args else []
+steps = {steps!r}
+crash = subject in os.environ.get("FAKE_CRASH", "").split() and not (log.with_name(f"crashed-{{subject}}")).exists()
+for step in steps[max(0, len(done) - 1):]:
+    with open(status, "a") as f:
+        f.write(f"#@# {{step}}\\n")
+    time.sleep(0.2)
+    if crash and step == "SkullStrip":
+        log.with_name(f"crashed-{{subject}}").touch()
+        finish(1, "Killed")
+running.unlink()
+(scripts / "recon-all.done").write_text("#START_TIME x\\n#END_TIME y\\n")
+finish()
+"""
+
+def run_recon_all(tmp, env):
+    result = subprocess.run([sys.executable, str(RECON_ALL_SCRIPT)], cwd=tmp, env=env, capture_output=True, text=True)
+    print(textwrap.indent(result.stdout + result.stderr[-2000:], "    "))
+    # the subjects which failed to start have no wall time
+    assert "( s)" not in result.stdout
+    return result.returncode
+
+def max_running(log_lines):
+    """Maximum number of fake recon-all running at the same time"""
+    events = sorted((float(t), 1 if kind == "start" else -1) for kind, _, t, _ in log_lines)
+    running = peak = 0
+    for _, step in events:
+        running += step
+        peak = max(peak, running)
+    return peak
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        bin_dir = tmp / "bin"
+        bin_dir.mkdir()
+        fake = bin_dir / "recon-all"
+        fake.write_text(FAKE_RECON_ALL.format(python=sys.executable, steps=STEPS))
+        fake.chmod(0o755)
+
+        subjects = ["sub-01", "sub-02", "sub-03", "sub-04", "sub-05", "sub-06", "sub-07"]
+        for subject in subjects:
+            if subject == "sub-05":  # no T1
+                continue
+            t1 = tmp / "bids" / subject / "ses-01" / "anat" / f"{subject}_ses-01_T1w.nii.gz"
+            t1.parent.mkdir(parents=True)
+            t1.write_bytes(b"T1")
+        (tmp / "freesurfer" / "sub-06" / "mri").mkdir(parents=True)
+        (tmp / "freesurfer" / "sub-06" / "mri" / "T1.mgz").write_bytes(b"T1")
+        (tmp / "freesurfer" / "sub-07" / "scripts").mkdir(parents=True)
+        (tmp / "freesurfer" / "sub-07" / "mri" / "orig").mkdir(parents=True)
+        (tmp / "freesurfer" / "sub-07" / "scripts" / "recon-all.log").write_text("ERROR: cannot read the T1")
+        pd.DataFrame(dict(participant_id=subjects, NIP="x", to_import="")).to_csv(
+            tmp / "participants.tsv", sep="\t", index=False)
+        config = dict(base_path=str(tmp), subjects_dir="bids", freesurfer_dir="freesurfer",
+                      participants_file=str(tmp / "participants.tsv"), recon_all_cores=4, recon_all_threads=2,
+                      recon_all_memory_per_job_gb=1, recon_all_retries=1)
+        (tmp / "config.yml").write_text(yaml.safe_dump(config))
+        env = dict(os.environ, PATH=f"{bin_dir}{os.pathsep}{os.environ['PATH']}", FAKE_LOG=str(tmp / "fake.log"),
+                   FAKE_CRASH="sub-02")
+
+        print("First run (sub-02 killed once, sub-05 has no T1, sub-06 outputs without import):")
+        assert run_recon_all(tmp, env) == 1, "sub-05 and sub-06 should make the run fail"
+        log_lines = [line.split() for line in (tmp / "fake.log").read_text().splitlines()]
+        assert max_running(log_lines) <= 2, "more jobs than the 4 cores / 2 threads allow"
+        starts = [(subject, imported) for kind, subject, _, imported in log_lines if kind == "start"]
+        assert starts.count(("sub-02", "True")) == 1 and ("sub-02", "False") in starts, "sub-02 should be resumed"
+        done = ["sub-01", "sub-02", "sub-03", "sub-04", "sub-07"]
+        for subject in done:
+            assert (tmp / "freesurfer" / subject / "scripts" / "recon-all.done").exists(), subject
+        assert (tmp / "freesurfer" / "sub-06" / "mri" / "T1.mgz").exists(), "the outputs of sub-06 were removed"
+        assert "sub-06" not in {subject for _, subject, _, _ in log_lines}
+        # the resumed subject only redid the steps from the one it was killed in
+        status = (tmp / "freesurfer" / "sub-02" / "scripts" / "recon-all-status.log").read_text().split("\n")
+        assert status.count("#@# SkullStrip") == 2 and status.count("#@# MotionCor") == 1, status
+        timings = pd.read_csv(tmp / "freesurfer" / "recon_all_timings.tsv", sep="\t")
+        assert set(timings.loc[timings.status == "done", "subject"]) == set(done), timings
+
+        print("Second run (only sub-05 and sub-06 to do):")
+        (tmp / "fake.log").write_text("")
+        assert run_recon_all(tmp, env) == 1
+        started = {line.split()[1] for line in (tmp / "fake.log").read_text().splitlines()}
+        assert started == {"sub-05"}, started  # sub-06 fails before recon-all starts
+    print("OK")
+
+if __name__ == "__main__":
+    main()
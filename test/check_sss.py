@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""Check of the chunked filtering and Maxwell filtering (utils/sss.py) against the in-memory path
+
+On a synthetic run (see synthetic.py) with a noisy channel and a flat one, read
+in several chunks:
+- find_bad_channels_chunked must find the bad channels of
+  find_bad_channels_maxwell on the whole filtered run, up to MAX_BADS_DIFF of
+  them (a channel found flat in a chunk still takes part in the noisy
+  detection of the next ones)
+- streaming_maxwell_filter, with the same bad channels, must write the data of
+  maxwell_filter on the whole filtered run, up to MAX_RELATIVE_ERROR of its
+  largest value
+"""
+
+import sys, tempfile
+from pathlib import Path
+import mne
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils.sss import ChunkedRun, find_bad_channels_chunked, streaming_maxwell_filter
+
+import synthetic
+
+L_FREQ, H_FREQ = 0.5, 20.
+MAX_MEMORY_MB = 300
+FLAT = "MEG0512"
+MAX_BADS_DIFF = 0
+MAX_RELATIVE_ERROR = 1e-6
+
+
+def main():
+    mne.set_log_level("ERROR")
+    with tempfile.TemporaryDirectory() as tmp:
+        raw, _ = synthetic.simulate_run(60., noisy=("MEG0101",))
+        raw._data[raw.ch_names.index(FLAT)] = 0.
+        fname = Path(tmp) / "run_raw.fif"
+        raw.save(fname)
+        raw = mne.io.read_raw_fif(fname)
+        destination = raw.info["dev_head_t"]
+
+        filtered = raw.copy().load_data().filter(L_FREQ, H_FREQ)
+        noisy, flat = mne.preprocessing.find_bad_channels_maxwell(filtered)
+        reference_bads = set(noisy + flat)
+        filtered.info["bads"] = noisy + flat
+        reference = mne.preprocessing.maxwell_filter(filtered, destination=destination).get_data()
+
+        run = ChunkedRun(raw, L_FREQ, H_FREQ, MAX_MEMORY_MB, step=5000)  # the 5 s windows of the detection
+        assert len(run.bounds) > 1, run.bounds
+        noisy, flat = find_bad_channels_chunked(run)
+        bads = set(noisy + flat)
+        print(f"{len(run.bounds)} chunks, bad channels {sorted(bads)} (whole run: {sorted(reference_bads)})")
+        assert {"MEG0101", FLAT} <= reference_bads
+        assert len(bads ^ reference_bads) <= MAX_BADS_DIFF, bads ^ reference_bads
+
+        out_fname = Path(tmp) / "run_raw_sss.fif"
+        streaming_maxwell_filter(
+            raw, out_fname, L_FREQ, H_FREQ, MAX_MEMORY_MB, destination=destination, bads=sorted(reference_bads)
+        )
+        streamed = mne.io.read_raw_fif(out_fname).get_data()
+        error = np.abs(streamed - reference).max() / np.abs(reference).max()
+        print(f"relative error of the streamed Maxwell filter: {error:.2e}")
+        assert error <= MAX_RELATIVE_ERROR, error
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
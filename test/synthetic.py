@@ -0,0 +1,155 @@
+"""Synthetic Neuromag-like recordings and anatomy, for the checks and benchmarks which run without the study data
+
+The sensors are 102 triplets (a magnetometer and two orthogonal planar
+gradiometers, with the Neuromag coil types and MEGxxx1/2/3 names) on a
+helmet-shaped cap around the head, with head shape points for the origin of the
+Maxwell filter. A run holds a few smooth sources mixed into the sensors plus
+sensor noise, the STI101 events of the start and end of the story, one STI008
+pulse ending at each word onset and a flat MISC005. An acquisition holds
+several runs separated by breaks, during which MISC005 is high (see
+find_run_bounds in 02_data-preparation/crop_runs.py). The anatomy is made of
+spheres: the two hemispheres, the inner skull and their spherical registrations.
+"""
+
+import typing as tp
+from pathlib import Path
+
+import mne
+import numpy as np
+import pandas as pd
+from mne.io.constants import FIFF
+from mne.surface import _get_ico_surface
+
+N_SENSORS = 102
+HELMET_CENTER = np.array([0., 0., 0.04])
+HELMET_RADIUS = 0.12
+# words of various frequencies (le is among the most frequent words, baobab among the rarest)
+WORDS = ["le", "de", "et", "il", "petit", "prince", "dessin", "mouton", "fleur", "étoile", "planète", "renard",
+         "rose", "volcan", "serpent", "aviateur", "désert", "chapeau", "boa", "baobab", "allumeur", "géographe"]
+# STI101 value of the start and end of the story in a run
+STORY_EVENT = 1
+
+
+def neuromag_info(sfreq: float = 1000.) -> mne.Info:
+    """Info of the 306 MEG channels, STI101, STI008 and MISC005, with the device and head frames aligned"""
+    k = np.arange(N_SENSORS) + 0.5
+    z = 1 - k / N_SENSORS * 1.3  # down to below the ears
+    r = np.sqrt(1 - z ** 2)
+    phi = np.pi * (1 + 5 ** 0.5) * k
+    normals = np.c_[r * np.cos(phi), r * np.sin(phi), z]
+
+    names, types = [], []
+    for sensor in range(N_SENSORS):
+        names += [f"MEG{sensor + 1:03d}2", f"MEG{sensor + 1:03d}3", f"MEG{sensor + 1:03d}1"]
+        types += ["grad", "grad", "mag"]
+    info = mne.create_info(names + ["STI101", "STI008", "MISC005"], sfreq, types + ["stim", "stim", "misc"])
+    for sensor, ez in enumerate(normals):
+        ex = np.cross([0., 0., 1.], ez)
+        ex = ex / np.linalg.norm(ex) if np.linalg.norm(ex) > 1e-6 else np.array([1., 0., 0.])
+        ey = np.cross(ez, ex)
+        # the second gradiometer is rotated by 90 degrees in the plane of the sensor
+        for ch, (ax, ay) in zip(info["chs"][3 * sensor:3 * sensor + 3], [(ex, ey), (ey, -ex), (ex, ey)]):
+            ch["loc"][:] = np.r_[HELMET_CENTER + HELMET_RADIUS * ez, ax, ay, ez]
+            ch["coord_frame"] = FIFF.FIFFV_COORD_DEVICE
+    with info._unlock():
+        info["dev_head_t"] = mne.transforms.Transform("meg", "head", np.eye(4))
+    montage = mne.channels.make_dig_montage(
+        nasion=[0., 0.09, 0.04], lpa=[-0.08, 0., 0.02], rpa=[0.08, 0., 0.02],
+        hsp=HELMET_CENTER + 0.09 * normals[:60], coord_frame="head")
+    info.set_montage(montage, on_missing="ignore")
+    return info
+
+
+def meg_signals(info: mne.Info, n_times: int, rng: np.random.Generator, noisy: tp.Sequence[str] = ()) -> np.ndarray:
+    """Smooth sources mixed into the MEG channels, plus sensor noise (and much more on the noisy channels)"""
+    picks = mne.pick_types(info, meg=True)
+    sources = np.cumsum(rng.standard_normal((5, n_times)), axis=1)
+    sources -= sources.mean(axis=1, keepdims=True)
+    # mixing weights of similar sizes, so that no channel looks flat
+    mixing = rng.choice([-1., 1.], (len(picks), 5)) * rng.uniform(0.5, 1.5, (len(picks), 5))
+    data = mixing @ sources * 1e-14 + rng.standard_normal((len(picks), n_times)) * 1e-13
+    for ch in noisy:
+        data[picks.tolist().index(info.ch_names.index(ch))] += rng.standard_normal(n_times) * 5e-11
+    data[np.isin(picks, mne.pick_types(info, meg="mag"))] *= 1e-2
+    return data
+
+
+def word_onsets(n_words: int, start: float, stop: float, rng: np.random.Generator) -> np.ndarray:
+    """Increasing onsets (s) between start and stop, 0.2 to 0.6 s apart"""
+    gaps = rng.uniform(0.2, 0.6, n_words)
+    onsets = start + np.cumsum(gaps)
+    return onsets[onsets < stop]
+
+
+def simulate_run(
+    duration: float = 60., sfreq: float = 1000., seed: int = 0, noisy: tp.Sequence[str] = ("MEG0101",),
+    n_missing: int = 3,
+) -> tp.Tuple[mne.io.RawArray, pd.DataFrame]:
+    """A run and its words (onset relative to the start of the story, as in the events.tsv)
+
+    The story starts 2 s into the run. n_missing words have no trigger, and the
+    triggers are up to 2 ms late.
+    """
+    rng = np.random.default_rng(seed)
+    info = neuromag_info(sfreq)
+    n_times = int(duration * sfreq)
+    data = np.zeros((len(info.ch_names), n_times))
+    data[mne.pick_types(info, meg=True)] = meg_signals(info, n_times, rng, noisy)
+
+    story_start, story_stop = 2., duration - 1.5
+    onsets = word_onsets(int(duration * 5), story_start + 1., story_stop - 1., rng)
+    words = pd.DataFrame(dict(onset=onsets - story_start, duration=0.3, word=rng.choice(WORDS, len(onsets))))
+
+    sti101 = data[info.ch_names.index("STI101")]
+    for t in [story_start, story_stop]:
+        sti101[int(t * sfreq):int(t * sfreq) + 10] = STORY_EVENT
+    sti008 = data[info.ch_names.index("STI008")]
+    triggered = np.sort(rng.choice(len(onsets), len(onsets) - n_missing, replace=False))
+    for onset in onsets[triggered]:
+        stop = int(round(onset * sfreq)) + rng.integers(0, 3)
+        sti008[stop - 20:stop] = 1  # the falling edge marks the word
+    return mne.io.RawArray(data, info, verbose=False), words
+
+
+def simulate_acquisition(
+    run_durations: tp.Sequence[float] = (20., 20.), break_duration: float = 15., sfreq: float = 1000., seed: int = 0,
+) -> mne.io.RawArray:
+    """Runs recorded in one file, MISC005 being high during the breaks between them"""
+    rng = np.random.default_rng(seed)
+    info = neuromag_info(sfreq)
+    pieces = []
+    for k, duration in enumerate(run_durations):
+        if k:
+            pause = np.zeros((len(info.ch_names), int(break_duration * sfreq)))
+            pause[info.ch_names.index("MISC005")] = 1.
+            pieces.append(pause)
+        pieces.append(np.zeros((len(info.ch_names), int(duration * sfreq))))
+    data = np.concatenate(pieces, axis=1)
+    data[mne.pick_types(info, meg=True)] = meg_signals(info, data.shape[1], rng)
+    return mne.io.RawArray(data, info, verbose=False)
+
+
+def write_events_tsv(words: pd.DataFrame, fname: str | Path) -> None:
+    """events.tsv of the metadata, the word being in the trial_type dict (see utils/events.py)"""
+    trial_type = [repr(dict(kind="word", word=word)) for word in words.word]
+    events = pd.DataFrame(dict(onset=words.onset.round(4), duration=words.duration, trial_type=trial_type))
+    events.to_csv(fname, sep="\t", index=False)
+
+
+def make_anatomy(subjects_dir: str | Path, subject: str, grade: int = 5) -> None:
+    """Spherical hemispheres (white, sphere and sphere.reg surfaces) in an inner skull, in mm like FreeSurfer
+
+    With grade 5, the spheres have the vertices of fsaverage, so the subject can
+    be named fsaverage to morph to it.
+    """
+    subject_dir = Path(subjects_dir) / subject
+    (subject_dir / "surf").mkdir(parents=True, exist_ok=True)
+    (subject_dir / "bem").mkdir(parents=True, exist_ok=True)
+    ico = _get_ico_surface(grade)
+    for hemi, side in [("lh", -1), ("rh", 1)]:
+        mne.write_surface(subject_dir / f"surf/{hemi}.white", ico["rr"] * 30 + [side * 35, 0, 0], ico["tris"],
+                          overwrite=True)
+        for surf in ["sphere", "sphere.reg"]:
+            mne.write_surface(subject_dir / f"surf/{hemi}.{surf}", ico["rr"] * 100, ico["tris"], overwrite=True)
+    skull = _get_ico_surface(4)
+    mne.write_surface(subject_dir / "bem/inner_skull.surf", skull["rr"] * 80, skull["tris"], overwrite=True)
@@ -0,0 +1,5 @@
+"""Helpers shared by the scripts of the pipeline
+
+The numbered scripts are run from their own directory, so they add the root of
+the repository to ``sys.path`` before importing from this package.
+"""
@@ -0,0 +1,77 @@
+"""Store of the derivatives of the FreeSurfer anatomy (source spaces, BEM solutions)
+
+They only depend on the anatomy of the subject and on a few parameters, not on
+the MEG data: they are computed once and saved in the store, with a build
+sidecar (see buildcache) recording the FreeSurfer surfaces they were computed
+from and the parameters. They are recomputed when one of these changed.
+"""
+
+import typing as tp
+from pathlib import Path
+
+import mne
+
+from . import buildcache
+
+SRC_SURFACES = [f"surf/{hemi}.{surf}" for hemi in ["lh", "rh"] for surf in ["white", "sphere"]]
+BEM_SURFACES = ["bem/inner_skull.surf", "bem/outer_skull.surf", "bem/outer_skin.surf"]
+CODE_VERSION = buildcache.code_version(__file__)
+
+
+def src_fname(store: Path, subject: str, spacing: str, add_dist: bool = False) -> Path:
+    # one file per parameters, so that source spaces with other parameters do not replace each other
+    return Path(store) / subject / f"{subject}-{spacing}{'-dist' if add_dist else ''}-src.fif"
+
+
+def bem_sol_fname(store: Path, subject: str, ico: int, conductivity: tp.Sequence[float]) -> Path:
+    # same naming as MNE (number of triangles of each layer), and the conductivity of each layer
+    layers = "-".join([str(20 * 4 ** ico)] * len(conductivity))
+    conductivities = "-".join(f"{value:g}" for value in conductivity)
+    return Path(store) / subject / f"{subject}-{layers}-cond{conductivities}-bem-sol.fif"
+
+
+def src_fingerprint(subjects_dir: Path, subject: str, spacing: str, add_dist: bool = False) -> dict:
+    return buildcache.fingerprint(
+        [Path(subjects_dir) / subject / f for f in SRC_SURFACES],
+        params=dict(spacing=spacing, add_dist=add_dist), code=CODE_VERSION)
+
+
+def bem_sol_fingerprint(
+    subjects_dir: Path, subject: str, ico: int, conductivity: tp.Sequence[float]
+) -> dict:
+    return buildcache.fingerprint(
+        [Path(subjects_dir) / subject / f for f in BEM_SURFACES[:len(conductivity)]],
+        params=dict(ico=ico, conductivity=list(conductivity)), code=CODE_VERSION)
+
+
+def source_space(
+    store: Path, subjects_dir: Path, subject: str, spacing: str = "oct6", add_dist: bool = False
+) -> mne.SourceSpaces:
+    """Source space of a subject, read from the store if up to date, else computed and stored"""
+    fname = src_fname(store, subject, spacing, add_dist)
+    fingerprint = src_fingerprint(subjects_dir, subject, spacing, add_dist)
+    if buildcache.up_to_date(fname, fingerprint):
+        return mne.read_source_spaces(fname, verbose=False)
+
+    src = mne.setup_source_space(subject=subject, spacing=spacing, subjects_dir=subjects_dir, add_dist=add_dist)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    src.save(fname, overwrite=True)
+    buildcache.record(fname, fingerprint)
+    return src
+
+
+def bem_solution(
+    store: Path, subjects_dir: Path, subject: str, ico: int = 4, conductivity: tp.Sequence[float] = (0.3,)
+) -> mne.bem.ConductorModel:
+    """BEM solution of a subject, read from the store if up to date, else computed and stored"""
+    fname = bem_sol_fname(store, subject, ico, conductivity)
+    fingerprint = bem_sol_fingerprint(subjects_dir, subject, ico, conductivity)
+    if buildcache.up_to_date(fname, fingerprint):
+        return mne.read_bem_solution(fname, verbose=False)
+
+    model = mne.make_bem_model(subject=subject, ico=ico, conductivity=conductivity, subjects_dir=subjects_dir)
+    bem_sol = mne.make_bem_solution(model)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    mne.write_bem_solution(fname, bem_sol, overwrite=True)
+    buildcache.record(fname, fingerprint)
+    return bem_sol
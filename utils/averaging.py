@@ -0,0 +1,203 @@
+"""Median evoked responses of several conditions in one pass over lazily read epochs
+
+epochs[query].average(method="median") needs the epochs to be loaded, and
+copies those of the query: with thousands of words per run, the epochs of a
+run are several GB. median_evokeds reads the epochs of all the conditions
+once, chunk by chunk (baseline and projections applied by MNE, as when
+loading), and takes the medians channel block by channel block:
+
+- by default, the epochs stay in memory, but the subset of each condition is
+  only copied for a block of channels at a time;
+- with max_memory_mb, the epochs are spilled to a temporary memory map (one
+  block of channels after the other), so that only a chunk of epochs or a
+  block of channels is in memory at a time;
+- with approximate, each condition keeps a remedian (Rousseeuw and Bassett,
+  1990) instead: buffers of base epochs are reduced to their median, level
+  after level, and nothing is written to disk. With a base of about sqrt(n)
+  for n epochs there are only two levels, so the memory grows with sqrt(n),
+  and the error stays around 0.6 standard error of the median.
+
+The exact modes give the same evoked responses as average(method="median").
+"""
+
+import os
+import tempfile
+import typing as tp
+
+import mne
+import numpy as np
+from mne.io.pick import _picks_to_idx
+
+# Data read or copied at once without max_memory_mb, when it is not all loaded anyway
+BLOCK_MB = 256
+
+
+class Remedian:
+    """Streaming approximation of the median of arrays, element-wise"""
+
+    def __init__(self, shape: tp.Tuple[int, ...], base: int) -> None:
+        self.shape = shape
+        self.base = base
+        # one buffer per level: an entry of level k is the median of base**k arrays
+        self.buffers: tp.List[np.ndarray] = []
+        self.counts: tp.List[int] = []
+        self.n = 0
+
+    def add(self, values: np.ndarray) -> None:
+        """Add the arrays of values (n, *shape)"""
+        for value in values:
+            self.n += 1
+            level = 0
+            while True:
+                if level == len(self.buffers):
+                    self.buffers.append(np.empty((self.base,) + self.shape))
+                    self.counts.append(0)
+                self.buffers[level][self.counts[level]] = value
+                self.counts[level] += 1
+                if self.counts[level] < self.base:
+                    break
+                value = np.median(self.buffers[level], axis=0)
+                self.counts[level] = 0
+                level += 1
+
+    def median(self) -> np.ndarray:
+        """Weighted median of the entries left in the buffers, each weighing the number of arrays it stands for
+
+        Below base arrays, this is their exact median.
+        """
+        values = np.concatenate([buffer[:count] for buffer, count in zip(self.buffers, self.counts)])
+        weights = np.concatenate([np.full(count, self.base ** level) for level, count in enumerate(self.counts)])
+        order = np.argsort(values, axis=0, kind="stable")
+        values = np.take_along_axis(values, order, axis=0)
+        cumulated = np.cumsum(weights[order], axis=0)
+        half = weights.sum() / 2
+        # the two middle values (the same one for an odd total), as np.median
+        low = np.take_along_axis(values, (cumulated < half).sum(axis=0, keepdims=True), axis=0)
+        high = np.take_along_axis(values, (cumulated <= half).sum(axis=0, keepdims=True), axis=0)
+        return ((low + high) / 2)[0]
+
+
+def condition_indices(epochs: mne.BaseEpochs, conditions: tp.Dict[str, str]) -> tp.Dict[str, np.ndarray]:
+    """Positions in epochs of the epochs of each condition (a metadata query or event name, as for epochs[...])"""
+    return {name: np.flatnonzero(np.isin(epochs.selection, epochs[query].selection))
+            for name, query in conditions.items()}
+
+
+def drop_bad(epochs: mne.BaseEpochs) -> None:
+    """epochs.drop_bad(), without reading the epochs if rejecting by annotation can not drop any
+
+    drop_bad() reads all the (lazy) epochs when reject_by_annotation is set,
+    even if the run has no BAD annotation.
+    """
+    raw = getattr(epochs, "_raw", None)
+    if not getattr(epochs, "reject_by_annotation", False) or raw is None or any(
+            description.lower().startswith("bad") for description in raw.annotations.description):
+        epochs.drop_bad()
+        return
+    epochs.reject_by_annotation = False
+    try:
+        epochs.drop_bad()
+    finally:
+        epochs.reject_by_annotation = True
+
+
+def data_picks(info: mne.Info) -> np.ndarray:
+    """The channels of the evoked responses of average(), the only ones read"""
+    return _picks_to_idx(info, None, "data_or_ica", ())
+
+
+def _chunks(n: int, size: int) -> tp.Iterator[slice]:
+    for start in range(0, n, size):
+        yield slice(start, min(start + size, n))
+
+
+def median_evokeds(
+    epochs: mne.BaseEpochs,
+    conditions: tp.Dict[str, str],
+    max_memory_mb: float | None = None,
+    approximate: bool = False,
+    base: int | None = None,
+    tmp_dir: tp.Any = None,
+    copy_to: np.ndarray | None = None,
+) -> tp.Dict[str, mne.Evoked]:
+    """Median evoked response of each condition (name: query of epochs[...]), reading the epochs once
+
+    The epochs need not be loaded. max_memory_mb bounds the data held at once
+    (besides the remedians with approximate): the epochs are then spilled to a
+    memory map in tmp_dir (default: the temporary folder of the system). base
+    is the buffer size of the remedians, by default sqrt(n) + 1 for the n epochs
+    of a condition.
+
+    copy_to is an array (epochs, data_picks, times), e.g. the memory map of an
+    epoch store (see utils/epochstore.py), which all the epochs are also
+    written to while they are read, including those of no condition.
+    """
+    # reads nothing unless epochs can be rejected or are out of the run
+    drop_bad(epochs)
+    indices = condition_indices(epochs, conditions)
+    used = np.unique(np.concatenate(list(indices.values())))
+    if copy_to is not None:
+        used = np.arange(len(epochs.events))
+    picks = data_picks(epochs.info)
+    if copy_to is not None and copy_to.shape != (len(used), len(picks), len(epochs.times)):
+        raise ValueError(f"copy_to has shape {copy_to.shape}, not {(len(used), len(picks), len(epochs.times))}")
+    shape = (len(picks), len(epochs.times))
+    epoch_mb = len(picks) * len(epochs.times) * 8 / 1024 ** 2
+    budget_mb = max_memory_mb or BLOCK_MB
+    # epochs read at once, and channels whose epochs are copied at once (store and copy of a condition)
+    chunk = max(1, int(budget_mb // epoch_mb))
+    block = max(1, int(budget_mb / 2 // (epoch_mb / len(picks) * max(1, len(used)))))
+
+    def read() -> tp.Iterator[tp.Tuple[slice, np.ndarray]]:
+        """Chunks of the epochs used, processed as when they are loaded"""
+        for chunk_slice in _chunks(len(used), chunk):
+            data = epochs.get_data(picks=picks, item=used[chunk_slice])
+            if copy_to is not None:
+                copy_to[chunk_slice] = data
+            yield chunk_slice, data
+            del data
+
+    medians = {}
+    if approximate:
+        remedians = {name: Remedian(shape, base or int(np.ceil(np.sqrt(len(idx)))) + 1)
+                     for name, idx in indices.items()}
+        for chunk_slice, data in read():
+            for name, idx in indices.items():
+                remedians[name].add(data[np.isin(used[chunk_slice], idx)])
+            del data
+        medians = {name: remedian.median() for name, remedian in remedians.items()}
+    else:
+        spill = max_memory_mb is not None and chunk < len(used)
+        if spill:
+            # channels first, so that a block of channels is contiguous
+            fd, fname = tempfile.mkstemp(suffix=".npy", dir=tmp_dir)
+            os.close(fd)
+            store = np.lib.format.open_memmap(fname, mode="w+", shape=(shape[0], len(used), shape[1]))
+            for chunk_slice, data in read():
+                store[:, chunk_slice] = data.transpose(1, 0, 2)
+                del data
+        else:
+            data = epochs.get_data(picks=picks, item=used) if len(used) else np.empty((0,) + shape)
+            if copy_to is not None:
+                copy_to[:] = data
+            store = data.transpose(1, 0, 2)
+        try:
+            for name, idx in indices.items():
+                position = np.searchsorted(used, idx)
+                medians[name] = np.empty(shape)
+                for block_slice in _chunks(len(picks), block):
+                    medians[name][block_slice] = np.median(store[block_slice][:, position], axis=1)
+        finally:
+            del store
+            if spill:
+                os.remove(fname)
+
+    evokeds = {}
+    for name, query in conditions.items():
+        subset = epochs[query]
+        data = np.zeros((len(epochs.ch_names), len(epochs.times)))
+        data[picks] = medians[name]
+        # as average() does, from the data of all the channels
+        evokeds[name] = subset._evoked_from_epoch_data(
+            data, subset.info, None, len(indices[name]), "average", subset._name)
+    return evokeds
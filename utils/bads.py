@@ -0,0 +1,139 @@
+"""Fast automatic bad channel detection, stored in BIDS channels.tsv files
+
+find_bad_channels_maxwell scores each channel on 5 s windows of the filtered
+run, and marks it noisy (or flat) if it is above (or below) the limit in at
+least min_count windows. The runs are already low-passed well below 40 Hz, so
+the detection can run on a decimated copy of the run, and on a subset of its
+windows (one out of every), with min_count scaled accordingly. Most of the
+time goes into the Maxwell fit of each window, so skipping windows saves more
+than decimating. The flat pass looks at the SD of the data on 20 samples at
+least, i.e. on longer segments once decimated.
+"""
+
+import math
+import os
+import typing as tp
+from collections import Counter
+from pathlib import Path
+
+import mne
+import numpy as np
+import pandas as pd
+from mne.preprocessing import find_bad_channels_maxwell
+
+# BIDS type and units of the MNE channel types
+_BIDS_TYPES = dict(mag=("MEGMAG", "T"), grad=("MEGGRADPLANAR", "T/m"), stim=("TRIG", "n/a"),
+                   eog=("EOG", "V"), ecg=("ECG", "V"), emg=("EMG", "V"), misc=("MISC", "n/a"))
+
+
+def subsample(
+    raw: mne.io.BaseRaw, duration: float = 5.0, every: int = 1, decim: int = 1, first_window: int = 0
+) -> mne.io.RawArray | None:
+    """Concatenation of one window out of every, decimated by decim
+
+    Windows are numbered from first_window at the start of raw, and the ones
+    with a number multiple of every are kept. Returns None if none is kept.
+    """
+    sfreq = raw.info["sfreq"]
+    step = int(round(sfreq * duration))
+    if step % decim:
+        raise ValueError(f"decim={decim} does not divide the {step} samples of the {duration} s windows")
+    if decim > 1 and raw.info["lowpass"] >= sfreq / decim / 2:
+        raise ValueError(
+            f"Cannot decimate by {decim}: the data are low-passed at {raw.info['lowpass']} Hz, "
+            f"above the Nyquist frequency of {sfreq / decim / 2} Hz"
+        )
+    starts = [start for k, start in enumerate(range(0, raw.n_times - step + 1, step))
+              if (first_window + k) % every == 0]
+    if not starts:
+        return None
+    data = np.concatenate([raw.get_data(start=start, stop=start + step)[:, ::decim] for start in starts], axis=1)
+    info = raw.info.copy()
+    with info._unlock():
+        info["sfreq"] = sfreq / decim
+    return mne.io.RawArray(data, info, verbose=False)
+
+
+def count_bad_windows(
+    raw: mne.io.BaseRaw, duration: float = 5.0, every: int = 1, decim: int = 1, first_window: int = 0,
+    **kwargs: tp.Any,
+) -> tp.Tuple[Counter, Counter, int]:
+    """Number of scanned windows where each channel is noisy and flat, and number of scanned windows"""
+    if every == 1 and decim == 1:
+        sub = raw
+    else:
+        sub = subsample(raw, duration=duration, every=every, decim=decim, first_window=first_window)
+    if sub is None:
+        return Counter(), Counter(), 0
+    sub.info["bads"] = []
+    _, _, scores = find_bad_channels_maxwell(
+        sub, duration=duration, min_count=1, return_scores=True, verbose=False, **kwargs
+    )
+    ch_names = scores["ch_names"].tolist()
+    with np.errstate(invalid="ignore"):  # NaN scores for the channels not scanned
+        noisy = Counter(dict(zip(ch_names, (scores["scores_noisy"] >= scores["limits_noisy"]).sum(1))))
+        flat = Counter(dict(zip(ch_names, (scores["scores_flat"] < scores["limits_flat"]).sum(1))))
+    return noisy, flat, len(scores["bins"])
+
+
+def select_bads(
+    noisy: Counter, flat: Counter, n_windows: int, ch_names: tp.List[str], min_count: int = 5, every: int = 1
+) -> tp.Tuple[tp.List[str], tp.List[str]]:
+    """Channels noisy and flat in at least min_count windows (min_count / every if subsampled)"""
+    min_count = min(math.ceil(min_count / every), n_windows)
+    noisy_chs = sorted((ch for ch, count in noisy.items() if count >= min_count > 0), key=ch_names.index)
+    flat_chs = sorted((ch for ch, count in flat.items() if count >= min_count > 0), key=ch_names.index)
+    return noisy_chs, flat_chs
+
+
+def find_bad_channels(
+    raw: mne.io.BaseRaw, duration: float = 5.0, min_count: int = 5, every: int = 1, decim: int = 1,
+    **kwargs: tp.Any,
+) -> tp.Tuple[tp.List[str], tp.List[str]]:
+    """Noisy and flat channels of a filtered run, scanning one window out of every, decimated by decim
+
+    With every = decim = 1, this is find_bad_channels_maxwell on the whole run
+    """
+    raw.info["bads"] = []
+    if every == 1 and decim == 1:
+        noisy, flat = find_bad_channels_maxwell(raw, duration=duration, min_count=min_count, verbose=False, **kwargs)
+        return list(noisy), list(flat)
+    noisy, flat, n_windows = count_bad_windows(raw, duration=duration, every=every, decim=decim, **kwargs)
+    return select_bads(noisy, flat, n_windows, raw.ch_names, min_count=min_count, every=every)
+
+
+def pool_bads(
+    run_bads: tp.Sequence[tp.Sequence[str]], own: tp.Sequence[str], min_runs: int
+) -> tp.List[str]:
+    """Bad channels of a run: its own, plus the ones found bad in at least min_runs runs of the subject"""
+    counts = Counter(ch for bads in run_bads for ch in set(bads))
+    pooled = list(own)
+    pooled += sorted(ch for ch, count in counts.items() if count >= min_runs and ch not in own)
+    return pooled
+
+
+def write_channels_tsv(
+    fname: str | Path, info: mne.Info, noisy: tp.Sequence[str], flat: tp.Sequence[str], method: str = ""
+) -> None:
+    """BIDS channels.tsv with the status of each channel of info"""
+    rows = []
+    for ch_name, ch_type in zip(info.ch_names, info.get_channel_types()):
+        bids_type, units = _BIDS_TYPES.get(ch_type, (ch_type.upper(), "n/a"))
+        status, description = "good", "n/a"
+        if ch_name in noisy:
+            status, description = "bad", f"noisy ({method})" if method else "noisy"
+        elif ch_name in flat:
+            status, description = "bad", f"flat ({method})" if method else "flat"
+        rows.append(dict(name=ch_name, type=bids_type, units=units, status=status, status_description=description))
+    fname = Path(fname)
+    tmp = fname.with_name(f"{fname.name}.{os.getpid()}.tmp")
+    pd.DataFrame(rows).to_csv(tmp, sep="\t", index=False)
+    os.replace(tmp, fname)
+
+
+def read_channels_tsv(fname: str | Path) -> tp.Tuple[tp.List[str], tp.List[str]]:
+    """Noisy and flat channels of a channels.tsv (bad channels with another description count as noisy)"""
+    channels = pd.read_csv(fname, sep="\t", keep_default_na=False)
+    bad = channels[channels.status == "bad"]
+    is_flat = bad.status_description.str.startswith("flat")
+    return bad.name[~is_flat].tolist(), bad.name[is_flat].tolist()
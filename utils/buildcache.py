@@ -0,0 +1,163 @@
+"""Incremental rebuild of the derivatives
+
+Each output is written with a JSON sidecar (<output>.build.json) holding the
+fingerprint of what it was built from: its input files, the config keys the
+stage depends on, and the version of the code. A stage is only rerun when its
+output or sidecar is missing (e.g. a crashed run) or when the fingerprint
+changed. The outputs which cannot hold a sidecar are fingerprinted in a
+Manifest instead.
+
+Input files are compared on size and mtime. Small files (events, transforms,
+surfaces...) are also hashed, so a touched or copied file with the same
+content does not trigger a rebuild.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import typing as tp
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+
+# above this size, input files are compared on size and mtime only
+HASH_MAX_BYTES = 64 * 1024**2
+
+
+def _sha1(fname: Path) -> str:
+    sha1 = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(1024**2), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def file_stamp(fname: str | Path) -> tp.Dict[str, tp.Any]:
+    """Size, mtime and (for small files) content hash of an input file"""
+    fname = Path(fname)
+    stat = fname.stat()
+    stamp: tp.Dict[str, tp.Any] = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    if stat.st_size <= HASH_MAX_BYTES:
+        stamp["sha1"] = _sha1(fname)
+    return stamp
+
+
+def code_version(*fnames: str | Path, packages: tp.Sequence[str] = ("mne",)) -> str:
+    """Hash of the source files of a stage and of the versions of the packages it relies on"""
+    sha1 = hashlib.sha1()
+    for fname in fnames:
+        sha1.update(Path(fname).read_bytes())
+    for package in packages:
+        try:
+            sha1.update(f"{package}=={version(package)}".encode())
+        except PackageNotFoundError:
+            pass
+    return sha1.hexdigest()
+
+
+def fingerprint(
+    inputs: tp.Iterable[str | Path],
+    params: tp.Dict[str, tp.Any] | None = None,
+    code: str | None = None,
+    optional: tp.Iterable[str | Path] = (),
+) -> tp.Dict[str, tp.Any]:
+    """Fingerprint of a stage output. Missing inputs raise FileNotFoundError
+
+    optional inputs are only stamped if they exist, e.g. the files written
+    by a previous step of the same stage: the fingerprint then differs from
+    the one recorded after a complete build, as long as one of them is missing.
+    """
+    inputs = list(inputs) + [fname for fname in optional if Path(fname).exists()]
+    return dict(
+        inputs={str(fname): file_stamp(fname) for fname in inputs},
+        # round trip through JSON so that it compares equal to the stored one
+        params=json.loads(json.dumps(params or {}, sort_keys=True, default=str)),
+        code=code,
+    )
+
+
+def sidecar(output: str | Path) -> Path:
+    output = Path(output)
+    return output.with_name(f"{output.name}.build.json")
+
+
+def _same_input(old: tp.Dict[str, tp.Any], new: tp.Dict[str, tp.Any]) -> bool:
+    if old.get("size") != new["size"]:
+        return False
+    if old.get("mtime_ns") == new["mtime_ns"]:
+        return True
+    return "sha1" in new and old.get("sha1") == new["sha1"]
+
+
+def unchanged(fname: str | Path, stamp: tp.Dict[str, tp.Any]) -> bool:
+    """Whether the file fname exists and matches its stamp, recorded by file_stamp"""
+    if not Path(fname).exists():
+        return False
+    return _same_input(stamp, file_stamp(fname))
+
+
+def same_fingerprint(old: tp.Dict[str, tp.Any], fp: tp.Dict[str, tp.Any]) -> bool:
+    """Whether a recorded fingerprint matches the current one"""
+    if old.get("params") != fp["params"] or old.get("code") != fp["code"]:
+        return False
+    old_inputs = old.get("inputs", {})
+    if set(old_inputs) != set(fp["inputs"]):
+        return False
+    return all(_same_input(old_inputs[fname], stamp) for fname, stamp in fp["inputs"].items())
+
+
+def up_to_date(output: str | Path, fp: tp.Dict[str, tp.Any]) -> bool:
+    """Whether output exists and was built from the same inputs, params and code"""
+    if not Path(output).exists() or not sidecar(output).exists():
+        return False
+    try:
+        old = json.loads(sidecar(output).read_text())
+    except ValueError:
+        return False
+    return same_fingerprint(old, fp)
+
+
+def record(output: str | Path, fp: tp.Dict[str, tp.Any]) -> None:
+    """Write the sidecar of an output, once it has been successfully written"""
+    path = sidecar(output)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(fp, indent=2, sort_keys=True))
+    os.replace(tmp, path)
+
+
+class Manifest:
+    """Fingerprints of many outputs in a single JSON file, e.g. the files of a BIDS dataset
+    which cannot hold a sidecar next to each of them
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        try:
+            self.entries: tp.Dict[str, tp.Any] = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            self.entries = {}
+        # entries recorded by this instance
+        self._recorded: tp.Dict[str, tp.Any] = {}
+
+    def up_to_date(self, output: str | Path, fp: tp.Dict[str, tp.Any]) -> bool:
+        old = self.entries.get(str(output))
+        return Path(output).exists() and old is not None and same_fingerprint(old, fp)
+
+    def record(self, output: str | Path, fp: tp.Dict[str, tp.Any]) -> None:
+        """Record an output once it has been successfully written, and save the manifest
+
+        The entries recorded meanwhile by other processes (e.g. converting
+        other subjects) are read back under a lock, so that none is lost.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path.with_name(f"{self.path.name}.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._recorded[str(output)] = fp
+            try:
+                self.entries = json.loads(self.path.read_text())
+            except (OSError, ValueError):
+                self.entries = {}
+            self.entries.update(self._recorded)
+            tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+            tmp.write_text(json.dumps(self.entries, indent=2, sort_keys=True))
+            os.replace(tmp, self.path)
@@ -0,0 +1,69 @@
+"""Configuration of the pipeline, and the folders its stages share
+
+The scripts read the config.yml of the folder they are run from, or the file
+set by set_config() (pipeline.py --config). Like the telemetry log, it is
+passed through an environment variable, so that the worker processes read
+the same file.
+
+The folders one stage writes and the next ones read are derived here, from
+the same keys, for every script:
+
+- bids_dir: the BIDS dataset of the conversion, read by the MEG
+  preprocessing and the coregistration
+- freesurfer_dir: the FreeSurfer subjects of recon-all, read by the BEM,
+  the coregistration and the source reconstruction
+- {study}/derivatives: the derivatives of the subjects (preprocessed_data)
+  and of their anatomy
+
+All of them are relative to base_path.
+"""
+
+import os
+import typing as tp
+from pathlib import Path
+
+import yaml
+
+CONFIG_VAR = "PIPELINE_CONFIG"
+
+
+def set_config(fname: str | Path) -> None:
+    """Read fname instead of config.yml, in this process and the processes it starts"""
+    os.environ[CONFIG_VAR] = str(Path(fname).resolve())
+
+
+def load_config() -> tp.Dict[str, tp.Any]:
+    with open(os.environ.get(CONFIG_VAR, "config.yml"), "r") as f:
+        return yaml.safe_load(f)
+
+
+def bids_dir(config: tp.Dict[str, tp.Any]) -> Path:
+    return Path(config["base_path"]) / config.get("bids_dir", "bids")
+
+
+def freesurfer_dir(config: tp.Dict[str, tp.Any]) -> Path:
+    return Path(config["base_path"]) / config.get("freesurfer_dir", "freesurfer")
+
+
+def derivatives_dir(config: tp.Dict[str, tp.Any]) -> Path:
+    return Path(config["base_path"]) / config["study"] / "derivatives"
+
+
+def preprocessed_dir(config: tp.Dict[str, tp.Any]) -> Path:
+    return derivatives_dir(config) / "preprocessed_data"
+
+
+def trans_fname(config: tp.Dict[str, tp.Any], subject: str, task: str | None = None) -> Path:
+    """Head to MRI transform of a subject, fitted on its middle run by the coregistration"""
+    task = config["task"] if task is None else task
+    return preprocessed_dir(config) / subject / f"{subject}_task-{task}_{config['middle_run']}_meg_trans.fif"
+
+
+def noise_cov_fname(config: tp.Dict[str, tp.Any], subject: str) -> Path:
+    """Noise covariance of a subject, written by 02_get_noise_cov.py and read by the inverse"""
+    return preprocessed_dir(config) / subject / f"{subject}_noise-cov.fif"
+
+
+def epochs_fname(config: tp.Dict[str, tp.Any], subject: str, run: int) -> Path:
+    """Epoch store of a run, written by 01_preprocessing.py and read by 03_contrasts.py"""
+    return preprocessed_dir(config) / subject / f"{subject}_{config['session']}task-{config['task']}_run-0{run}_epochs"
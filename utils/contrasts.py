@@ -0,0 +1,84 @@
+"""Weighted contrasts of metadata queries, evaluated on the epoch stores of the runs
+
+A contrast maps metadata queries (pandas syntax, as epochs[...]) to weights,
+e.g. in config.yml:
+
+    contrasts:
+      rare_minus_frequent: {"is_rare": 1, "~is_rare": -1}
+      long_minus_short: {"length >= 7": 1, "length <= 4": -1}
+      late_words: {"position >= 500": 1}
+
+In each run, the evoked response (mean or median) of the epochs of each query
+is computed from the epoch store (see utils/epochstore.py) and the responses
+are combined with the weights (mne.combine_evoked). The contrasts of the runs
+are then averaged into that of the subject, as the evo_diff of the
+preprocessing. A query shared by several contrasts is only evaluated once per
+run.
+
+A query may match no epoch in some runs (e.g. position >= 500 in a short run):
+these runs are left out of the contrasts using it, which are averaged over the
+runs where all their queries match. Only a contrast with no such run fails.
+"""
+
+import typing as tp
+from pathlib import Path
+
+import mne
+
+from .epochstore import EpochStore
+
+METHODS = ["mean", "median"]
+
+
+def check_contrasts(contrasts: tp.Dict[str, tp.Dict[str, float]]) -> tp.Dict[str, tp.Dict[str, float]]:
+    """Contrasts of the config, with their weights as floats"""
+    checked = {}
+    for name, weights in (contrasts or {}).items():
+        if not isinstance(weights, dict) or not weights:
+            raise ValueError(f"Contrast {name!r} must map metadata queries to weights, got {weights!r}")
+        checked[name] = {str(query): float(weight) for query, weight in weights.items()}
+    return checked
+
+
+def run_contrasts(
+    store: EpochStore, contrasts: tp.Dict[str, tp.Dict[str, float]], method: str = "median",
+    max_memory_mb: float | None = None,
+) -> tp.Dict[str, mne.Evoked]:
+    """Evoked contrasts of a run, each query being evaluated once
+
+    The contrasts with a query matching no epoch of the run are left out.
+    """
+    if method not in METHODS:
+        raise ValueError(f"method must be one of {METHODS}, got {method!r}")
+    queries = {query for weights in contrasts.values() for query in weights}
+    evokeds = {query: store.evoked(query, method, max_memory_mb)
+               for query in sorted(queries) if len(store.select(query))}
+    results = {}
+    for name, weights in contrasts.items():
+        if not all(query in evokeds for query in weights):
+            continue
+        evoked = mne.combine_evoked([evokeds[query] for query in weights], list(weights.values()))
+        evoked.comment = name
+        results[name] = evoked
+    return results
+
+
+def subject_contrasts(
+    store_paths: tp.Sequence[str | Path], contrasts: tp.Dict[str, tp.Dict[str, float]], method: str = "median",
+    max_memory_mb: float | None = None,
+) -> tp.Dict[str, mne.Evoked]:
+    """Contrasts of a subject: those of its runs (one store each), averaged as mne.grand_average
+
+    Each contrast is averaged over the runs where all its queries match epochs.
+    """
+    per_run: tp.Dict[str, tp.List[mne.Evoked]] = {name: [] for name in contrasts}
+    for path in store_paths:
+        for name, evoked in run_contrasts(EpochStore(path), contrasts, method, max_memory_mb).items():
+            per_run[name].append(evoked)
+    results = {}
+    for name, evokeds in per_run.items():
+        if not evokeds:
+            raise ValueError(f"No run has epochs matching all the queries of contrast {name!r}: {contrasts[name]}")
+        results[name] = mne.grand_average(evokeds)
+        results[name].comment = name
+    return results
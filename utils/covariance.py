@@ -0,0 +1,272 @@
+"""Noise covariance of long recordings, accumulated block by block
+
+mne.compute_raw_covariance cuts the (concatenated) recording in 0.2 s epochs,
+drops the ones overlapping the boundaries between the concatenated raws, loads
+all of them, and selects between the estimators by 3-fold cross-validation on
+the samples (in order). The empirical and shrunk estimators and their
+log-likelihoods only depend on the sums and cross-products of the samples of
+each fold: they are accumulated here while the segments are read from disk in
+blocks, each segment in its own process, and the estimators are computed from
+them the way compute_covariance does. Like compute_raw_covariance, all the
+samples are centred on the mean of the whole recording, for the estimators and
+for the cross-validation, so that the same estimator and shrinkages are
+selected.
+
+The rank reduction relies on two private helpers of mne.cov, _picks_by_type
+and _smart_eigh (checked with MNE 1.6 to 1.13): their import and the
+parameters used here are checked when this module is imported, so that a
+release changing them fails at once rather than giving another covariance.
+"""
+
+import inspect
+import itertools
+import multiprocessing
+import typing as tp
+from concurrent.futures import ProcessPoolExecutor
+
+import mne
+import numpy as np
+
+try:
+    from mne.cov import _picks_by_type, _smart_eigh
+except ImportError as e:
+    raise ImportError(f"utils/covariance.py needs _picks_by_type and _smart_eigh of mne.cov (MNE 1.6 to 1.13), "
+                      f"not found in MNE {mne.__version__}") from e
+if not {"rank", "proj_subspace", "do_compute_rank"} <= set(inspect.signature(_smart_eigh).parameters):
+    raise ImportError(f"mne.cov._smart_eigh of MNE {mne.__version__} does not take the parameters of MNE 1.6 to 1.13")
+
+TSTEP = 0.2  # s, length of the epochs of compute_raw_covariance
+N_FOLDS = 3  # cross-validation folds of compute_raw_covariance
+SHRINKAGES = np.logspace(-4, 0, 30)  # grid of the shrunk estimator
+# scaling of each channel type while the estimators are computed (the defaults of compute_covariance)
+SCALINGS = dict(mag=1e15, grad=1e13, eeg=1e6)
+
+
+def epoch_starts(lengths: tp.Sequence[int], step: int) -> tp.List[np.ndarray]:
+    """Start (in each segment) of the epochs kept by compute_raw_covariance on the concatenated segments
+
+    Epochs tile the concatenation from its first sample; the ones overlapping
+    the start of a segment (but the first one) are rejected by annotation.
+    """
+    bounds = np.concatenate([[0], np.cumsum(lengths)])
+    starts = np.arange(0, bounds[-1] - step + 1, step)
+    junctions = bounds[1:-1]
+    crossing = ((starts[:, None] < junctions) & (junctions <= starts[:, None] + step - 1)).any(axis=1)
+    starts = starts[~crossing]
+    return [starts[(starts >= start) & (starts < stop)] - start for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def fold_bounds(n_samples: int, n_folds: int = N_FOLDS) -> np.ndarray:
+    """Sample bounds of the folds of KFold(n_folds) (not shuffled)"""
+    sizes = np.full(n_folds, n_samples // n_folds)
+    sizes[: n_samples % n_folds] += 1
+    return np.concatenate([[0], np.cumsum(sizes)])
+
+
+def empty_stats(n_channels: int, n_folds: int = N_FOLDS) -> tp.Dict[str, np.ndarray]:
+    """Number of samples, sums and cross-products of each fold"""
+    return dict(n=np.zeros(n_folds, dtype=np.int64), sums=np.zeros((n_folds, n_channels)),
+                prods=np.zeros((n_folds, n_channels, n_channels)))
+
+
+def accumulate(
+    raw: mne.io.BaseRaw, picks: np.ndarray, starts: np.ndarray, offset: int, folds: np.ndarray,
+    step: int, block_size: int = 50,
+) -> tp.Dict[str, np.ndarray]:
+    """Statistics of the epochs of raw starting at starts, the first one being sample offset of the folds
+
+    The epochs are read block_size at a time, a block of consecutive epochs in a single read.
+    """
+    stats = empty_stats(len(picks), len(folds) - 1)
+    # blocks of at most block_size consecutive epochs
+    breaks = np.flatnonzero(np.diff(starts) != step) + 1
+    blocks = [run[i:i + block_size] for run in np.split(starts, breaks) for i in range(0, len(run), block_size)]
+    for block in blocks:
+        data = raw.get_data(picks=picks, start=block[0], stop=block[-1] + step)
+        for fold in range(len(folds) - 1):
+            # part of the block in the fold
+            start = max(folds[fold] - offset, 0)
+            stop = min(folds[fold + 1] - offset, data.shape[1])
+            if start >= stop:
+                continue
+            x = data[:, start:stop]
+            stats["n"][fold] += x.shape[1]
+            stats["sums"][fold] += x.sum(axis=1)
+            stats["prods"][fold] += x @ x.T
+        offset += data.shape[1]
+    return stats
+
+
+def _accumulate_segment(fname, tmin, tmax, ch_names, starts, offset, folds, step, block_size):
+    """Worker: statistics of a segment of a raw file"""
+    raw = mne.io.read_raw_fif(fname, allow_maxshield=True, verbose=False).crop(tmin=tmin, tmax=tmax)
+    return accumulate(raw, mne.pick_channels(raw.ch_names, ch_names, ordered=True), starts, offset, folds,
+                      step, block_size)
+
+
+def _shrunk(cov: np.ndarray, shrinkages: tp.List[tp.Tuple[str, float, np.ndarray]]) -> np.ndarray:
+    """Covariance shrunk by channel type, as mne.cov._ShrunkCovariance"""
+    from sklearn.covariance import shrunk_covariance
+
+    cov = cov.copy()
+    for _, shrinkage, picks in shrinkages:
+        cov[np.ix_(picks, picks)] = shrunk_covariance(cov[np.ix_(picks, picks)], shrinkage=shrinkage)
+    for (type_i, shrinkage_i, picks_i), (type_j, shrinkage_j, picks_j) in itertools.combinations(shrinkages, 2):
+        c_ij = 0.0 if "eeg" in (type_i, type_j) else np.sqrt((1.0 - shrinkage_i) * (1.0 - shrinkage_j))
+        cov[np.ix_(picks_i, picks_j)] *= c_ij
+        cov[np.ix_(picks_j, picks_i)] *= c_ij
+    return cov
+
+
+def _scale(cov: np.ndarray, picks_list: tp.List[tp.Tuple[str, np.ndarray]], undo: bool = False) -> None:
+    """Scale (or unscale) the rows and columns of each channel type of cov in place, by SCALINGS"""
+    scales = np.ones(len(cov))
+    for ch_type, picks in picks_list:
+        scales[picks] = SCALINGS.get(ch_type, 1.0)
+    if undo:
+        scales = 1.0 / scales
+    cov *= np.outer(scales, scales)
+
+
+def _logdet(precision: np.ndarray) -> float:
+    """Log-determinant of a positive semi-definite matrix, as mne.fixes._logdet"""
+    from scipy.linalg import eigvalsh
+
+    values = eigvalsh(precision)
+    tol = values.max() * values.size * np.finfo(np.float64).eps
+    return np.sum(np.log(np.where(values > tol, values, tol)))
+
+
+def _gaussian_loglik(precision: np.ndarray, prods: np.ndarray, n: int) -> float:
+    """Mean log-likelihood of n centered samples with cross-products prods, as mne.cov._gaussian_loglik_scorer"""
+    return (-0.5 * np.sum(prods * precision) / n
+            - 0.5 * (len(precision) * np.log(2.0 * np.pi) - _logdet(precision)))
+
+
+def _centered(prods: np.ndarray, sums: np.ndarray, n: int, mean: np.ndarray) -> np.ndarray:
+    """Cross-products of n samples around mean, from their cross-products and sums"""
+    return prods - np.outer(mean, sums) - np.outer(sums, mean) + n * np.outer(mean, mean)
+
+
+def covariance_from_stats(
+    stats: tp.Dict[str, np.ndarray], info: mne.Info, method: str | tp.Sequence[str] = ("shrunk", "empirical"),
+    rank: str | dict = "info", return_estimators: bool = False,
+) -> mne.Covariance | tp.List[mne.Covariance]:
+    """Best covariance (by cross-validated log-likelihood) of the accumulated samples, as compute_raw_covariance
+
+    info is the one of the channels of stats (the data channels); method is
+    "empirical" and/or "shrunk", and rank "info" or a dict (not estimated from the data).
+    With return_estimators, the covariance of each method is returned, the best first.
+    """
+    from scipy.linalg import pinvh
+    from sklearn.covariance import log_likelihood, shrunk_covariance
+
+    method = [method] if isinstance(method, str) else list(method)
+    if not set(method) <= {"empirical", "shrunk"}:
+        raise ValueError(f"method must be 'empirical' and/or 'shrunk', got {method}")
+    if not (rank == "info" or isinstance(rank, dict)):
+        raise ValueError(f"rank must be 'info' or a dict, got {rank!r}")
+
+    # cross-products of the samples minus the channel means (of all the folds), for each fold
+    n, n_total = stats["n"], stats["n"].sum()
+    mean = stats["sums"].sum(axis=0) / n_total
+    prods = np.stack([_centered(prod, sums, n_fold, mean)
+                      for prod, sums, n_fold in zip(stats["prods"], stats["sums"], n)])
+    total = prods.sum(axis=0)
+    # training folds and left out fold of each split
+    splits = [(total - prods[fold], prods[fold]) for fold in range(len(n))]
+
+    # scaled, and projected on the subspace of the rank of the data
+    picks_list = _picks_by_type(info)
+    _scale(total, picks_list)
+    for train, test in splits:
+        _scale(train, picks_list)
+        _scale(test, picks_list)
+    if rank == "info":
+        rank = mne.compute_rank(mne.io.RawArray(np.zeros((len(info.ch_names), 1)), info, verbose=False),
+                                rank="info", verbose=False)
+    _, eigvec, mask = _smart_eigh(total, info, rank, proj_subspace=True, do_compute_rank=False, verbose=False)
+    eigvec = eigvec[mask]
+    total = eigvec @ total @ eigvec.T
+    splits = [(eigvec @ train @ eigvec.T, eigvec @ test @ eigvec.T) for train, test in splits]
+    used = np.where(mask)[0]
+    sub_picks_list = [(key, np.searchsorted(used, picks)) for key, picks in picks_list]
+
+    def train_test():
+        for fold, (train, test) in enumerate(splits):
+            yield train / (n_total - n[fold]), test, n[fold]
+
+    covs = []
+    for method_ in method:
+        if method_ == "empirical":
+            def fit(emp):
+                return emp
+        else:
+            # shrinkage of each channel type maximizing the mean log-likelihood of the left out folds
+            shrinkages = []
+            for ch_type, picks in sub_picks_list:
+                scores = np.zeros(len(SHRINKAGES))
+                for emp, test, n_test in train_test():
+                    emp, test = emp[np.ix_(picks, picks)], test[np.ix_(picks, picks)] / n_test
+                    scores += [log_likelihood(test, pinvh(shrunk_covariance(emp, shrinkage), check_finite=False))
+                               for shrinkage in SHRINKAGES]
+                shrinkages.append((ch_type, SHRINKAGES[np.argmax(scores)], picks))
+
+            def fit(emp, shrinkages=shrinkages):
+                return _shrunk(emp, shrinkages)
+
+        cov = fit(total / n_total)
+        loglik = None
+        if len(method) > 1:
+            loglik = np.mean([_gaussian_loglik(pinvh(fit(emp), check_finite=False), test, n_test)
+                              for emp, test, n_test in train_test()])
+        # project back, undo the bias and the scaling
+        cov = eigvec.T @ cov @ eigvec
+        cov *= n_total / max(n_total - 1, 1)
+        _scale(cov, picks_list, undo=True)
+        covs.append(mne.Covariance(cov, info.ch_names, info["bads"], info["projs"], nfree=n_total - 1))
+        covs[-1].update(method=method_, loglik=loglik)
+        if method_ == "shrunk":
+            # the shrinkage selected for each channel type
+            covs[-1]["shrinkage"] = {ch_type: float(shrinkage) for ch_type, shrinkage, _ in shrinkages}
+    if len(covs) > 1:
+        covs.sort(key=lambda cov: cov["loglik"], reverse=True)
+    return covs if return_estimators else covs[0]
+
+
+def compute_segments_covariance(
+    segments: tp.Sequence[tp.Tuple[str, float, float]], method: str | tp.Sequence[str] = ("shrunk", "empirical"),
+    rank: str | dict = "info", n_workers: int = 1, block_size: int = 50, return_estimators: bool = False,
+) -> mne.Covariance | tp.List[mne.Covariance]:
+    """compute_raw_covariance of the concatenation of the (fname, tmin, tmax) segments, without loading them
+
+    Each segment is cropped as raw.crop(tmin, tmax), and read from disk
+    block_size epochs at a time, by n_workers processes.
+    """
+    raws = [mne.io.read_raw_fif(fname, allow_maxshield=True, verbose=False).crop(tmin=tmin, tmax=tmax)
+            for fname, tmin, tmax in segments]
+    info = raws[0].info
+    picks = np.sort(np.concatenate([picks for _, picks in _picks_by_type(info)]))
+    ch_names = [info.ch_names[pick] for pick in picks]
+    step = int(round(TSTEP * info["sfreq"]))
+
+    starts = epoch_starts([raw.n_times for raw in raws], step)
+    offsets = np.concatenate([[0], np.cumsum([len(s) * step for s in starts])])
+    folds = fold_bounds(offsets[-1])
+    if offsets[-1] < len(picks):
+        raise ValueError(f"Not enough samples ({offsets[-1]}) for the covariance of {len(picks)} channels")
+
+    args = [(fname, tmin, tmax, ch_names, seg_starts, offset, folds, step, block_size)
+            for (fname, tmin, tmax), seg_starts, offset in zip(segments, starts, offsets)]
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results = list(executor.map(_accumulate_segment, *zip(*args)))
+    else:
+        results = [_accumulate_segment(*arg) for arg in args]
+
+    stats = empty_stats(len(picks))
+    for result in results:
+        for key in stats:
+            stats[key] += result[key]
+    return covariance_from_stats(stats, mne.pick_info(info, picks), method=method, rank=rank,
+                                 return_estimators=return_estimators)
@@ -0,0 +1,211 @@
+"""Executor of a graph of tasks, each one running a function of a pipeline script
+
+The stages of the pipeline are expanded into tasks (one per subject, per run
+or for the group), which depend on the tasks whose outputs they read. A task
+is started as soon as its dependencies are done, in a pool of processes, so
+that a subject can be in source reconstruction while another one is still
+being Maxwell filtered. When a task fails, the tasks depending on it are
+skipped and the other subjects go on. A task is only failed by a worker
+crash if it crashes when run alone (see run()).
+
+The numbered scripts cannot be imported by name: a task refers to a function
+by the path of its script, which each worker loads once (without running its
+__main__ block). The script is loaded under a name other processes cannot
+import: a task starting its own pool of spawned processes (e.g. the report)
+must send them functions of the utils modules, not of its script.
+"""
+
+import importlib.util
+import multiprocessing
+import sys
+import time
+import typing as tp
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from .parallel import set_num_threads
+
+# scripts already loaded by this process
+_SCRIPTS: tp.Dict[str, tp.Any] = {}
+
+
+def load_script(script: str | Path) -> tp.Any:
+    """Module of a pipeline script, loaded once per process"""
+    script = str(Path(script).resolve())
+    if script not in _SCRIPTS:
+        name = "".join(c if c.isalnum() else "_" for c in f"_pipeline_{Path(script).parent.name}_{Path(script).stem}")
+        spec = importlib.util.spec_from_file_location(name, script)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        _SCRIPTS[script] = module
+    return _SCRIPTS[script]
+
+
+def run_function(script: str, func: str, args: tuple, keep: bool = False) -> tp.Any:
+    """Call func(*args) of a script. Its result is only sent back if keep, e.g. not a forward solution"""
+    result = getattr(load_script(script), func)(*args)
+    return result if keep else None
+
+
+@dataclass
+class Task:
+    """Call of func(*args) of a script, for a subject and run (None for the group or the whole subject)
+
+    run is a run number, or the name of another unit of the subject (e.g. an
+    acquisition file). done is whether its outputs are up to date. If collect,
+    the results of the dependencies (in the order of deps) are passed as an
+    extra argument.
+    """
+
+    stage: str
+    subject: str | None
+    run: tp.Any
+    script: str
+    func: str
+    args: tuple = ()
+    deps: tp.List[str] = field(default_factory=list)
+    done: bool = False
+    collect: bool = False
+
+    @property
+    def name(self) -> str:
+        return task_name(self.stage, self.subject, self.run)
+
+
+def task_name(stage: str, subject: str | None = None, run: tp.Any = None) -> str:
+    parts = [stage] + ([subject] if subject is not None else [])
+    if run is not None:
+        parts.append(f"run-{run}" if isinstance(run, int) else str(run))
+    return "/".join(parts)
+
+
+def to_run(tasks: tp.Sequence[Task]) -> tp.List[Task]:
+    """Tasks which are not up to date, or which depend on a task to run, in the order of tasks
+
+    The tasks must be sorted so that each one comes after its dependencies.
+    """
+    names = set()
+    for task in tasks:
+        if not task.done or any(dep in names for dep in task.deps):
+            names.add(task.name)
+    return [task for task in tasks if task.name in names]
+
+
+def run(
+    tasks: tp.Sequence[Task], n_workers: int, num_threads: int, priority: tp.Callable[[Task], tp.Any] | None = None,
+) -> tp.Dict[str, str]:
+    """Run the tasks (sorted after their dependencies) at most n_workers at a time. Returns the status of each task
+
+    Among the tasks ready to start, the one with the highest priority is
+    started first, e.g. the later stages so that the subjects are finished
+    one after the other. Dependencies which are not in tasks are taken as done.
+
+    A worker which crashes (e.g. out of memory) breaks the pool, and all the
+    tasks running in it are interrupted: which one crashed is unknown. They
+    are run again one at a time, each alone in a pool of one worker, while the
+    other tasks go on in a new pool. Only a task which crashes when run alone
+    is failed.
+    """
+    pending = {task.name: task for task in tasks}
+    # results are only kept for the tasks which collect them
+    collected = {dep for task in tasks if task.collect for dep in task.deps}
+    results: tp.Dict[str, tp.Any] = {}
+    status: tp.Dict[str, str] = {}
+    # future -> (task, start time, whether it runs alone)
+    running: tp.Dict[tp.Any, tp.Tuple[Task, float, bool]] = {}
+    # tasks interrupted by a worker crash, waiting to run alone
+    isolated: tp.List[Task] = []
+
+    def new_executor(max_workers: int) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=set_num_threads,
+            initargs=(num_threads,),
+        )
+
+    def submit(executor: ProcessPoolExecutor, task: Task, alone: bool) -> None:
+        args = task.args + (([results.get(dep) for dep in task.deps],) if task.collect else ())
+        future = executor.submit(run_function, task.script, task.func, args, task.name in collected)
+        running[future] = task, time.perf_counter(), alone
+        status[task.name] = "running"
+
+    def interrupt(task: Task) -> None:
+        print(f"{task.name} interrupted by a worker crash, it will run again alone")
+        status[task.name] = "interrupted"
+        isolated.append(task)
+
+    executor = new_executor(n_workers)
+    solo: ProcessPoolExecutor | None = None
+    try:
+        while pending or running or isolated:
+            # tasks whose dependency failed will never run
+            for name, task in list(pending.items()):
+                failed = [dep for dep in task.deps if status.get(dep) in ("failed", "skipped")]
+                if failed:
+                    print(f"Skipping {name} ({failed[0]} {status[failed[0]]})")
+                    status[name] = "skipped"
+                    del pending[name]
+            # the interrupted tasks one at a time, next to the others
+            if isolated and len(running) < n_workers and not any(alone for _, _, alone in running.values()):
+                solo = solo or new_executor(1)
+                submit(solo, isolated.pop(0), alone=True)
+            ready = [task for task in pending.values()
+                     if all(dep not in pending and status.get(dep, "done") == "done" for dep in task.deps)]
+            if priority is not None:
+                ready.sort(key=priority, reverse=True)
+            for task in ready[:max(0, n_workers - len(running))]:
+                submit(executor, task, alone=False)
+                del pending[task.name]
+            if not running:
+                if pending:
+                    raise RuntimeError(f"Dependencies never done: {sorted(pending)}")
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = solo_broken = False
+            for future in finished:
+                task, start, alone = running.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    if alone:
+                        # it crashed its own worker
+                        solo_broken = True
+                        status[task.name] = "failed"
+                        print(f"{task.name} failed: {e!r}")
+                    else:
+                        broken = True
+                        interrupt(task)
+                    continue
+                except Exception as e:
+                    status[task.name] = "failed"
+                    print(f"{task.name} failed: {e!r}")
+                    continue
+                status[task.name] = "done"
+                if task.name in collected:
+                    results[task.name] = result
+                print(f"{task.name} done ({time.perf_counter() - start:.0f} s)")
+            # results are freed once all the tasks collecting them started
+            for name in [name for name in results if not any(
+                    name in task.deps for task in pending.values() if task.collect)]:
+                del results[name]
+            if broken:
+                # the other tasks of the broken pool are interrupted too (but those which already finished)
+                for future, (task, _, alone) in list(running.items()):
+                    if not alone and not (future.done() and future.exception() is None):
+                        del running[future]
+                        interrupt(task)
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = new_executor(n_workers)
+            if solo_broken:
+                solo.shutdown(wait=False, cancel_futures=True)
+                solo = None
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if solo is not None:
+            solo.shutdown(wait=True, cancel_futures=True)
+    return status
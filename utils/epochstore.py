@@ -0,0 +1,127 @@
+"""Epochs of a run persisted as a memory map, with their word metadata
+
+An epoch store is a folder holding:
+
+- data.npy: the epochs (epochs, channels, times) of the data channels, as
+  float32 after baseline correction, read with np.load(mmap_mode="r");
+- metadata.tsv: one row per epoch (the aligned words and their features);
+- info.fif: the measurement info of the channels, and epochs.json the first
+  time and the baseline of the epochs.
+
+It is filled while the epochs are read for the medians of the preprocessing
+(copy_to of utils/averaging.median_evokeds), and written to a temporary folder
+moved in place at the end, so that a crashed run leaves no partial store.
+Evoked responses of any metadata query are then computed from the stores
+without reading the raw files (see utils/contrasts.py).
+"""
+
+import contextlib
+import json
+import os
+import shutil
+import typing as tp
+from pathlib import Path
+
+import mne
+import numpy as np
+import pandas as pd
+
+from .averaging import BLOCK_MB, _chunks, data_picks, drop_bad
+
+DTYPE = np.float32
+
+
+@contextlib.contextmanager
+def writer(path: str | Path, epochs: mne.BaseEpochs) -> tp.Iterator[np.ndarray]:
+    """Store of the epochs at path, whose data (epochs, data_picks, times) the caller fills
+
+    Yields the memory map to fill, e.g. as copy_to of median_evokeds. The
+    bad epochs are dropped first, the metadata being those of the epochs kept.
+    """
+    path = Path(path)
+    drop_bad(epochs)
+    picks = data_picks(epochs.info)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    try:
+        data = np.lib.format.open_memmap(
+            tmp / "data.npy", mode="w+", dtype=DTYPE, shape=(len(epochs.events), len(picks), len(epochs.times)))
+        yield data
+        data.flush()
+        del data
+        metadata = epochs.metadata if epochs.metadata is not None else pd.DataFrame(index=range(len(epochs.events)))
+        metadata.to_csv(tmp / "metadata.tsv", sep="\t", index=False)
+        mne.io.write_info(tmp / "info.fif", mne.pick_info(epochs.info, picks))
+        (tmp / "epochs.json").write_text(json.dumps(dict(
+            tmin=float(epochs.times[0]), baseline=epochs.baseline, n_epochs=len(epochs.events)), indent=2))
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+
+
+def write(path: str | Path, epochs: mne.BaseEpochs, max_memory_mb: float | None = None) -> None:
+    """Store the epochs at path, reading them chunk by chunk (when no medians are computed along the way)"""
+    with writer(path, epochs) as data:
+        epoch_mb = data[0].size * 8 / 1024 ** 2 if len(data) else 1.
+        chunk = max(1, int((max_memory_mb or BLOCK_MB) // epoch_mb))
+        picks = data_picks(epochs.info)
+        for chunk_slice in _chunks(len(data), chunk):
+            data[chunk_slice] = epochs.get_data(picks=picks, item=np.arange(len(data))[chunk_slice])
+
+
+def files(path: str | Path) -> tp.List[Path]:
+    """Files of a store, e.g. the inputs of what is computed from it"""
+    return [Path(path) / name for name in ["data.npy", "metadata.tsv", "info.fif", "epochs.json"]]
+
+
+class EpochStore:
+    """Epochs of a run read from a store: the data stay on disk until they are indexed"""
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self.data = np.load(self.path / "data.npy", mmap_mode="r")
+        # words such as "nan" or "null" are not missing values
+        self.metadata = pd.read_csv(self.path / "metadata.tsv", sep="\t", keep_default_na=False, na_values=[""])
+        self.info = mne.io.read_info(self.path / "info.fif", verbose=False)
+        params = json.loads((self.path / "epochs.json").read_text())
+        self.tmin = params["tmin"]
+        self.baseline = tuple(params["baseline"]) if params["baseline"] is not None else None
+        if len(self.metadata) != len(self.data):
+            raise ValueError(f"{self.path} has {len(self.data)} epochs but {len(self.metadata)} metadata rows")
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def select(self, query: str) -> np.ndarray:
+        """Positions of the epochs whose metadata match query (pandas syntax, as epochs[query])"""
+        return self.metadata.reset_index(drop=True).query(query, engine="python").index.to_numpy()
+
+    def evoked(self, query: str, method: str = "mean", max_memory_mb: float | None = None) -> mne.Evoked:
+        """Mean or median evoked response of the epochs matching query, reading max_memory_mb at a time"""
+        idx = self.select(query)
+        if not len(idx):
+            raise ValueError(f"No epoch of {self.path.name} matches {query!r}")
+        n_channels, n_times = self.data.shape[1:]
+        budget = (max_memory_mb or BLOCK_MB) * 1024 ** 2
+        average = np.empty((n_channels, n_times))
+        if method == "mean":
+            # epochs read at once, summed in float64
+            chunk = max(1, int(budget // (n_channels * n_times * 8)))
+            average[:] = 0
+            for chunk_slice in _chunks(len(idx), chunk):
+                average += self.data[idx[chunk_slice]].sum(axis=0, dtype=np.float64)
+            average /= len(idx)
+        elif method == "median":
+            # channels whose epochs are read at once
+            block = max(1, int(budget // (len(idx) * n_times * 8)))
+            for block_slice in _chunks(n_channels, block):
+                average[block_slice] = np.median(self.data[idx, block_slice].astype(np.float64), axis=0)
+        else:
+            raise ValueError(f"method must be 'mean' or 'median', got {method!r}")
+        evoked = mne.EvokedArray(average, self.info, tmin=self.tmin, comment=query, nave=len(idx), verbose=False)
+        # the epochs were baseline corrected, as those averaged by epochs.average()
+        evoked.baseline = self.baseline
+        return evoked
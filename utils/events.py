@@ -0,0 +1,168 @@
+"""Events files with the trial_type column parsed into typed columns
+
+The trial_type column of the metadata holds the repr of a dict per event
+(e.g. "{'word': 'maison', ...}"). Each distinct value is parsed once with
+ast.literal_eval (never eval) and its keys become columns of the table. The
+parsed table is cached in the directory set by set_cache_dir() (e.g. under the
+derivatives, never next to the events file, whose directory may be read-only or
+shared), in an npz per file, and is only parsed again when the file changes. The values of the object columns (e.g. booleans
+with missing values, or ints mixed with strings) are stored as their repr and
+read back with ast.literal_eval, so that a cached read gives the same table as
+a fresh one.
+"""
+
+import ast
+import hashlib
+import json
+import os
+import typing as tp
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# bump when the layout of the cached tables changes
+CACHE_VERSION = 2
+
+_CACHE_DIR: Path | None = None
+
+
+def set_cache_dir(cache_dir: str | Path | None) -> None:
+    """Set the directory of the parsed tables (None to parse the files at each read)"""
+    global _CACHE_DIR
+    _CACHE_DIR = None if cache_dir is None else Path(cache_dir)
+
+
+def _literal(value: tp.Any) -> tp.Any:
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def parse_trial_type(trial_type: pd.Series) -> pd.DataFrame:
+    """One column per key of the dicts of a trial_type column, with the index of trial_type
+
+    Entries which are not dicts (e.g. NaN or plain strings) get NaN in every column
+    """
+    codes, uniques = pd.factorize(trial_type)
+    records = [_literal(value) for value in uniques]
+    records = [record if isinstance(record, dict) else {} for record in records]
+    records.append({})  # missing values (code -1)
+    table = pd.DataFrame.from_records(records).iloc[codes]
+    table.index = trial_type.index
+    return table.infer_objects()
+
+
+def _encode(value: tp.Any) -> str:
+    """repr of a value of an object column, which _decode reads back"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    text = repr(value)
+    try:
+        decoded = _decode(text)
+    except ValueError:
+        decoded = None
+    is_nan = isinstance(value, float) and value != value
+    if type(decoded) is not type(value) or not (is_nan or decoded == value):
+        raise ValueError(f"{value!r} has no literal repr")
+    return text
+
+
+def _decode(text: str) -> tp.Any:
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return float(text)  # nan, inf and -inf are not literals
+
+
+def _stamp(fname: Path, sha1: str | None = None) -> tp.Dict[str, tp.Any]:
+    stat = fname.stat()
+    if sha1 is None:
+        sha1 = hashlib.sha1(fname.read_bytes()).hexdigest()
+    return dict(version=CACHE_VERSION, size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha1=sha1)
+
+
+def cache_file(fname: str | Path) -> Path | None:
+    """npz of the parsed table of an events file in the cache directory (None without one)
+
+    Named after the file and a hash of its path, so that files of the same name in other directories do not share it.
+    """
+    if _CACHE_DIR is None:
+        return None
+    fname = Path(fname).resolve()
+    return _CACHE_DIR / f"{fname.name}.{hashlib.sha1(str(fname).encode()).hexdigest()[:12]}.npz"
+
+
+def _save(events: pd.DataFrame, cache: Path, stamp: tp.Dict[str, tp.Any]) -> None:
+    arrays = {"columns": np.array(events.columns, dtype=str), "stamp": np.array(json.dumps(stamp))}
+    for k, name in enumerate(events.columns):
+        values = events[name]
+        if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            arrays[f"data{k}"] = values.to_numpy()
+        else:
+            # stored as fixed-width unicode, so the cache loads without pickle
+            arrays[f"repr{k}"] = np.array([_encode(value) for value in values], dtype=str)
+            arrays[f"dtype{k}"] = np.array(str(values.dtype))  # e.g. the str dtype of pandas >= 3
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache.with_name(f"{cache.name}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, cache)
+
+
+def _load(cache: Path) -> tp.Tuple[pd.DataFrame, tp.Dict[str, tp.Any]]:
+    with np.load(cache) as npz:
+        columns = {}
+        for k, name in enumerate(npz["columns"].tolist()):
+            if f"repr{k}" in npz:
+                values = pd.Series([_decode(text) for text in npz[f"repr{k}"].tolist()], dtype=object)
+                dtype = npz[f"dtype{k}"].item()
+                columns[name] = values if dtype == "object" else values.astype(dtype)
+            else:
+                columns[name] = npz[f"data{k}"]
+        stamp = json.loads(npz["stamp"].item())
+    return pd.DataFrame(columns), stamp
+
+
+def _write_cache(events: pd.DataFrame, cached: Path, stamp: tp.Dict[str, tp.Any]) -> None:
+    try:
+        _save(events, cached, stamp)
+    except (OSError, ValueError) as e:  # e.g. read-only cache directory, or values without a literal repr
+        print(f"Could not cache the parsed events in {cached}: {e}")
+
+
+def read_events(fname: str | Path, sep: str = "\t", cache: bool = True) -> pd.DataFrame:
+    """Read an events file and parse its trial_type column into typed columns
+
+    Columns already present in the file take precedence over the keys of the
+    trial_type dicts. With cache (and a cache directory set), the parsed table
+    is stored and reused as long as the file is unchanged (same size and mtime,
+    or same content hash after a touch or a copy).
+    """
+    fname = Path(fname)
+    cached = cache_file(fname)
+    cache = cache and cached is not None
+    sha1 = None
+    if cache and cached.exists():
+        try:
+            events, stamp = _load(cached)
+        except (OSError, ValueError, KeyError):
+            stamp = {}
+        current = fname.stat()
+        if stamp.get("version") == CACHE_VERSION and stamp.get("size") == current.st_size:
+            if stamp.get("mtime_ns") == current.st_mtime_ns:
+                return events
+            sha1 = hashlib.sha1(fname.read_bytes()).hexdigest()
+            if stamp.get("sha1") == sha1:
+                _write_cache(events, cached, _stamp(fname, sha1))
+                return events
+
+    events = pd.read_csv(fname, sep=sep)
+    if "trial_type" in events.columns:
+        parsed = parse_trial_type(events["trial_type"])
+        parsed = parsed.drop(columns=[c for c in parsed.columns if c in events.columns])
+        events = pd.concat([events, parsed], axis=1)
+    if cache:
+        _write_cache(events, cached, _stamp(fname, sha1))
+    return events
@@ -0,0 +1,107 @@
+"""Group average of source estimates in constant memory
+
+The subjects are added one by one to running sums and sums of squares, from
+which the mean and the variance across subjects are computed: only one subject
+is in memory at a time. The accumulator is saved with the file stamps of the
+estimates it holds, so that a new subject can be added to a saved one without
+reading the others again.
+"""
+
+import json
+import typing as tp
+from pathlib import Path
+
+import mne
+import numpy as np
+
+from . import buildcache
+
+
+def max_normalize(data: np.ndarray) -> np.ndarray:
+    """Data divided by their maximum"""
+    return data / np.max(data)
+
+
+# per-subject normalizations, by name (saved with the accumulator)
+NORMALIZATIONS: tp.Dict[str, tp.Callable[[np.ndarray], np.ndarray] | None] = dict(none=None, max=max_normalize)
+
+
+class GroupAccumulator:
+    """Running sums and sums of squares of the estimates of the subjects, on the same vertices and times"""
+
+    def __init__(self, normalization: str = "none") -> None:
+        if normalization not in NORMALIZATIONS:
+            raise ValueError(f"normalization must be one of {sorted(NORMALIZATIONS)}, got {normalization!r}")
+        self.normalization = normalization
+        self.sums: np.ndarray | None = None
+        self.sums_sq: np.ndarray | None = None
+        self.vertices: tp.List[np.ndarray] = []
+        self.tmin = 0.0
+        self.tstep = 1.0
+        self.subject: str | None = None
+        # file stamp of the estimate of each subject added
+        self.inputs: tp.Dict[str, tp.Dict[str, tp.Any]] = {}
+
+    @property
+    def n(self) -> int:
+        return len(self.inputs)
+
+    def add(self, key: str, stc: mne.SourceEstimate, fname: str | Path | None = None) -> None:
+        """Add the estimate of a subject (read from fname, stamped to detect changes)"""
+        if key in self.inputs:
+            raise ValueError(f"{key} is already in the group average")
+        normalize = NORMALIZATIONS[self.normalization]
+        data = np.asarray(stc.data, dtype=np.float64)
+        if normalize is not None:
+            data = normalize(data)
+        if self.sums is None:
+            self.sums, self.sums_sq = np.zeros_like(data), np.zeros_like(data)
+            self.vertices = [v.copy() for v in stc.vertices]
+            self.tmin, self.tstep, self.subject = stc.tmin, stc.tstep, stc.subject
+        elif data.shape != self.sums.shape or not all(
+            np.array_equal(a, b) for a, b in zip(stc.vertices, self.vertices)
+        ):
+            raise ValueError(f"The estimate of {key} is not on the vertices and times of the group")
+        self.sums += data
+        self.sums_sq += data ** 2
+        self.inputs[key] = buildcache.file_stamp(fname) if fname is not None else {}
+
+    def up_to_date(self, key: str, fname: str | Path) -> bool:
+        """Whether the estimate of key was added, from the current file fname"""
+        return key in self.inputs and buildcache.unchanged(fname, self.inputs[key])
+
+    def _stc(self, data: np.ndarray) -> mne.SourceEstimate:
+        return mne.SourceEstimate(data, self.vertices, tmin=self.tmin, tstep=self.tstep, subject=self.subject)
+
+    def mean(self) -> mne.SourceEstimate:
+        if not self.n:
+            raise ValueError("No subject in the group average")
+        return self._stc(self.sums / self.n)
+
+    def variance(self, ddof: int = 1) -> mne.SourceEstimate:
+        """Variance across subjects (ddof=1: unbiased)"""
+        if self.n <= ddof:
+            raise ValueError(f"The variance needs more than {ddof} subjects, got {self.n}")
+        mean = self.sums / self.n
+        # clipped: rounding can make it slightly negative where the subjects agree
+        return self._stc(np.maximum(self.sums_sq - self.n * mean ** 2, 0) / (self.n - ddof))
+
+    def save(self, fname: str | Path) -> None:
+        fname = Path(fname)
+        tmp = fname.with_name(f"{fname.name}.tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, sums=self.sums, sums_sq=self.sums_sq, tmin=self.tmin, tstep=self.tstep,
+                     meta=json.dumps(dict(normalization=self.normalization, subject=self.subject, inputs=self.inputs)),
+                     **{f"vertices_{k}": vertices for k, vertices in enumerate(self.vertices)})
+        tmp.replace(fname)
+
+    @classmethod
+    def load(cls, fname: str | Path) -> "GroupAccumulator":
+        with np.load(fname) as f:
+            meta = json.loads(str(f["meta"]))
+            acc = cls(meta["normalization"])
+            acc.sums, acc.sums_sq = f["sums"], f["sums_sq"]
+            acc.tmin, acc.tstep = float(f["tmin"]), float(f["tstep"])
+            acc.vertices = [f[f"vertices_{k}"] for k in range(sum(key.startswith("vertices_") for key in f.files))]
+        acc.subject, acc.inputs = meta["subject"], meta["inputs"]
+        return acc
@@ -0,0 +1,212 @@
+"""Source estimates of many evokeds or epochs with a single imaging kernel
+
+apply_inverse prepares the inverse operator (for the nave of the data, lambda2
+and the method) and assembles its imaging kernel on every call. The kernel only
+depends on the operator and on (nave, lambda2, method): it is assembled once,
+kept in memory and on disk (next to the operator, with a build sidecar), and
+applied to a whole block of evokeds or epochs as one matrix product, the
+estimates being written to disk block by block.
+
+The kernel is assembled by the private _assemble_kernel of apply_inverse
+(checked with MNE 1.6 to 1.13): its import and parameters are checked when this
+module is imported, and test/check_inverse.py compares the estimates with
+apply_inverse and apply_inverse_epochs.
+"""
+
+import inspect
+import typing as tp
+from pathlib import Path
+
+import mne
+import numpy as np
+from mne.minimum_norm import prepare_inverse_operator, read_inverse_operator
+from mne.io.constants import FIFF
+
+try:
+    from mne.minimum_norm.inverse import _assemble_kernel
+except ImportError as e:
+    raise ImportError(f"utils/inverse.py needs _assemble_kernel of mne.minimum_norm.inverse (MNE 1.6 to 1.13), "
+                      f"not found in MNE {mne.__version__}") from e
+if not {"inv", "label", "method", "pick_ori"} <= set(inspect.signature(_assemble_kernel).parameters):
+    raise ImportError(f"mne.minimum_norm.inverse._assemble_kernel of MNE {mne.__version__} does not take the "
+                      "parameters of MNE 1.6 to 1.13")
+
+from . import buildcache
+
+CODE_VERSION = buildcache.code_version(__file__)
+
+# kernels already loaded by this process
+_KERNELS: tp.Dict[tp.Tuple, "InverseKernel"] = {}
+
+
+class InverseKernel:
+    """Imaging kernel of an inverse operator prepared for (nave, lambda2, method)
+
+    The estimate of data (channels x times) is combine(kernel @ data) * noise_norm,
+    combine being the norm of the 3 current components of the free orientations.
+    """
+
+    def __init__(
+        self, kernel: np.ndarray, noise_norm: np.ndarray | None, vertices: tp.List[np.ndarray],
+        ch_names: tp.List[str], n_ori: int, subject: str | None, nave: int,
+    ) -> None:
+        self.kernel = kernel
+        self.noise_norm = noise_norm
+        self.vertices = vertices
+        self.ch_names = ch_names
+        self.n_ori = n_ori
+        self.subject = subject
+        self.nave = nave
+
+    @classmethod
+    def from_inverse(
+        cls, inverse_operator: mne.minimum_norm.InverseOperator, nave: int, lambda2: float, method: str = "dSPM",
+        pick_ori: str | None = None,
+    ) -> "InverseKernel":
+        """Kernel of apply_inverse(data with nave, inverse_operator, lambda2, method, pick_ori) (None or 'normal')"""
+        if pick_ori not in (None, "normal"):
+            raise ValueError(f"pick_ori must be None or 'normal', got {pick_ori!r}")
+        inv = prepare_inverse_operator(inverse_operator, nave, lambda2, method, verbose=False)
+        kernel, noise_norm, vertices, _ = _assemble_kernel(inv, None, method, pick_ori, verbose=False)
+        free_ori = inv["source_ori"] == FIFF.FIFFV_MNE_FREE_ORI and pick_ori != "normal"
+        subject = inv["src"]._subject
+        return cls(kernel, noise_norm, vertices, list(inv["noise_cov"].ch_names), 3 if free_ori else 1, subject, nave)
+
+    def save(self, fname: str | Path) -> None:
+        with open(fname, "wb") as f:  # np.savez would add .npz to the name
+            np.savez(f, kernel=self.kernel, noise_norm=np.array([]) if self.noise_norm is None else self.noise_norm,
+                     n_ori=self.n_ori, ch_names=np.array(self.ch_names), subject=str(self.subject or ""), nave=self.nave,
+                     **{f"vertices_{k}": vertices for k, vertices in enumerate(self.vertices)})
+
+    @classmethod
+    def load(cls, fname: str | Path) -> "InverseKernel":
+        with np.load(fname) as f:
+            n_spaces = sum(key.startswith("vertices_") for key in f.files)
+            noise_norm = f["noise_norm"] if f["noise_norm"].size else None
+            return cls(f["kernel"], noise_norm, [f[f"vertices_{k}"] for k in range(n_spaces)],
+                       f["ch_names"].tolist(), int(f["n_ori"]), str(f["subject"]) or None, int(f["nave"]))
+
+    @property
+    def n_sources(self) -> int:
+        return self.kernel.shape[0] // self.n_ori
+
+    def check_channels(self, info: mne.Info) -> None:
+        missing = sorted(set(self.ch_names) - set(info["ch_names"]))
+        if missing:
+            raise ValueError(f"{len(missing)} channels of the inverse operator are not in the data ({missing})")
+
+    def apply(self, data: np.ndarray) -> np.ndarray:
+        """Estimates of a stack of data (... x channels of the kernel x times): ... x sources x times"""
+        *batch, n_channels, n_times = data.shape
+        # one product for the whole stack: channels x (items x times)
+        data = np.moveaxis(data.reshape(-1, n_channels, n_times), 1, 0).reshape(n_channels, -1)
+        sol = self.kernel @ data
+        if self.n_ori == 3:
+            sol = np.sqrt((sol.reshape(self.n_sources, 3, -1) ** 2).sum(axis=1))
+        if self.noise_norm is not None:
+            sol *= self.noise_norm
+        sol = sol.reshape(self.n_sources, -1, n_times)
+        return np.moveaxis(sol, 1, 0).reshape(*batch, self.n_sources, n_times)
+
+    def to_stc(self, sol: np.ndarray, tmin: float, tstep: float) -> mne.SourceEstimate:
+        return mne.SourceEstimate(sol, self.vertices, tmin=tmin, tstep=tstep, subject=self.subject)
+
+    def apply_evoked(self, evoked: mne.Evoked) -> mne.SourceEstimate:
+        """Same as apply_inverse(evoked, ...) with the parameters of the kernel"""
+        self.check_channels(evoked.info)
+        if evoked.nave != self.nave:
+            raise ValueError(f"The kernel was prepared for nave={self.nave}, got an evoked with nave={evoked.nave}")
+        sol = self.apply(evoked.data[[evoked.ch_names.index(name) for name in self.ch_names]])
+        return self.to_stc(sol, evoked.times[0], 1.0 / evoked.info["sfreq"])
+
+
+def kernel_fname(inv_fname: str | Path, nave: int, lambda2: float, method: str, pick_ori: str | None = None) -> Path:
+    inv_fname = Path(inv_fname)
+    stem = inv_fname.name[: -len("-inv.fif")] if inv_fname.name.endswith("-inv.fif") else inv_fname.stem
+    ori = "" if pick_ori is None else f"_{pick_ori}"
+    return inv_fname.with_name(f"{stem}_{method}{ori}_lambda2-{lambda2:g}_nave-{nave}-kernel.npz")
+
+
+def get_kernel(
+    inv_fname: str | Path, nave: int, lambda2: float, method: str = "dSPM", pick_ori: str | None = None,
+    store: bool = True,
+) -> InverseKernel:
+    """Kernel of the inverse operator of inv_fname, from memory or disk if up to date, else assembled
+
+    With store, an assembled kernel is saved next to the operator.
+    """
+    fname = kernel_fname(inv_fname, nave, lambda2, method, pick_ori)
+    fingerprint = buildcache.fingerprint(
+        [inv_fname], params=dict(nave=nave, lambda2=lambda2, method=method, pick_ori=pick_ori), code=CODE_VERSION)
+    key = (str(fname), *(stamp.get("sha1", stamp["mtime_ns"]) for stamp in fingerprint["inputs"].values()))
+    if key in _KERNELS:
+        return _KERNELS[key]
+    if buildcache.up_to_date(fname, fingerprint):
+        kernel = InverseKernel.load(fname)
+    else:
+        kernel = InverseKernel.from_inverse(read_inverse_operator(inv_fname, verbose=False), nave, lambda2, method,
+                                            pick_ori)
+        if store:
+            kernel.save(fname)
+            buildcache.record(fname, fingerprint)
+    _KERNELS[key] = kernel
+    return kernel
+
+
+def _data_blocks(
+    insts: mne.BaseEpochs | tp.Sequence[mne.Evoked], ch_names: tp.List[str], n_items: int
+) -> tp.Iterator[np.ndarray]:
+    """Data of the evokeds or epochs, by blocks of n_items, on the given channels"""
+    if isinstance(insts, mne.BaseEpochs):
+        picks = [insts.ch_names.index(name) for name in ch_names]
+        block = []
+        for epoch in insts:  # read epoch by epoch if not preloaded
+            block.append(epoch[picks])
+            if len(block) == n_items:
+                yield np.stack(block)
+                block = []
+        if block:
+            yield np.stack(block)
+        return
+    for start in range(0, len(insts), n_items):
+        yield np.stack([evoked.data[[evoked.ch_names.index(name) for name in ch_names]]
+                        for evoked in insts[start:start + n_items]])
+
+
+def apply_kernel(
+    kernel: InverseKernel, insts: mne.BaseEpochs | tp.Sequence[mne.Evoked], out_fname: str | Path,
+    max_block_mb: float = 1024.0, dtype: tp.Any = np.float32,
+) -> np.ndarray:
+    """Estimates of all the epochs (or evokeds, of a same time range and nave) in an .npy file of items x sources x times
+
+    The data are read and the estimates written by blocks of items which
+    take at most max_block_mb in memory. Returns the estimates memory-mapped.
+    Epochs which are not preloaded are read one by one, once their bad epochs
+    have been dropped. As apply_inverse_epochs, single epochs need a kernel
+    prepared for nave=1.
+    """
+    if isinstance(insts, mne.BaseEpochs):
+        if kernel.nave != 1:
+            raise ValueError(f"The kernel was prepared for nave={kernel.nave}, epochs need nave=1")
+        insts.drop_bad()
+        n_items, times = len(insts), insts.times
+        kernel.check_channels(insts.info)
+    else:
+        n_items, times = len(insts), insts[0].times
+        for evoked in insts:
+            if not np.array_equal(evoked.times, times):
+                raise ValueError("The evokeds must have the same times")
+            if evoked.nave != kernel.nave:
+                raise ValueError(f"The kernel was prepared for nave={kernel.nave}, got an evoked with nave={evoked.nave}")
+            kernel.check_channels(evoked.info)
+    # memory of a block: its data, the kernel product and the estimates
+    item_mb = (len(kernel.ch_names) + kernel.kernel.shape[0] + kernel.n_sources) * len(times) * 8 / 1024**2
+    block_items = max(1, int(max_block_mb // item_mb))
+
+    out = np.lib.format.open_memmap(out_fname, mode="w+", dtype=dtype, shape=(n_items, kernel.n_sources, len(times)))
+    start = 0
+    for data in _data_blocks(insts, kernel.ch_names, block_items):
+        out[start:start + len(data)] = kernel.apply(data)
+        start += len(data)
+    out.flush()
+    return out
@@ -0,0 +1,129 @@
+"""Cached word frequencies
+
+zipf_frequency is called for every word of every run of every subject, while
+all the participants hear the same story. The frequencies are memoized in
+process (LRU) and in an SQLite table keyed by (word, language, wordfreq version),
+which can be shared by all the worker processes of a study.
+"""
+
+import sqlite3
+import typing as tp
+from collections import OrderedDict
+from importlib.metadata import version
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from wordfreq import zipf_frequency
+
+from .events import read_events
+
+WORDFREQ_VERSION = version("wordfreq")
+
+# number of (word, language) frequencies kept in process
+MEMORY_SIZE = 2**16
+
+_MEMORY: "OrderedDict[tp.Tuple[str, str], float]" = OrderedDict()
+_CACHE_FILE: Path | None = None
+_CONNECTION: sqlite3.Connection | None = None
+
+
+def set_cache_file(cache_file: str | Path | None) -> None:
+    """Set the SQLite file of the on-disk cache (None to only cache in process)"""
+    global _CACHE_FILE, _CONNECTION
+    if _CONNECTION is not None:
+        _CONNECTION.close()
+    _CACHE_FILE = None if cache_file is None else Path(cache_file)
+    _CONNECTION = None
+
+
+def _connection() -> sqlite3.Connection | None:
+    global _CONNECTION
+    if _CONNECTION is None and _CACHE_FILE is not None:
+        _CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        # each process opens its own connection, WAL lets them read while one writes
+        _CONNECTION = sqlite3.connect(_CACHE_FILE, timeout=60)
+        _CONNECTION.execute("PRAGMA journal_mode=WAL")
+        _CONNECTION.execute(
+            "CREATE TABLE IF NOT EXISTS wordfreq ("
+            "word TEXT, lang TEXT, version TEXT, freq REAL, PRIMARY KEY (word, lang, version))"
+        )
+    return _CONNECTION
+
+
+def _lookup(words: tp.List[str], lang: str) -> tp.Dict[str, float]:
+    """Frequencies of distinct words, read from the disk cache and computed if missing"""
+    freqs: tp.Dict[str, float] = {}
+    con = _connection()
+    if con is not None:
+        for start in range(0, len(words), 500):  # stay below the SQLite variable limit
+            chunk = words[start : start + 500]
+            rows = con.execute(
+                f"SELECT word, freq FROM wordfreq WHERE lang = ? AND version = ? "
+                f"AND word IN ({', '.join('?' * len(chunk))})",
+                [lang, WORDFREQ_VERSION, *chunk],
+            )
+            freqs.update(rows)
+    missing = {word: zipf_frequency(word, lang) for word in words if word not in freqs}
+    if con is not None and missing:
+        with con:
+            con.executemany(
+                "INSERT OR IGNORE INTO wordfreq VALUES (?, ?, ?, ?)",
+                [(word, lang, WORDFREQ_VERSION, freq) for word, freq in missing.items()],
+            )
+    freqs.update(missing)
+    return freqs
+
+
+def _remember(key: tp.Tuple[str, str], freq: float) -> None:
+    _MEMORY[key] = freq
+    _MEMORY.move_to_end(key)
+    if len(_MEMORY) > MEMORY_SIZE:
+        _MEMORY.popitem(last=False)
+
+
+def lookup(words: tp.Iterable[str], lang: str = "fr") -> tp.Dict[str, float]:
+    """Frequencies of distinct words, from the in-process LRU, then the disk cache, then wordfreq"""
+    freqs: tp.Dict[str, float] = {}
+    missing = []
+    for word in set(words):
+        if (word, lang) in _MEMORY:
+            freqs[word] = _MEMORY[word, lang]
+            _MEMORY.move_to_end((word, lang))
+        else:
+            missing.append(word)
+    for word, freq in _lookup(missing, lang).items():
+        _remember((word, lang), freq)
+        freqs[word] = freq
+    return freqs
+
+
+def get_wordfreq(word: str, lang: str = "fr") -> float:
+    return lookup([word], lang)[word]
+
+
+def word_frequencies(words: pd.Series, lang: str = "fr") -> np.ndarray:
+    """Zipf frequencies of a column of words, with one cache look-up for the whole column
+
+    Entries which are not strings (e.g. NaN for non-word events) get a NaN frequency
+    """
+    is_word = words.map(lambda x: isinstance(x, str)).to_numpy(dtype=bool)
+    uniques, inverse = np.unique(words[is_word].to_numpy(dtype=str), return_inverse=True)
+    freqs = lookup(uniques.tolist(), lang)
+    out = np.full(len(words), np.nan)
+    out[is_word] = np.array([freqs[word] for word in uniques], dtype=float)[inverse]
+    return out
+
+
+def prewarm(metadata_dir: str | Path, lang: str = "fr", pattern: str = "*_events.tsv") -> int:
+    """Fill the cache with the words of all the events files of the metadata directory
+
+    Returns the number of distinct words
+    """
+    words: tp.Set[str] = set()
+    for fname in sorted(Path(metadata_dir).glob(pattern)):
+        events = read_events(fname)
+        if "word" in events.columns:
+            words.update(word for word in events["word"].unique() if isinstance(word, str))
+    lookup(words, lang)
+    return len(words)
@@ -0,0 +1,228 @@
+"""Approximate matching of the word onsets of the metadata with the triggers"""
+
+import itertools
+import typing as tp
+
+import numpy as np
+
+
+class NoApproximateMatch(ValueError):
+    """Error raised when the function could not fully match the two list
+    The error has a 'match' attribute holding the matches so far, for debugging
+    """
+
+    def __init__(self, msg: str, matches: tp.Any) -> None:
+        super().__init__(msg)
+        self.matches = matches
+
+
+def _diff_to(sequence: tp.Sequence[float], last: int, ind: int) -> np.ndarray:
+    """Differences between the values around index last and the value at last"""
+    sub = sequence[last : last + ind] if ind > 0 else sequence[last + ind : last]
+    return np.array(sub) - sequence[last]
+
+
+# above this number of walks, advancing them together on arrays beats walking them one by one
+_MIN_VECTORIZED_WALKS = 64
+
+
+def _walk(
+    seq1: tp.List[float],
+    seq2: tp.List[float],
+    state: tp.Tuple[int, int, int, int],
+    abs_tol: float,
+    rel_tol: float,
+    max_missing: int,
+    seen: tp.Dict[tp.Tuple[int, int], tp.Tuple[int, int]],
+    walk: tp.Tuple[int, int],
+) -> tp.Tuple[tp.List[int], tp.List[int], bool, int, int, tp.Tuple[int, int] | None]:
+    """Greedy matching of a single walk from state (cur1, cur2, last1, last2)
+
+    seen maps the matches found by the previous walks to (walk, position in its
+    matches): once the walk finds one of them, it shares the future of that walk.
+    walk is (index of this walk, number of matches before state), to fill seen.
+
+    Returns the new matches on each sequence, whether the walk aborted,
+    the last matched indices and the (walk, position) followed after a merge
+    """
+    cur1, cur2, last1, last2 = state
+    n1, n2 = len(seq1), len(seq2)
+    matches1: tp.List[int] = []
+    matches2: tp.List[int] = []
+    while cur1 < n1 and cur2 < n2:
+        d1, d2 = seq1[cur1] - seq1[last1], seq2[cur2] - seq2[last2]
+        if abs(d1 - d2) <= max(abs_tol, rel_tol * min(abs(d1), abs(d2))):
+            matches1.append(cur1)
+            matches2.append(cur2)
+            last1, last2 = cur1, cur2
+            cur1, cur2 = cur1 + 1, cur2 + 1
+            if (last1, last2) in seen:
+                return matches1, matches2, False, last1, last2, seen[last1, last2]
+            seen[last1, last2] = (walk[0], walk[1] + len(matches1) - 1)
+        elif d2 < d1:
+            cur2 += 1
+        else:
+            cur1 += 1
+        # allow for 1 extra (absolute) step if getting closer
+        # need to check 2 tolerance so that we can match farther if it is closer
+        if cur1 + 1 < n1 and cur2 < n2:
+            d1, d1_next = seq1[cur1] - seq1[last1], seq1[cur1 + 1] - seq1[last1]
+            d2 = seq2[cur2] - seq2[last2]
+            if abs(d1_next - d1) <= 2 * abs_tol and abs(d1_next - d2) < abs(d1 - d2):
+                cur1 += 1
+        if cur2 + 1 < n2 and cur1 < n1:
+            d2, d2_next = seq2[cur2] - seq2[last2], seq2[cur2 + 1] - seq2[last2]
+            d1 = seq1[cur1] - seq1[last1]
+            if abs(d2_next - d2) <= 2 * abs_tol and abs(d2_next - d1) < abs(d2 - d1):
+                cur2 += 1
+        # if we are over the limit for matching, then abort
+        if cur1 - last1 > max_missing + 1 or cur2 - last2 > max_missing + 1:
+            return matches1, matches2, True, last1, last2, None
+    return matches1, matches2, False, last1, last2, None
+
+
+def approx_match_samples(
+    s1: tp.Sequence[float],
+    s2: tp.Sequence[float],
+    abs_tol: float,
+    rel_tol: float = 0.003,
+    max_missing: int = 3,
+    first_match: tp.Tuple[int, int] | None = None,
+) -> tp.Tuple[np.ndarray, np.ndarray]:
+    """
+    Approximate sample sequence matching
+    Eg:
+    seq0 = [1100, 2300, 3600]
+    seq1 = [0, 1110, 3620, 6500]
+    will match on 1100-1110 with tolerance 10,
+    and then on 3600-3620 (as the diffs match with tolerance 10)
+
+    When first_match is None, all the (max_missing + 1) ** 2 start offsets are
+    tried and the longest match is returned. While there are many of them, the
+    greedy walks of all the offsets are advanced together, one step at a time,
+    on NumPy arrays holding the state of every walk. Walks reaching the same
+    state share the same future, so they are merged and each state is only
+    explored once.
+
+    Returns
+    -------
+    tuple of indices which match on the first list and the second list
+    """
+    if first_match is None:
+        starts = list(itertools.product(range(max_missing + 1), repeat=2))
+    else:
+        starts = [tuple(first_match)]
+    seq1 = np.asarray(s1, dtype=float)
+    seq2 = np.asarray(s2, dtype=float)
+    n1, n2 = len(seq1), len(seq2)
+    n_walks = len(starts)
+    limit = max_missing + 1
+
+    # state of every walk: last matched index and current look-up index on each sequence
+    last1 = np.array([s[0] for s in starts], dtype=int)
+    last2 = np.array([s[1] for s in starts], dtype=int)
+    cur1, cur2 = last1 + 1, last2 + 1
+    # matches so far, each walk matches at most once per index of the shortest sequence
+    matches1 = np.zeros((n_walks, min(n1, n2) + 1), dtype=int)
+    matches2 = np.zeros_like(matches1)
+    matches1[:, 0], matches2[:, 0] = last1, last2
+    n_matches = np.ones(n_walks, dtype=int)
+    failed = np.zeros(n_walks, dtype=bool)
+    # walks merged into another one: walk -> (walk it follows, position of the shared future)
+    merges: tp.Dict[int, tp.Tuple[int, int]] = {}
+
+    active = np.flatnonzero((cur1 < n1) & (cur2 < n2))
+    while active.size >= _MIN_VECTORIZED_WALKS:
+        c1, c2, l1, l2 = cur1[active], cur2[active], last1[active], last2[active]
+        ref1, ref2 = seq1[l1], seq2[l2]
+        d1, d2 = seq1[c1] - ref1, seq2[c2] - ref2
+
+        # match if the diffs are within tolerance, otherwise move the one behind by one step
+        tol = np.maximum(abs_tol, rel_tol * np.minimum(np.abs(d1), np.abs(d2)))
+        matched = np.abs(d1 - d2) <= tol
+        rows, cols = active[matched], n_matches[active[matched]]
+        matches1[rows, cols], matches2[rows, cols] = c1[matched], c2[matched]
+        n_matches[rows] += 1
+        l1, l2 = np.where(matched, c1, l1), np.where(matched, c2, l2)
+        ref1, ref2 = seq1[l1], seq2[l2]
+        step2 = ~matched & (d2 < d1)
+        c1 = c1 + (matched | ~step2)
+        c2 = c2 + (matched | step2)
+
+        # allow for 1 extra (absolute) step if getting closer, first on s1 then on s2
+        for seq, cur, ref, n, other_seq, other_cur, other_ref, other_n in (
+            (seq1, c1, ref1, n1, seq2, c2, ref2, n2),
+            (seq2, c2, ref2, n2, seq1, c1, ref1, n1),
+        ):
+            ok = (cur + 1 < n) & (other_cur < other_n)
+            diff = seq[np.minimum(cur, n - 1)] - ref
+            diff_next = seq[np.minimum(cur + 1, n - 1)] - ref
+            other_diff = other_seq[np.minimum(other_cur, other_n - 1)] - other_ref
+            ok &= np.abs(diff_next - diff) <= 2 * abs_tol
+            ok &= np.abs(diff_next - other_diff) < np.abs(diff - other_diff)
+            cur += ok
+
+        cur1[active], cur2[active], last1[active], last2[active] = c1, c2, l1, l2
+
+        # if we are over the limit for matching, then abort
+        aborted = (c1 - l1 > limit) | (c2 - l2 > limit)
+        failed[active[aborted]] = True
+        keep = ~aborted & (c1 < n1) & (c2 < n2)
+        active = active[keep]
+
+        # merge the walks in the same state into the first of them
+        key = ((l2[keep] * n1 + l1[keep]) * (n2 + 2) + c2[keep]) * (n1 + 2) + c1[keep]
+        _, first, inverse = np.unique(key, return_index=True, return_inverse=True)
+        follows = active[first[inverse]]
+        for walk, other in zip(active[follows != active], follows[follows != active]):
+            merges[walk] = (other, n_matches[other])
+        active = active[follows == active]
+
+    # few walks are left: finish them one by one without the array overhead
+    list1, list2 = seq1.tolist(), seq2.tolist()
+    seen: tp.Dict[tp.Tuple[int, int], tp.Tuple[int, int]] = {}
+    for walk in active:
+        start = n_matches[walk]
+        new1, new2, failed[walk], last1[walk], last2[walk], follows = _walk(
+            list1,
+            list2,
+            (int(cur1[walk]), int(cur2[walk]), int(last1[walk]), int(last2[walk])),
+            abs_tol,
+            rel_tol,
+            max_missing,
+            seen,
+            (walk, start),
+        )
+        matches1[walk, start : start + len(new1)] = new1
+        matches2[walk, start : start + len(new2)] = new2
+        n_matches[walk] += len(new1)
+        if follows is not None:
+            merges[walk] = (follows[0], follows[1] + 1)
+
+    # merged walks share the matches of the walk they follow from the merge on
+    for walk in list(merges):
+        chain = [walk]
+        while chain[-1] in merges:
+            chain.append(merges[chain[-1]][0])
+        for walk in reversed(chain[:-1]):
+            other, at = merges.pop(walk)
+            n_new = n_matches[other] - at
+            matches1[walk, n_matches[walk] : n_matches[walk] + n_new] = matches1[other, at : n_matches[other]]
+            matches2[walk, n_matches[walk] : n_matches[walk] + n_new] = matches2[other, at : n_matches[other]]
+            n_matches[walk] += n_new
+            failed[walk], last1[walk], last2[walk] = failed[other], last1[other], last2[other]
+
+    success = np.flatnonzero(~failed)
+    if success.size:
+        best = success[np.argmax(n_matches[success])]
+        return matches1[best, : n_matches[best]], matches2[best, : n_matches[best]]
+
+    # report the walk which went the farthest in the first sequence
+    best = np.flatnonzero(failed)[np.argmax(last1[failed])]
+    out = (matches1[best, : n_matches[best]], matches2[best, : n_matches[best]])
+    seqs, lasts = (s1, s2), (int(last1[best]), int(last2[best]))
+    msg = f"Failed to match after indices {list(lasts)} "
+    msg += f"(values {[s[r] for s, r in zip(seqs, lasts)]}, first_match={starts[best]})\n"
+    msg += f"(follows:\n {_diff_to(s1, lasts[0], 10)}\n {_diff_to(s2, lasts[1], 10)}"
+    msg += f"(before:\n {_diff_to(s1, lasts[0], -10)}\n {_diff_to(s2, lasts[1], -10)}"
+    raise NoApproximateMatch(msg, matches=out)
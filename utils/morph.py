@@ -0,0 +1,120 @@
+"""Store of the morphs of the source estimates of each subject to fsaverage
+
+A surface SourceMorph is a sparse matrix (fsaverage vertices x subject
+vertices) which only depends on the spherical registrations of the two
+subjects, on the vertices of the source space of the subject and on the
+smoothing parameters. It is computed once and saved in the anatomy store (see
+anatomy.py) with a build sidecar, then shared by all the scripts which morph.
+The estimates of a subject (e.g. several contrasts) are morphed together, by a
+single sparse matrix product.
+
+MNE computes the morph through the morph maps it caches itself in
+subjects_dir/morph-maps, which it never checks against the registrations: maps
+older than the registrations are removed before a morph is computed again.
+"""
+
+import hashlib
+import typing as tp
+from pathlib import Path
+
+import mne
+import numpy as np
+
+from . import buildcache
+
+CODE_VERSION = buildcache.code_version(__file__)
+
+# morphs already loaded by this process
+_MORPHS: tp.Dict[tp.Tuple, mne.SourceMorph] = {}
+
+
+def vertices_hash(vertices: tp.Sequence[np.ndarray]) -> str:
+    """Hash of the vertices of a source space (or of the source estimates defined on it)"""
+    sha1 = hashlib.sha1()
+    for hemi_vertices in vertices:
+        sha1.update(np.asarray(hemi_vertices, dtype=np.int64).tobytes())
+        sha1.update(b"|")
+    return sha1.hexdigest()
+
+
+def _registrations(subjects_dir: Path, subject: str, subject_to: str) -> tp.List[Path]:
+    # surface morphs go through the spherical registrations of both subjects
+    return [Path(subjects_dir) / s / f"surf/{hemi}.sphere.reg" for s in [subject, subject_to] for hemi in ["lh", "rh"]]
+
+
+def morph_fname(
+    store: Path, subject: str, vertices: tp.Sequence[np.ndarray], subject_to: str = "fsaverage",
+    spacing: int = 5, smooth: int | str | None = None,
+) -> Path:
+    """One file per parameters, so that morphs with other parameters do not replace each other"""
+    tag = f"spacing-{spacing}_smooth-{smooth}_vertices-{vertices_hash(vertices)[:12]}"
+    return Path(store) / subject / f"{subject}-to-{subject_to}_{tag}-morph.h5"
+
+
+def morph_fingerprint(
+    subjects_dir: Path, subject: str, vertices: tp.Sequence[np.ndarray], subject_to: str = "fsaverage",
+    spacing: int = 5, smooth: int | str | None = None,
+) -> dict:
+    registrations = _registrations(subjects_dir, subject, subject_to)
+    return buildcache.fingerprint(registrations, params=dict(
+        subject_to=subject_to, spacing=spacing, smooth=smooth, vertices=vertices_hash(vertices)), code=CODE_VERSION)
+
+
+def drop_stale_morph_maps(subjects_dir: Path, subject: str, subject_to: str = "fsaverage") -> None:
+    """Remove the morph maps cached by MNE for subject and subject_to if older than one of their registrations"""
+    registrations = _registrations(subjects_dir, subject, subject_to)
+    newest = max(fname.stat().st_mtime_ns for fname in registrations)
+    for name in [f"{subject}-{subject_to}", f"{subject_to}-{subject}"]:
+        fname = Path(subjects_dir) / "morph-maps" / f"{name}-morph.fif"
+        if fname.exists() and fname.stat().st_mtime_ns < newest:
+            fname.unlink()
+
+
+def get_morph(
+    store: Path, subjects_dir: Path, stc: mne.SourceEstimate, subject: str, subject_to: str = "fsaverage",
+    spacing: int = 5, smooth: int | str | None = None,
+) -> mne.SourceMorph:
+    """Morph of the estimates of subject (defined on the vertices of stc), from memory or the store if up to date"""
+    fname = morph_fname(store, subject, stc.vertices, subject_to, spacing, smooth)
+    fingerprint = morph_fingerprint(subjects_dir, subject, stc.vertices, subject_to, spacing, smooth)
+    key = (str(fname), repr(sorted(fingerprint["params"].items())),
+           *(stamp.get("sha1", stamp["mtime_ns"]) for stamp in fingerprint["inputs"].values()))
+    if key in _MORPHS:
+        return _MORPHS[key]
+    if buildcache.up_to_date(fname, fingerprint):
+        morph = mne.read_source_morph(fname)
+    else:
+        drop_stale_morph_maps(subjects_dir, subject, subject_to)
+        morph = mne.compute_source_morph(stc, subject_from=subject, subject_to=subject_to, subjects_dir=subjects_dir,
+                                         spacing=spacing, smooth=smooth)
+        fname.parent.mkdir(parents=True, exist_ok=True)
+        morph.save(fname, overwrite=True)
+        buildcache.record(fname, fingerprint)
+    _MORPHS[key] = morph
+    return morph
+
+
+def apply_morph(morph: mne.SourceMorph, stcs: tp.Sequence[mne.SourceEstimate]) -> tp.List[mne.SourceEstimate]:
+    """morph.apply(stc) for each of the surface estimates stcs, by one product of the sparse morph matrix"""
+    if morph.kind != "surface":
+        raise ValueError(f"Only surface morphs are batched, got a {morph.kind} morph")
+    if not stcs:
+        return []
+    # the vertices of the subject the morph was computed on
+    vertices_from = morph.src_data["vertices_from"]
+    for stc in stcs:
+        if stc.subject is not None and stc.subject != morph.subject_from:
+            raise ValueError(f"stc.subject ({stc.subject}) != morph.subject_from ({morph.subject_from})")
+        if len(stc.vertices) != len(vertices_from) or not all(
+            np.array_equal(vertices, hemi_from) for vertices, hemi_from in zip(stc.vertices, vertices_from)
+        ):
+            raise ValueError(f"The estimate is not defined on the vertices the morph was computed from "
+                             f"({stc.data.shape[0]} and {morph.morph_mat.shape[1]} vertices)")
+    # vertices x (estimates x times)
+    data = morph.morph_mat @ np.concatenate([stc.data for stc in stcs], axis=1)
+    bounds = np.cumsum([0] + [stc.data.shape[1] for stc in stcs])
+    return [
+        mne.SourceEstimate(data[:, start:stop], morph.vertices_to, tmin=stc.tmin, tstep=stc.tstep,
+                           subject=morph.subject_to)
+        for stc, start, stop in zip(stcs, bounds[:-1], bounds[1:])
+    ]
@@ -0,0 +1,72 @@
+"""Split of the cores of the machine between worker processes, their jobs and BLAS threads
+
+Only uses the standard library, so that it can be imported before numpy: the
+number of BLAS threads is read from the environment when numpy is loaded.
+"""
+
+import os
+import typing as tp
+
+THREAD_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+
+
+def available_cpus() -> int:
+    """Number of cores this process may run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        return os.cpu_count() or 1
+
+
+def available_memory_gb() -> float | None:
+    """Memory available for new processes (None if unknown)"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024**2
+    except OSError:
+        pass
+    return None
+
+
+def split_resources(
+    n_tasks: int, memory_per_task_gb: float, n_workers: int | None = None, n_jobs: int | None = None,
+    num_threads: int | None = None,
+) -> tp.Tuple[int, int, int]:
+    """(worker processes, jobs per worker, BLAS threads per worker) to run n_tasks tasks
+
+    The values given are kept; the others are derived from the available cores
+    and memory: as many workers as tasks, cores, and tasks fitting in memory
+    allow. The cores of a worker are split between its jobs and threads, so
+    that jobs x threads fits in them: one job with all the cores as threads
+    by default, or as many of one as the other given leaves room for.
+    """
+    cpus = available_cpus()
+    if n_workers is None:
+        n_workers = min(n_tasks, cpus)
+        memory = available_memory_gb()
+        if memory is not None:
+            n_workers = min(n_workers, int(memory // memory_per_task_gb))
+    n_workers = max(1, n_workers)
+    per_worker = max(1, cpus // n_workers)
+    if n_jobs is None and num_threads is None:
+        n_jobs = 1
+    if num_threads is None:
+        num_threads = max(1, per_worker // n_jobs)
+    if n_jobs is None:
+        n_jobs = max(1, per_worker // num_threads)
+    return n_workers, n_jobs, num_threads
+
+
+def set_num_threads(num_threads: int) -> None:
+    """Set the number of BLAS/OpenMP threads of the current process (and of the processes it spawns)"""
+    for var in THREAD_VARS:
+        os.environ[var] = str(num_threads)
+    # The environment is only read when the BLAS libraries are loaded, so also
+    # limit the thread pools which are already running if threadpoolctl is available
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(int(num_threads))
@@ -0,0 +1,207 @@
+"""Incremental build of the HTML reports, section by section
+
+A report is a list of sections (e.g. the group results, then one section per
+subject), each rendered from a few derivatives by a function adding figures to
+an mne.Report. The HTML of each rendered section is cached (a JSON file with a
+build sidecar keyed on its inputs, parameters and code), so that only the
+sections whose inputs changed are rendered again, off-screen and in a process
+pool. The reports are then assembled from the cached sections, which is cheap.
+
+The cache relies on the internals of mne.Report, not on its public API: the
+elements of a section are read from the private Report._content, cached as the
+fields of the private _ContentElement, and appended back to _content when
+assembling. These change across MNE versions, so the version of MNE and the
+fields are part of the fingerprint of each section (a section rendered by
+another MNE is rendered again), and are checked when a report is assembled. A
+change of these internals can still break the cache within a version range,
+and then needs a change of this module.
+"""
+
+import dataclasses
+import importlib.machinery
+import json
+import multiprocessing
+import os
+import sys
+import typing as tp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from . import buildcache
+
+CODE_VERSION = buildcache.code_version(__file__)
+
+
+@dataclasses.dataclass
+class Section:
+    """Part of a report, rendered by render(report, **kwargs) from the input files and cached under name
+
+    render is sent to the worker processes, which import it by its module:
+    it should be defined in an importable module (e.g. render_evoked below).
+    The sections rendered by a pipeline script loaded by pipeline.py are
+    rendered in the calling process instead.
+    """
+
+    name: str
+    render: tp.Callable[..., None]
+    inputs: tp.List[Path]
+    kwargs: tp.Dict[str, tp.Any] = dataclasses.field(default_factory=dict)
+    # to assemble reports from part of the sections
+    tags: tp.Tuple[str, ...] = ()
+
+
+def section_fname(cache_dir: Path, name: str) -> Path:
+    return Path(cache_dir) / f"{name}.json"
+
+
+def element_fields() -> tp.List[str]:
+    """Fields of the elements of an mne.Report, as cached"""
+    import mne
+
+    try:
+        from mne.report.report import _ContentElement
+    except ImportError as e:
+        raise ImportError(f"The report sections cannot be cached with MNE {mne.__version__}: "
+                          "mne.report.report._ContentElement is missing") from e
+    return [field.name for field in dataclasses.fields(_ContentElement)]
+
+
+def section_fingerprint(section: Section, code: str | None = None) -> dict:
+    import mne
+
+    params = dict(section.kwargs, render=section.render.__qualname__, mne=mne.__version__, fields=element_fields())
+    return buildcache.fingerprint(section.inputs, params=params, code=f"{CODE_VERSION}-{code}")
+
+
+def render_evoked(report, fname: str, title: str, plot_title: str, times: tp.List[float], section: str | None = None) -> None:
+    """Joint plot of the first evoked response of fname"""
+    import mne
+
+    evoked = mne.read_evokeds(fname)[0]
+    fig = evoked.plot_joint(times=times, title=plot_title, picks="meg", exclude="bads", show=False)
+    report.add_figure(fig=fig, title=title, section=section)
+
+
+def render_stc(
+    report, fname: str, title: str, n_time_points: int, subject: str, subjects_dir: str, section: str | None = None
+) -> None:
+    """Source estimate of fname, on the surfaces of subject"""
+    import mne
+
+    stc = mne.read_source_estimate(fname)
+    report.add_stc(stc=stc, subject=subject, subjects_dir=subjects_dir, title=title,
+                   n_time_points=n_time_points, section=section)
+
+
+def importable(func: tp.Callable) -> bool:
+    """Whether a spawned process can import func by its module (not a pipeline script loaded by utils/dag.py)"""
+    module = func.__module__
+    if module == "__main__":
+        return True
+    top = module.partition(".")[0]
+    # not sys.modules, where the loaded scripts are too
+    return top in sys.builtin_module_names or importlib.machinery.PathFinder.find_spec(top) is not None
+
+
+def set_offscreen() -> None:
+    """Render the figures off-screen, without opening windows (in the current process)"""
+    import matplotlib
+
+    matplotlib.use("Agg")
+    try:
+        import pyvista
+    except ImportError:
+        return
+    pyvista.OFF_SCREEN = True
+
+
+def render_section(section: Section, cache_dir: Path, fingerprint: dict) -> str:
+    """Render a section and cache the HTML of its elements, with the fingerprint of its inputs"""
+    import matplotlib.pyplot as plt
+    import mne
+
+    report = mne.Report(verbose=False)
+    section.render(report, **section.kwargs)
+    plt.close("all")
+    elements = [dataclasses.asdict(element) for element in report._content]
+
+    fname = section_fname(cache_dir, section.name)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    tmp = fname.with_name(f"{fname.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(elements))
+    os.replace(tmp, fname)
+    buildcache.record(fname, fingerprint)
+    return section.name
+
+
+def render_sections(
+    sections: tp.Sequence[Section], cache_dir: Path, code: str | None = None, n_workers: int = 1
+) -> tp.List[str]:
+    """Render the sections which are not cached (or outdated), in n_workers processes
+
+    Returns the names of the sections which failed to render.
+    """
+    outdated = []
+    for section in sections:
+        fingerprint = section_fingerprint(section, code)
+        if not buildcache.up_to_date(section_fname(cache_dir, section.name), fingerprint):
+            outdated.append((section, fingerprint))
+    print(f"{len(outdated)} section(s) to render out of {len(sections)}")
+    failed = []
+    # rendered in this process: all of them with one worker, else those whose render the workers cannot import
+    local, pooled = [], []
+    for section, fingerprint in outdated:
+        parallel = n_workers > 1 and len(outdated) > 1 and importable(section.render)
+        (pooled if parallel else local).append((section, fingerprint))
+    if local:
+        set_offscreen()
+    for section, fingerprint in local:
+        try:
+            render_section(section, cache_dir, fingerprint)
+        except Exception as e:
+            print(f"Failed to render {section.name}: {e!r}")
+            failed.append(section.name)
+    if not pooled:
+        return failed
+    with ProcessPoolExecutor(
+        max_workers=min(n_workers, len(pooled)),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=set_offscreen,
+    ) as executor:
+        futures = {executor.submit(render_section, section, cache_dir, fingerprint): section.name
+                   for section, fingerprint in pooled}
+        for future in as_completed(futures):
+            try:
+                print(f"Rendered {future.result()}")
+            except Exception as e:
+                print(f"Failed to render {futures[future]}: {e!r}")
+                failed.append(futures[future])
+    return failed
+
+
+def assemble(
+    title: str, sections: tp.Sequence[Section], cache_dir: Path, fname: str | Path, tags: tp.Sequence[str] | None = None
+) -> None:
+    """Save the report of the cached sections (only those with one of tags, if given)"""
+    import mne
+    from mne.report.report import _ContentElement
+
+    fields = set(element_fields())
+    report = mne.Report(title=title, verbose=False)
+    for section in sections:
+        if tags is not None and not set(tags) & set(section.tags):
+            continue
+        cached = section_fname(cache_dir, section.name)
+        if not cached.exists():
+            print(f"Section {section.name} is missing from the report (not rendered)")
+            continue
+        for element in json.loads(cached.read_text()):
+            if set(element) != fields:
+                raise ValueError(f"Section {section.name} was cached with other report elements than those of "
+                                 f"MNE {mne.__version__} ({sorted(set(element) ^ fields)}): render it again")
+            element["tags"] = tuple(element["tags"])
+            # the sections are rendered separately: their elements must not share an id
+            if any(other.dom_id == element["dom_id"] for other in report._content):
+                raise ValueError(f"Two elements of the report have the id {element['dom_id']}")
+            report._content.append(_ContentElement(**element))
+    report.save(fname, overwrite=True, open_browser=False)
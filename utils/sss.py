@@ -0,0 +1,197 @@
+"""Memory-bounded band-pass filtering and Maxwell filtering of long runs
+
+The run is never loaded as a whole: it is read from disk in chunks (padded by
+one filter length on each side), band-pass filtered, Maxwell filtered and the
+result is written straight into the output FIF by Raw.save, which pulls the
+processed chunks one after the other through a lazy Raw.
+
+Without tSSS, the Maxwell filter is a spatial projection, and the padding makes
+the FIR filtering of each chunk identical to the filtering of the whole run,
+so the output matches the in-memory path up to floating point errors.
+
+The bad channel detection is only an approximation of find_bad_channels_maxwell
+on the whole run: the windows where each channel is noisy or flat are counted
+chunk by chunk, but find_bad_channels_maxwell excludes the channels flat on the
+whole run from its noisy detection, while here a channel is only excluded in
+the chunks where it is found flat, so it still takes part in the Maxwell fits
+of the noisy detection of the other chunks. This may change the noisy
+channels of a run with a channel flat in some chunks only.
+test/check_sss.py compares both paths on synthetic data.
+"""
+
+import typing as tp
+from collections import Counter
+
+import mne
+import numpy as np
+
+from .bads import count_bad_windows, select_bads
+
+# copies of a padded chunk alive at the peak (read, filtered, Maxwell filtered and its temporaries)
+_COPIES_PER_CHUNK = 6
+
+
+def chunk_bounds(n_times: int, chunk_samples: int, min_last: int = 1) -> tp.List[tp.Tuple[int, int]]:
+    """(start, stop) of consecutive chunks, the last one absorbing a remainder shorter than min_last"""
+    starts = list(range(0, n_times, chunk_samples))
+    stops = starts[1:] + [n_times]
+    if len(starts) > 1 and stops[-1] - starts[-1] < min_last:
+        starts.pop()
+        stops.pop(-2)
+    return list(zip(starts, stops))
+
+
+class ChunkedRun:
+    """Read padded chunks of a run from disk and band-pass filter them"""
+
+    def __init__(
+        self,
+        raw: mne.io.BaseRaw,
+        l_freq: float,
+        h_freq: float,
+        max_memory_mb: float,
+        step: int = 1,
+    ) -> None:
+        self.raw = raw
+        self.l_freq, self.h_freq = l_freq, h_freq
+        sfreq = raw.info["sfreq"]
+        # the output of the zero-phase FIR filter at a sample depends on
+        # half a filter length of data around it: pad with a whole one
+        self.pad = len(mne.filter.create_filter(None, sfreq, l_freq, h_freq, verbose=False))
+        budget = max_memory_mb * 1024**2 / (8 * len(raw.ch_names) * _COPIES_PER_CHUNK)
+        chunk_samples = max(int(budget) - 2 * self.pad, step)
+        # whole number of steps, e.g. the windows of the bad channel detection
+        self.chunk_samples = max(chunk_samples // step, 1) * step
+        self.bounds = chunk_bounds(raw.n_times, self.chunk_samples, min_last=step)
+
+    def filtered(self, start: int, stop: int) -> mne.io.RawArray:
+        """Band-pass filtered samples [start, stop) of the run, as a RawArray"""
+        first = max(start - self.pad, 0)
+        last = min(stop + self.pad, self.raw.n_times)
+        data = self.raw.get_data(start=first, stop=last)
+        padded = mne.io.RawArray(data, self.raw.info, first_samp=self.raw.first_samp + first, verbose=False)
+        padded.filter(self.l_freq, self.h_freq, verbose=False)
+        chunk = mne.io.RawArray(
+            padded.get_data(start=start - first, stop=stop - first),
+            padded.info,
+            first_samp=self.raw.first_samp + start,
+            verbose=False,
+        )
+        return chunk
+
+
+def find_bad_channels_chunked(
+    run: ChunkedRun, duration: float = 5.0, min_count: int = 5, every: int = 1, decim: int = 1, **kwargs: tp.Any
+) -> tp.Tuple[tp.List[str], tp.List[str]]:
+    """find_bad_channels_maxwell on the filtered chunks of a run
+
+    The chunks hold a whole number of detection windows, and the windows where
+    each channel is noisy or flat are counted across chunks, as the full-run
+    call does. This is an approximation: the full-run call excludes the
+    channels flat on the whole run from its noisy detection, while a channel
+    found flat in a chunk is not excluded from the noisy detection of the
+    following chunks. As in
+    bads.find_bad_channels, only one window out of every can be scanned, on
+    data decimated by decim.
+    """
+    noisy, flat = Counter(), Counter()
+    n_windows = 0
+    step = int(round(duration * run.raw.info["sfreq"]))
+    for start, stop in run.bounds:
+        chunk = run.filtered(start, stop)
+        chunk_noisy, chunk_flat, chunk_windows = count_bad_windows(
+            chunk, duration=duration, every=every, decim=decim, first_window=start // step, **kwargs
+        )
+        noisy.update(chunk_noisy)
+        flat.update(chunk_flat)
+        n_windows += chunk_windows
+    return select_bads(noisy, flat, n_windows, run.raw.ch_names, min_count=min_count, every=every)
+
+
+class _ProcessedChunks:
+    """Band-pass and Maxwell filtered chunks of a run, computed in order and on demand"""
+
+    def __init__(self, run: ChunkedRun, bads: tp.List[str], maxwell_kwargs: tp.Dict[str, tp.Any]) -> None:
+        self.run = run
+        self.bads = bads
+        self.maxwell_kwargs = maxwell_kwargs
+        self.current: tp.Tuple[int, int, np.ndarray] | None = None
+
+    def process(self, start: int, stop: int) -> mne.io.BaseRaw:
+        chunk = self.run.filtered(start, stop)
+        chunk.info["bads"] = list(self.bads)
+        return mne.preprocessing.maxwell_filter(chunk, verbose=False, **self.maxwell_kwargs)
+
+    def get(self, start: int, stop: int) -> np.ndarray:
+        """Processed samples [start, stop) of the run (indices from the start of the run)"""
+        out = None
+        pos = start
+        while pos < stop:
+            if self.current is None or not self.current[0] <= pos < self.current[1]:
+                first, last = next((b for b in self.run.bounds if b[0] <= pos < b[1]))
+                self.current = (first, last, self.process(first, last).get_data())
+            first, last, data = self.current
+            block = data[:, pos - first : min(stop, last) - first]
+            if out is None:
+                out = np.empty((data.shape[0], stop - start))
+            out[:, pos - start : pos - start + block.shape[1]] = block
+            pos += block.shape[1]
+        return out
+
+
+class _LazySSSRaw(mne.io.BaseRaw):
+    """Raw whose data are processed from the original run when they are read"""
+
+    def __init__(self, chunks: _ProcessedChunks, info: mne.Info) -> None:
+        raw = chunks.run.raw
+        super().__init__(
+            info,
+            preload=False,
+            first_samps=(raw.first_samp,),
+            last_samps=(raw.last_samp,),
+            raw_extras=[dict(chunks=chunks, first_samp=raw.first_samp)],
+            verbose=False,
+        )
+        self.set_annotations(raw.annotations)
+
+    def _read_segment_file(self, data, idx, fi, start, stop, cals, mult):
+        extras = self._raw_extras[fi]
+        assert mult is None  # the Maxwell filtered data have no projector nor compensation
+        block = extras["chunks"].get(start - extras["first_samp"], stop - extras["first_samp"])
+        data[:] = block[idx]
+
+
+def streaming_maxwell_filter(
+    raw: mne.io.BaseRaw,
+    out_fname: tp.Any,
+    l_freq: float,
+    h_freq: float,
+    max_memory_mb: float,
+    cross_talk: tp.Any = None,
+    calibration: tp.Any = None,
+    destination: tp.Any = None,
+    bads: tp.List[str] | None = None,
+) -> tp.List[str]:
+    """Band-pass filter, find the bad channels (unless given) and Maxwell filter a
+    (not preloaded) run in chunks, writing the result to out_fname. Returns the bad
+    channels (noisy + flat)
+
+    The bad channels found here may differ from those of find_bad_channels_maxwell
+    on the whole run (see find_bad_channels_chunked); pass bads to use others.
+    """
+    maxwell_kwargs = dict(cross_talk=cross_talk, calibration=calibration)
+    step = int(round(5.0 * raw.info["sfreq"]))  # windows of find_bad_channels_maxwell
+    run = ChunkedRun(raw, l_freq, h_freq, max_memory_mb, step=step)
+
+    if bads is None:
+        noisy, flat = find_bad_channels_chunked(run, **maxwell_kwargs)
+        bads = noisy + flat
+
+    chunks = _ProcessedChunks(run, bads, dict(maxwell_kwargs, destination=destination))
+    # the info of the output, as set by the filters, is the one of any processed chunk
+    first = chunks.process(*run.bounds[0])
+    chunks.current = (*run.bounds[0], first.get_data())
+    lazy = _LazySSSRaw(chunks, first.info)
+    del first
+    lazy.save(out_fname, overwrite=True)
+    return bads
@@ -0,0 +1,207 @@
+"""Wall time, CPU time, peak memory, I/O and threads of the stages of the pipeline
+
+Each named stage (filter, maxwell_filter, forward...) of a subject and run is
+wrapped in a stage() block, which appends one JSON line to the telemetry log
+when it ends:
+
+    with telemetry.stage("maxwell_filter", subject, run):
+        raw_sss = mne.preprocessing.maxwell_filter(raw, ...)
+
+The log is set by configure(), through an environment variable so that the
+worker processes write to the same log; without it, stage() does nothing.
+Only Linux gives the peak memory (VmHWM, reset at the start of each stage)
+and the I/O of a stage; elsewhere, the peak of the process is recorded.
+
+The slowest stages and subjects of a log are summarized by:
+    python -m utils.telemetry <log.jsonl>
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import socket
+import sys
+import time
+import typing as tp
+from datetime import datetime
+from pathlib import Path
+
+LOG_VAR = "PIPELINE_TELEMETRY"
+
+# stages running in this process, innermost last: the peak memory of each one
+_STACK: tp.List[tp.Dict[str, tp.Any]] = []
+
+
+def configure(fname: str | Path | None) -> None:
+    """Log the stages of this process (and of the processes it starts) to fname, or to none if None
+
+    The first call wins: a script loaded by pipeline.py keeps the log of the pipeline.
+    """
+    if LOG_VAR in os.environ:
+        return
+    if fname is not None:
+        Path(fname).parent.mkdir(parents=True, exist_ok=True)
+    os.environ[LOG_VAR] = "" if fname is None else str(fname)
+
+
+def _proc_status(key: str) -> int | None:
+    """Value (in bytes) of a memory line of /proc/self/status, e.g. VmHWM"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{key}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak() -> bool:
+    """Reset VmHWM to the current RSS (Linux >= 4.0)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _io() -> tp.Dict[str, int]:
+    """Bytes read and written by the process (including from the page cache), from /proc/self/io"""
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return dict(read=int(fields["rchar"]), written=int(fields["wchar"]))
+    except (OSError, KeyError, ValueError):
+        return {}
+
+
+def blas_threads() -> tp.Dict[str, int]:
+    """Threads of the BLAS and OpenMP libraries loaded, as threadpoolctl sees them (else from the environment)"""
+    try:
+        from threadpoolctl import threadpool_info
+    except ImportError:
+        threads = os.environ.get("OMP_NUM_THREADS")
+        return dict(env=int(threads)) if threads and threads.isdigit() else {}
+    threads: tp.Dict[str, int] = {}
+    for pool in threadpool_info():
+        api = pool["user_api"]
+        threads[api] = max(threads.get(api, 0), pool["num_threads"])
+    return threads
+
+
+def _cpu_time() -> float:
+    """CPU time of the process and of its waited children (e.g. FreeSurfer binaries)"""
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+@contextlib.contextmanager
+def stage(name: str, subject: str | None = None, run: tp.Any = None, **extra: tp.Any) -> tp.Iterator[tp.Dict[str, tp.Any]]:
+    """Record a stage of a subject (and run) in the telemetry log
+
+    extra is recorded as is (e.g. the number of epochs). The record is
+    yielded, so that values known at the end can be added to it.
+    """
+    fname = os.environ.get(LOG_VAR)
+    if not fname:
+        yield dict(extra)
+        return
+
+    # the peak of the enclosing stage so far, before resetting it for this one
+    hwm = _proc_status("VmHWM")
+    if _STACK and hwm is not None:
+        _STACK[-1]["peak"] = max(_STACK[-1]["peak"], hwm)
+    scoped = _reset_peak()
+    current = dict(peak=0)
+    _STACK.append(current)
+    record: tp.Dict[str, tp.Any] = dict(extra)
+    io_start, cpu_start, start = _io(), _cpu_time(), time.perf_counter()
+    status = "ok"
+    try:
+        yield record
+    except BaseException as e:
+        status = type(e).__name__
+        raise
+    finally:
+        wall = time.perf_counter() - start
+        cpu = _cpu_time() - cpu_start
+        io_end = _io()
+        _STACK.pop()
+        if scoped:
+            peak = max(_proc_status("VmHWM") or 0, current["peak"])
+        else:  # peak of the whole process (ru_maxrss is in kB on Linux, in bytes on macOS)
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        if _STACK:
+            _STACK[-1]["peak"] = max(_STACK[-1]["peak"], peak)
+        line = dict(
+            stage=name, subject=subject, run=run, status=status, depth=len(_STACK),
+            wall_s=round(wall, 3), cpu_s=round(cpu, 3), peak_rss_mb=round(peak / 1024**2, 1),
+            peak_scope="stage" if scoped else "process",
+            read_mb=round((io_end["read"] - io_start["read"]) / 1024**2, 1) if io_start and io_end else None,
+            written_mb=round((io_end["written"] - io_start["written"]) / 1024**2, 1) if io_start and io_end else None,
+            threads=blas_threads(), pid=os.getpid(), host=socket.gethostname(), script=Path(sys.argv[0]).name,
+            date=datetime.now().isoformat(timespec="seconds"), **record,
+        )
+        # a single append per record, so that the lines of concurrent workers are not interleaved
+        with open(fname, "a") as f:
+            f.write(json.dumps(line, default=str) + "\n")
+
+
+def read_log(fname: str | Path) -> tp.List[tp.Dict[str, tp.Any]]:
+    records = []
+    with open(fname) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:  # line cut by a crash
+                continue
+    return records
+
+
+def summarize(records: tp.List[tp.Dict[str, tp.Any]], top: int = 10) -> str:
+    """Tables of the time, CPU use and peak memory of each stage, and of the slowest subjects and units"""
+    import pandas as pd
+
+    df = pd.DataFrame(records)
+    if df.empty:
+        return "No stage recorded"
+    df["threads"] = df["threads"].map(lambda threads: max(threads.values()) if isinstance(threads, dict) and threads else 1)
+    # CPU time over the wall time the BLAS threads could have used
+    df["cpu_use"] = df["cpu_s"] / (df["wall_s"] * df["threads"]).clip(lower=1e-9)
+    by_stage = df.groupby("stage").agg(
+        n=("wall_s", "size"), total_s=("wall_s", "sum"), mean_s=("wall_s", "mean"), max_s=("wall_s", "max"),
+        cpu_use=("cpu_use", "mean"), peak_rss_mb=("peak_rss_mb", "max"), read_mb=("read_mb", "sum"),
+        written_mb=("written_mb", "sum"), failed=("status", lambda status: int((status != "ok").sum())),
+    ).sort_values("total_s", ascending=False)
+    # the outermost stages only, not to count the nested ones twice
+    outer = df[df["depth"] == 0]
+    by_subject = outer.groupby(outer["subject"].fillna("-")).agg(
+        total_s=("wall_s", "sum"), peak_rss_mb=("peak_rss_mb", "max"), n=("wall_s", "size"),
+    ).sort_values("total_s", ascending=False).head(top)
+    slowest = df.sort_values("wall_s", ascending=False).head(top)[
+        ["stage", "subject", "run", "wall_s", "cpu_s", "threads", "peak_rss_mb", "read_mb", "date"]]
+    return "\n\n".join([
+        f"Stages ({len(df)} records):\n{by_stage.round(2).to_string()}",
+        f"Slowest subjects:\n{by_subject.round(2).to_string()}",
+        f"Slowest stages:\n{slowest.to_string(index=False)}",
+    ])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Slowest stages and subjects of telemetry logs")
+    parser.add_argument("logs", nargs="+", help="JSONL logs written by the stages")
+    parser.add_argument("--top", type=int, default=10, help="number of subjects and stages listed")
+    parser.add_argument("--stage", nargs="+", help="only these stages")
+    args = parser.parse_args()
+    records = [record for fname in args.logs for record in read_log(fname)]
+    if args.stage:
+        records = [record for record in records if record["stage"] in args.stage]
+    print(summarize(records, args.top))
+
+
+if __name__ == "__main__":
+    main()